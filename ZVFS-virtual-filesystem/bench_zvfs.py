@@ -0,0 +1,223 @@
+# benchmark of the zvfs commands
+# generates a synthetic image (nb of files, size distribution, share of deleted files), times mkfs, addfs, catfs,
+# getfs, rmfs, lsfs, gifs and dfrgfs on it and prints the results as JSON: ops/sec, MB/s, nb of fsyncs and how much
+# each command raised the peak RSS, so two runs (e.g. before and after a change) can be compared with --compare
+# the peak RSS is the highest memory use of the whole process so far, so peak_rss_growth_kb is only what a command
+# needed beyond everything before it (0 = it stayed below an earlier peak), the absolute peak is peak_rss_kb
+#
+# usage: python bench_zvfs.py [--files N] [--sizes fixed:N|uniform:MIN:MAX|lognormal:MU:SIGMA] [--delete RATIO]
+#                             [--repeat N] [--seed N] [--v2] [--output result.json] [--compare baseline.json]
+#                             [--threshold 0.2]
+# the commands print to the console as usual, their output is sent to /dev/null while they are timed
+
+import contextlib
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import zvfs
+
+
+######################### synthetic data ##############################
+
+def size_generator(spec, rng):
+    # function returning random file sizes for a distribution given as text:
+    # fixed:N, uniform:MIN:MAX or lognormal:MU:SIGMA (mu/sigma of the natural log of the size)
+    # raises ValueError for a spec it doesn't understand
+    kind, *args = spec.split(":")
+    try:
+        values = [float(arg) for arg in args]
+    except ValueError:
+        raise ValueError(f"bad size distribution {spec!r}")
+    if kind == "fixed" and len(values) == 1:
+        return lambda: int(values[0])
+    if kind == "uniform" and len(values) == 2:
+        return lambda: rng.randint(int(values[0]), int(values[1]))
+    if kind == "lognormal" and len(values) == 2:
+        return lambda: int(rng.lognormvariate(values[0], values[1]))
+    raise ValueError(f"bad size distribution {spec!r}")
+
+
+def make_host_files(directory, count, sizes, rng):
+    # count files with random (but reproducible) contents in directory, returns their paths
+    # text so catfs has something to print, every file different so nothing is accidentally the same
+    paths = []
+    for i in range(count):
+        path = os.path.join(directory, f"file{i:05d}.txt")
+        size = max(0, sizes())
+        line = f"{i} {rng.random()}\n".encode()
+        with open(path, "wb") as f:
+            f.write((line * (size // len(line) + 1))[:size])
+        paths.append(path)
+    return paths
+
+
+######################### measuring ##############################
+
+class FsyncCounter:     # counts the os.fsync calls made while it is active
+    def __init__(self):
+        self.count = 0
+        self._real = None
+
+    def __enter__(self):
+        self._real = os.fsync
+
+        def counting_fsync(fd):
+            self.count += 1
+            return self._real(fd)
+
+        os.fsync = counting_fsync
+        return self
+
+    def __exit__(self, *exc):
+        os.fsync = self._real
+
+
+def peak_rss_kb():      # highest resident memory of this process so far (ru_maxrss is KB on Linux, bytes on macOS)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+def measure(name, calls, nbytes=0):
+    # runs every call() (output to /dev/null), returns the result dict of the command
+    peak_before = peak_rss_kb()
+    with open(os.devnull, "w") as devnull, FsyncCounter() as fsyncs, contextlib.redirect_stdout(devnull):
+        start = time.perf_counter()
+        for call in calls:
+            call()
+        seconds = time.perf_counter() - start
+    result = {
+        "ops": len(calls),
+        "seconds": round(seconds, 6),
+        "ops_per_sec": round(len(calls) / seconds, 2) if seconds > 0 else None,
+        "mb_per_sec": round(nbytes / seconds / 1e6, 2) if nbytes and seconds > 0 else None,
+        "fsyncs": fsyncs.count,
+        "peak_rss_kb": peak_rss_kb(),
+    }
+    result["peak_rss_growth_kb"] = result["peak_rss_kb"] - peak_before
+    print(f"{name:<8} {result['ops']:>6} ops {result['seconds']:>10.4f} s", file=sys.stderr)
+    return result
+
+
+######################### benchmark ##############################
+
+def run(files=32, sizes="lognormal:8:1.5", delete=0.25, repeat=20, seed=0, version=zvfs.VERSION, work_dir=None):
+    # runs the whole benchmark in a temporary directory, returns the result dict (config + one entry per command)
+    # raises ValueError if the configuration can't work (e.g. too many files for a version 1 image)
+    if version == zvfs.VERSION and files > zvfs.FILE_CAPACITY:
+        raise ValueError(f"a version 1 image holds at most {zvfs.FILE_CAPACITY} files, use --v2 for more.")
+    if not 0 <= delete <= 1:
+        raise ValueError("the deletion ratio must be between 0 and 1.")
+    rng = random.Random(seed)
+    sizes_of = size_generator(sizes, rng)
+    results = {}
+
+    old_cwd = os.getcwd()
+    work_dir = tempfile.mkdtemp(prefix="bench_zvfs_", dir=work_dir)
+    try:
+        host_dir = os.path.join(work_dir, "host")
+        out_dir = os.path.join(work_dir, "out")
+        os.mkdir(host_dir)
+        os.mkdir(out_dir)
+        paths = make_host_files(host_dir, files, sizes_of, rng)
+        names = [os.path.basename(path) for path in paths]
+        total_bytes = sum(os.path.getsize(path) for path in paths)
+        fs = os.path.join(work_dir, "bench.zvfs")
+
+        results["mkfs"] = measure("mkfs", [lambda i=i: zvfs.mkfs(os.path.join(work_dir, f"mkfs{i}.zvfs"), version=version)
+                                           for i in range(repeat)])
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            zvfs.mkfs(fs, version=version)
+        results["addfs"] = measure("addfs", [lambda path=path: zvfs.addfs(fs, path) for path in paths], total_bytes)
+        results["lsfs"] = measure("lsfs", [lambda: zvfs.lsfs(fs)] * repeat)
+        results["gifs"] = measure("gifs", [lambda: zvfs.gifs(fs)] * repeat)
+        results["catfs"] = measure("catfs", [lambda name=name: zvfs.catfs(fs, name) for name in names], total_bytes)
+        os.chdir(out_dir)       # getfs extracts into the current directory
+        results["getfs"] = measure("getfs", [lambda name=name: zvfs.getfs(fs, name) for name in names], total_bytes)
+        os.chdir(old_cwd)
+
+        removed = rng.sample(names, int(len(names) * delete))
+        removed_bytes = sum(os.path.getsize(os.path.join(host_dir, name)) for name in removed)
+        results["rmfs"] = measure("rmfs", [lambda name=name: zvfs.rmfs(fs, name) for name in removed])
+        image_size = os.path.getsize(fs)
+        results["dfrgfs"] = measure("dfrgfs", [lambda: zvfs.dfrgfs(fs)], total_bytes - removed_bytes)
+        results["dfrgfs"]["bytes_freed"] = image_size - os.path.getsize(fs)
+    finally:
+        os.chdir(old_cwd)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return {
+        "config": {"files": files, "sizes": sizes, "delete": delete, "repeat": repeat, "seed": seed,
+                   "version": version, "total_bytes": total_bytes},
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+
+
+def compare(baseline, current, threshold=0.2):
+    # commands that got slower than the baseline by more than threshold (0.2 = 20% fewer ops/sec)
+    # returns a list of (command, baseline ops/sec, current ops/sec)
+    slower = []
+    for name, result in current["results"].items():
+        old = baseline.get("results", {}).get(name)
+        if not old or not old.get("ops_per_sec") or not result.get("ops_per_sec"):
+            continue
+        if result["ops_per_sec"] < old["ops_per_sec"] * (1 - threshold):
+            slower.append((name, old["ops_per_sec"], result["ops_per_sec"]))
+    return slower
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    try:
+        version = zvfs.VERSION_2 if zvfs.pop_flag(args, "--v2") else zvfs.VERSION
+        options = {
+            "files": int(zvfs.pop_option(args, "--files", "32")),
+            "sizes": zvfs.pop_option(args, "--sizes", "lognormal:8:1.5"),
+            "delete": float(zvfs.pop_option(args, "--delete", "0.25")),
+            "repeat": int(zvfs.pop_option(args, "--repeat", "20")),
+            "seed": int(zvfs.pop_option(args, "--seed", "0")),
+        }
+        output = zvfs.pop_option(args, "--output")
+        baseline_path = zvfs.pop_option(args, "--compare")
+        threshold = float(zvfs.pop_option(args, "--threshold", "0.2"))
+        if args:
+            raise ValueError(f"unknown arguments {' '.join(args)}")
+        baseline = None
+        if baseline_path:
+            try:
+                with open(baseline_path) as f:
+                    baseline = json.load(f)
+            except (OSError, json.JSONDecodeError) as e:
+                print(f"Error: can't read baseline {baseline_path} ({e})")
+                sys.exit(1)
+        report = run(version=version, **options)
+    except ValueError as e:
+        print(f"Error: {e}")
+        print("Usage: python bench_zvfs.py [--files N] [--sizes fixed:N|uniform:MIN:MAX|lognormal:MU:SIGMA] "
+              "[--delete RATIO] [--repeat N] [--seed N] [--v2] [--output result.json] [--compare baseline.json] "
+              "[--threshold 0.2]")
+        sys.exit(1)
+
+    text = json.dumps(report, indent=2)
+    if output:
+        with open(output, "w") as f:
+            f.write(text + "\n")
+    print(text)
+
+    if baseline is not None:
+        if baseline.get("config") != report["config"]:
+            print("Warning: the baseline was made with another configuration, the numbers may not be comparable",
+                  file=sys.stderr)
+        slower = compare(baseline, report, threshold)
+        for name, old, new in slower:
+            print(f"Regression: {name} {old} -> {new} ops/sec", file=sys.stderr)
+        if slower:
+            sys.exit(1)
@@ -0,0 +1,1530 @@
+# #################################### Testing for zvfs ####################################
+
+
+import zvfs             # you need to call zvfs.METHOD/OBJECT for anything that you want to import from zvfs
+import zvfs_server
+import bench_zvfs
+import zvfs_fuse
+import zvfs_async
+import os
+import asyncio
+import multiprocessing
+import json
+import io
+import time
+import threading
+import subprocess
+import sys
+
+
+# helper: create a fresh filesystem with some host files added to it, returns path of the image
+def make_fs(tmp_path, files):
+    fs = str(tmp_path / "test.zvfs")
+    zvfs.mkfs(fs)
+    for name, data in files.items():
+        host = tmp_path / name
+        host.write_bytes(data)
+        zvfs.addfs(fs, str(host))
+    return fs
+
+
+#region ######################## Test ZvfsImage #########################
+
+def test_image_loads_table_and_index(tmp_path):
+    fs = make_fs(tmp_path, {"a.txt": b"hello", "b.txt": b"world!"})
+
+    with zvfs.ZvfsImage(fs) as image:
+        assert len(image.entries) == zvfs.FILE_CAPACITY
+        assert image.index == {"a.txt": 0, "b.txt": 1}
+        assert image.lookup("b.txt").length == 6
+        assert image.read_data(image.lookup("a.txt")) == b"hello"
+        assert image.lookup("missing.txt") is None
+
+def test_image_index_stays_in_sync(tmp_path):
+    fs = make_fs(tmp_path, {"a.txt": b"hello"})
+
+    with zvfs.ZvfsImage(fs, writable=True) as image:
+        image.add_bytes("c.txt", b"x" * 100)
+        assert image.lookup("c.txt").start == zvfs.DATA_START + 64
+        image.remove("a.txt")
+        assert image.lookup("a.txt") is None
+        assert image.find("a.txt", include_deleted=True).flag == 1
+
+        try:
+            image.add_bytes("c.txt", b"again")
+            assert False, "Duplicate name should raise ValueError"
+        except ValueError:
+            assert True
+
+    # what was kept in memory must match what a fresh open reads from disk
+    with zvfs.ZvfsImage(fs) as image:
+        assert image.index == {"c.txt": 1}
+        assert image.header.file_count == 1
+        assert image.header.deleted_files == 1
+
+def test_commands_use_image(tmp_path, monkeypatch, capsys):
+    fs = make_fs(tmp_path, {"a.txt": b"hello"})
+    monkeypatch.chdir(tmp_path)
+    os.remove("a.txt")
+
+    zvfs.getfs(fs, "a.txt")
+    assert (tmp_path / "a.txt").read_bytes() == b"hello"
+
+    zvfs.catfs(fs, "a.txt")
+    assert "hello" in capsys.readouterr().out
+
+    zvfs.rmfs(fs, "a.txt")
+    zvfs.catfs(fs, "a.txt")
+    assert "not found" in capsys.readouterr().out
+
+#endregion
+
+
+#region ######################## Test mmap read path #########################
+
+def test_view_is_zero_copy_slice(tmp_path):
+    fs = make_fs(tmp_path, {"a.txt": b"hello", "b.bin": bytes(range(256)) * 10})
+
+    with zvfs.ZvfsImage(fs, use_mmap=True) as image:
+        entry = image.lookup("b.bin")
+        with image.view(entry) as data:
+            assert isinstance(data.obj, zvfs.mmap.mmap)   # slice of the mapping, not a copy
+            assert data == bytes(range(256)) * 10
+
+def test_catfs_streams_multibyte_text(tmp_path, capsys):
+    text = "äöü" * (zvfs.CHUNK_SIZE // 3 + 5)    # a chunk border falls in the middle of a character
+    fs = make_fs(tmp_path, {"u.txt": text.encode("utf-8")})
+    capsys.readouterr()     # drop output of mkfs/addfs
+
+    zvfs.catfs(fs, "u.txt")
+    assert capsys.readouterr().out == f"Contents of 'u.txt':\n\n{text}\n"
+
+#endregion
+
+
+#region ######################## Test streaming addfs #########################
+
+def test_addfs_streams_in_chunks(tmp_path, monkeypatch):
+    monkeypatch.setattr(zvfs, "CHUNK_SIZE", 1000)   # force many chunks for a small file
+    data = os.urandom(10_001)
+    fs = make_fs(tmp_path, {"big.bin": data, "after.txt": b"x"})
+
+    with zvfs.ZvfsImage(fs) as image:
+        assert image.read_data(image.lookup("big.bin")) == data
+        assert image.lookup("after.txt").start == zvfs.DATA_START + 10_048   # padded to the 64-byte boundary
+        assert image.header.next_free_offset == zvfs.DATA_START + 10_048 + 64
+
+def test_copy_range_fallbacks(tmp_path, monkeypatch):
+    data = os.urandom(5000)
+    (tmp_path / "src").write_bytes(data)
+
+    def broken(*args):
+        raise OSError("not supported")
+
+    for mode in ("sendfile", "pread"):
+        monkeypatch.setattr(zvfs.os, "copy_file_range", broken)
+        if mode == "pread":
+            monkeypatch.setattr(zvfs.os, "sendfile", broken)
+        with open(tmp_path / "src", "rb") as src, open(tmp_path / mode, "w+b") as dst:
+            zvfs.copy_range(src.fileno(), dst.fileno(), 100, 64, 4900)
+        assert (tmp_path / mode).read_bytes() == b"\x00" * 64 + data[100:]
+
+#endregion
+
+
+#region ######################## Test addfs_many #########################
+
+def test_addfs_many_single_fsync(tmp_path, monkeypatch):
+    fs = make_fs(tmp_path, {})
+    paths = []
+    for i in range(5):
+        (tmp_path / f"f{i}.txt").write_bytes(b"data %d" % i)
+        paths.append(str(tmp_path / f"f{i}.txt"))
+
+    fsyncs = []
+    real_fsync = zvfs.os.fsync
+    monkeypatch.setattr(zvfs.os, "fsync", lambda fd: (fsyncs.append(fd), real_fsync(fd)))
+    zvfs.addfs_many(fs, paths)
+    assert len(fsyncs) == 2     # one commit: journal record + payloads, then the table in place (not one per file)
+
+    with zvfs.ZvfsImage(fs) as image:
+        assert image.header.file_count == 5
+        assert image.header.free_entry_offset == zvfs.HEADER_SIZE + 5 * zvfs.ENTRY_SIZE
+        assert image.read_data(image.lookup("f3.txt")) == b"data 3"
+
+def test_addfs_many_all_or_nothing(tmp_path, capsys):
+    fs = make_fs(tmp_path, {"f1.txt": b"old"})
+    size_before = os.path.getsize(fs)
+    (tmp_path / "f0.txt").write_bytes(b"new")
+
+    zvfs.addfs_many(fs, [str(tmp_path / "f0.txt"), str(tmp_path / "f1.txt")])   # f1.txt already exists
+    assert "Nothing was added." in capsys.readouterr().out
+    assert os.path.getsize(fs) == size_before
+
+    with zvfs.ZvfsImage(fs) as image:
+        assert image.header.file_count == 1
+        assert image.lookup("f0.txt") is None
+
+#endregion
+
+
+#region ######################## Test dfrgfs #########################
+
+def test_dfrgfs_compacts_in_place(tmp_path, monkeypatch):
+    monkeypatch.setattr(zvfs, "CHUNK_SIZE", 100)    # moves overlap their own source with a small buffer
+    files = {"a.bin": os.urandom(300), "b.bin": os.urandom(1000), "c.bin": os.urandom(70), "d.bin": b""}
+    fs = make_fs(tmp_path, files)
+    zvfs.rmfs(fs, "a.bin")
+    zvfs.rmfs(fs, "c.bin")
+
+    zvfs.dfrgfs(fs)
+
+    with zvfs.ZvfsImage(fs) as image:
+        assert image.index == {"b.bin": 0, "d.bin": 1}
+        assert image.lookup("b.bin").start == zvfs.DATA_START
+        assert image.read_data(image.lookup("b.bin")) == files["b.bin"]
+        assert image.header.deleted_files == 0
+        assert image.header.free_entry_offset == zvfs.HEADER_SIZE + 2 * zvfs.ENTRY_SIZE
+        assert image.header.next_free_offset == zvfs.DATA_START + 1024
+        assert image.entries[2].is_empty()
+    assert os.path.getsize(fs) == zvfs.DATA_START + 1024     # tail is cut off
+
+#endregion
+
+
+#region ######################## Test free-extent allocator #########################
+
+def test_add_reuses_space_of_deleted_file(tmp_path):
+    fs = make_fs(tmp_path, {"a.bin": b"a" * 100, "b.bin": b"b" * 500, "c.bin": b"c" * 10})
+    zvfs.rmfs(fs, "b.bin")
+
+    with zvfs.ZvfsImage(fs, writable=True) as image:
+        b_start = image.find("b.bin", include_deleted=True).start
+        end_before = image.header.next_free_offset
+        assert image.free_extents == [[b_start, 512]]
+
+        slot, entry = image.add_bytes("d.bin", b"d" * 200)      # best fit: lands where b.bin was
+        assert entry.start == b_start
+        assert image.header.next_free_offset == end_before
+        assert image.free_extents == [[b_start + 256, 256]]
+        assert image.find("b.bin", include_deleted=True) is None    # its data is gone, so is the deleted entry
+        assert image.header.deleted_files == 0
+
+    with zvfs.ZvfsImage(fs) as image:     # same result when everything is rebuilt from disk
+        assert image.free_extents == [[b_start + 256, 256]]
+        assert image.read_data(image.lookup("d.bin")) == b"d" * 200
+        assert image.read_data(image.lookup("c.bin")) == b"c" * 10
+
+def test_add_reuses_deleted_slot_when_table_is_full(tmp_path, capsys):
+    fs = make_fs(tmp_path, {})
+    with zvfs.ZvfsImage(fs, writable=True) as image:
+        for i in range(zvfs.FILE_CAPACITY):
+            image.add_bytes(f"f{i}", b"x")
+        assert image.header.flags == 1 and image.header.free_entry_offset == 0
+    zvfs.rmfs(fs, "f7")
+
+    (tmp_path / "new.txt").write_bytes(b"y")
+    zvfs.addfs(fs, str(tmp_path / "new.txt"))
+    assert "Error" not in capsys.readouterr().out
+
+    with zvfs.ZvfsImage(fs) as image:
+        assert image.index["new.txt"] == 7
+        assert image.lookup("new.txt").start == image.find("f6").start + 64   # old data space of f7
+        assert image.header.file_count == zvfs.FILE_CAPACITY
+        assert image.header.deleted_files == 0
+
+#endregion
+
+
+#region ######################## Test version 2 format #########################
+
+def test_v2_table_grows_and_index_finds_files(tmp_path):
+    fs = str(tmp_path / "v2.zvfs")
+    zvfs.mkfs(fs, zvfs.VERSION_2, slots=10)
+
+    with zvfs.ZvfsImage(fs, writable=True) as image:
+        with image.batch():
+            for i in range(600):        # needs 3 more table blocks
+                image.add_bytes(f"file{i}", b"%d" % i)
+        assert image.header.file_capacity == 10 + 3 * zvfs.BLOCK_SLOTS
+
+    with zvfs.ZvfsImage(fs, load_table=False) as image:    # lookups through the on-disk hash index only
+        assert image.entries is None
+        assert image.read_data(image.lookup("file599")) == b"599"
+        assert image.read_data(image.lookup("file7")) == b"7"
+        assert image.lookup("file600") is None
+
+    with zvfs.ZvfsImage(fs) as image:       # version 1 classes read the chained table
+        assert len(image.entries) == image.header.file_capacity
+        assert image.header.file_count == 600
+        assert image.index["file300"] == 300
+
+def test_v2_remove_readd_and_defragment(tmp_path):
+    fs = str(tmp_path / "v2.zvfs")
+    zvfs.mkfs(fs, zvfs.VERSION_2, slots=4)
+
+    with zvfs.ZvfsImage(fs, writable=True) as image:
+        for round in range(50):         # lots of stale buckets -> index gets rebuilt along the way
+            image.add_bytes(f"tmp{round}", b"x" * 100)
+            image.remove(f"tmp{round}")
+        for i in range(300):
+            image.add_bytes(f"keep{i}", b"k%d" % i)
+        for i in range(0, 300, 2):
+            image.remove(f"keep{i}")
+        image.compact()
+
+    with zvfs.ZvfsImage(fs, load_table=False) as image:
+        assert image.lookup("keep0") is None
+        assert image.read_data(image.lookup("keep299")) == b"k299"
+    with zvfs.ZvfsImage(fs) as image:
+        assert image.header.file_count == 150
+        assert image.header.deleted_files == 0
+        for slot, entry in image.active_entries():
+            assert image.read_data(entry) == b"k" + entry.name[4:].encode()
+
+def test_v1_images_are_unchanged(tmp_path):
+    fs = make_fs(tmp_path, {"a.txt": b"hello"})
+    with open(fs, "rb") as f:
+        header = zvfs.Header().unpack(f.read(zvfs.HEADER_SIZE))
+    assert header.version == 1 and zvfs.read_slot_map(header) is not None   # reserved2 holds the slot map
+    assert os.path.getsize(fs) == zvfs.DATA_START + 64
+
+#endregion
+
+
+#region ######################## Test checksums / fsckfs #########################
+
+def test_addfs_stores_checksum(tmp_path):
+    fs = make_fs(tmp_path, {"a.txt": b"hello"})
+    with zvfs.ZvfsImage(fs, writable=True) as image:
+        image.add_bytes("b.txt", b"world")
+        image.add_bytes("c.txt", b"no crc", checksum=False)
+        assert image.lookup("a.txt").checksum() == zvfs.zlib.crc32(b"hello")
+        assert image.lookup("b.txt").checksum() == zvfs.zlib.crc32(b"world")
+        assert image.lookup("c.txt").checksum() is None
+
+def test_checksummed_addfs_keeps_the_kernel_copy(tmp_path, monkeypatch):
+    if not hasattr(os, "copy_file_range"):
+        return
+    calls = []
+    real_copy = os.copy_file_range
+    monkeypatch.setattr(os, "copy_file_range", lambda *args: calls.append(args) or real_copy(*args))
+    data = os.urandom(5000)
+    fs = make_fs(tmp_path, {"a.bin": data})
+    assert calls
+    with zvfs.ZvfsImage(fs) as image:
+        assert image.lookup("a.bin").checksum() == zvfs.zlib.crc32(data)
+
+def test_fsckfs_finds_bit_rot(tmp_path, capsys):
+    fs = make_fs(tmp_path, {f"f{i}.bin": os.urandom(3000) for i in range(8)})
+    assert zvfs.fsckfs(fs) == []
+
+    with zvfs.ZvfsImage(fs) as image:
+        start = image.lookup("f5.bin").start
+    with open(fs, "r+b") as f:      # flip one bit in the data of f5.bin
+        f.seek(start + 1234)
+        byte = f.read(1)[0]
+        f.seek(start + 1234)
+        f.write(bytes([byte ^ 0x10]))
+
+    assert zvfs.fsckfs(fs, workers=4) == ["f5.bin"]
+    assert "7 ok, 1 corrupt" in capsys.readouterr().out
+
+#endregion
+
+
+#region ######################## Test compression #########################
+
+def test_compressed_files_roundtrip(tmp_path, monkeypatch, capsys):
+    monkeypatch.setattr(zvfs, "CHUNK_SIZE", 4096)   # many compressed and decompressed chunks
+    log = b"".join(b"2025-12-05 12:00:%02d INFO request handled in %d ms\n" % (i % 60, i) for i in range(5000))
+    fs = make_fs(tmp_path, {})
+    for codec in ("zlib", "lzma"):
+        (tmp_path / f"{codec}.log").write_bytes(log)
+        zvfs.addfs(fs, str(tmp_path / f"{codec}.log"), compress=codec)
+
+    with zvfs.ZvfsImage(fs) as image:
+        for codec in ("zlib", "lzma"):
+            entry = image.lookup(f"{codec}.log")
+            assert entry.type == zvfs.CODECS[codec]
+            assert entry.length * 3 < len(log) and entry.data_length() == len(log)
+            assert b"".join(image.iter_data(entry)) == log
+    assert zvfs.fsckfs(fs) == []
+
+    monkeypatch.chdir(tmp_path)
+    os.remove("lzma.log")
+    zvfs.getfs(fs, "lzma.log")
+    assert (tmp_path / "lzma.log").read_bytes() == log
+    capsys.readouterr()
+    zvfs.catfs(fs, "zlib.log")
+    assert capsys.readouterr().out == "Contents of 'zlib.log':\n\n" + log.decode() + "\n"
+
+def test_compression_that_does_not_pay_off_keeps_raw_bytes(tmp_path):
+    data = os.urandom(5000)
+    fs = make_fs(tmp_path, {})
+    with zvfs.ZvfsImage(fs, writable=True) as image:
+        image.add_bytes("random.bin", data, compress="zlib")
+        entry = image.lookup("random.bin")
+        assert not entry.is_compressed() and entry.length == 5000
+        assert image.read_data(entry) == data
+
+#endregion
+
+
+#region ######################## Test getfs --all #########################
+
+def test_getfs_all_extracts_every_active_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(zvfs, "CHUNK_SIZE", 1000)
+    files = {f"f{i}.bin": os.urandom(i * 700) for i in range(12)}
+    fs = make_fs(tmp_path, files)
+    (tmp_path / "notes.txt").write_bytes(b"zvfs " * 2000)
+    zvfs.addfs(fs, str(tmp_path / "notes.txt"), compress="zlib")
+    zvfs.rmfs(fs, "f3.bin")
+
+    assert zvfs.getfs_all(fs, str(tmp_path / "restore"), workers=4) == 12
+    restored = {path.name: path.read_bytes() for path in (tmp_path / "restore").iterdir()}
+    expected = {name: data for name, data in files.items() if name != "f3.bin"}
+    expected["notes.txt"] = b"zvfs " * 2000
+    assert restored == expected
+
+def add_foreign(monkeypatch, fs, name, data):
+    # adds a file the way a tool that doesn't check paths would
+    with monkeypatch.context() as patch:
+        patch.setattr(zvfs, "check_path", lambda name: None)
+        with zvfs.ZvfsImage(fs, writable=True) as image:
+            image.add_bytes(name, data)
+
+def test_extract_all_keeps_files_inside_destination(tmp_path, monkeypatch):
+    fs = make_fs(tmp_path, {"a.txt": b"aaa"})
+    add_foreign(monkeypatch, fs, "../evil.txt", b"x")
+    with zvfs.ZvfsImage(fs) as image:
+        paths = image.extract_all(tmp_path / "out")
+    assert sorted(path.name for path in paths) == ["a.txt", "evil.txt"]
+    assert (tmp_path / "out" / "evil.txt").read_bytes() == b"x"
+    assert not (tmp_path / "evil.txt").exists()
+
+#endregion
+
+
+#region ######################## Test deduplication #########################
+
+def test_dedup_shares_one_extent(tmp_path):
+    config = b"listen 8080\nworkers 4\n" * 300
+    fs = make_fs(tmp_path, {})
+    for i in range(3):
+        (tmp_path / f"snap{i}.conf").write_bytes(config)
+    (tmp_path / "other.conf").write_bytes(config[:-1] + b"?")   # same length, different bytes
+    zvfs.addfs(fs, str(tmp_path / "snap0.conf"), dedup=True)
+    size = os.path.getsize(fs)
+    zvfs.addfs_many(fs, [str(tmp_path / "snap1.conf"), str(tmp_path / "snap2.conf")], dedup=True)
+    assert os.path.getsize(fs) == size      # no data written for the copies
+    zvfs.addfs(fs, str(tmp_path / "other.conf"), dedup=True)
+
+    with zvfs.ZvfsImage(fs) as image:
+        starts = {image.lookup(f"snap{i}.conf").start for i in range(3)}
+        assert len(starts) == 1 and image.lookup("other.conf").start not in starts
+        assert image.shared_refs(image.lookup("snap0.conf")) == 3
+        assert image.read_data(image.lookup("snap2.conf")) == config
+
+def test_rmfs_and_dfrgfs_honor_shared_extents(tmp_path):
+    config = os.urandom(3000)
+    fs = make_fs(tmp_path, {"first.bin": os.urandom(5000)})
+    with zvfs.ZvfsImage(fs, writable=True) as image:
+        image.add_bytes("a.conf", config, dedup=True)
+        image.add_bytes("b.conf", config, dedup=True)
+        image.remove("a.conf")
+        assert image.shared_refs(image.lookup("b.conf")) == 1
+        image.add_bytes("filler.bin", os.urandom(3000))     # must not land on the data b.conf still uses
+        assert image.read_data(image.lookup("b.conf")) == config
+        image.add_bytes("c.conf", config, dedup=True)
+        image.remove("first.bin")
+
+    zvfs.dfrgfs(fs)
+    with zvfs.ZvfsImage(fs) as image:
+        b, c = image.lookup("b.conf"), image.lookup("c.conf")
+        assert b.start == c.start and image.shared_refs(b) == 2
+        assert image.read_data(c) == config
+        assert image.read_data(image.lookup("filler.bin")) != config
+    assert os.path.getsize(fs) == zvfs.DATA_START + 3008 + 3008
+    assert zvfs.fsckfs(fs) == []
+
+#endregion
+
+
+#region ######################## Test zvfs daemon #########################
+
+def test_daemon_serves_requests(tmp_path, monkeypatch, capsys):
+    fs = make_fs(tmp_path, {"a.txt": b"hello daemon"})
+    (tmp_path / "b.bin").write_bytes(os.urandom(3000))
+    sock = str(tmp_path / "zvfs.sock")
+    monkeypatch.chdir(tmp_path)
+
+    async def scenario():
+        server = zvfs_server.ZvfsServer(fs)
+        async with await server.start(sock):
+            # the sync client blocks, so it runs in a thread while the loop serves it
+            add = await asyncio.to_thread(zvfs_server.client, fs, ["addfs", "b.bin", "--compress", "zlib"], sock)
+            assert add["ok"] and add["name"] == "b.bin"
+            listing = await asyncio.to_thread(zvfs_server.client, fs, ["lsfs"], sock)
+            assert [f["name"] for f in listing["files"]] == ["a.txt", "b.bin"]
+
+            reader, writer = await asyncio.open_unix_connection(sock)
+            for line in (b'{"op": "cat", "name": "a.txt"}\n', b'{"op": "rm", "name": "nope"}\n', b'{"op": "format"}\n', b'oops\n'):
+                writer.write(line)
+            responses = [await reader.readline() for _ in range(4)]
+            writer.close()
+            assert b'"text": "hello daemon"' in responses[0]
+            assert all(b'"ok": false' in r for r in responses[1:])
+
+            # several readers at once, the write in between still sees a consistent table
+            jobs = [asyncio.to_thread(zvfs_server.request, sock, {"op": "get", "name": "b.bin", "dest": str(tmp_path / f"out{i}.bin")}) for i in range(4)]
+            jobs.append(asyncio.to_thread(zvfs_server.request, sock, {"op": "rm", "name": "a.txt"}))
+            assert all(r["ok"] for r in await asyncio.gather(*jobs))
+
+            try:    # the image is locked as long as the daemon runs
+                zvfs_server.ZvfsServer(fs)
+                assert False, "second daemon on the same image"
+            except ValueError as e:
+                assert "locked" in str(e)
+        server.close()
+        zvfs_server.ZvfsServer(fs).close()      # lock is gone with the first daemon
+
+    asyncio.run(scenario())
+    capsys.readouterr()
+    assert all((tmp_path / f"out{i}.bin").read_bytes() == (tmp_path / "b.bin").read_bytes() for i in range(4))
+    zvfs.lsfs(fs)
+    assert "a.txt" not in capsys.readouterr().out
+
+def test_daemon_group_commits_queued_writes(tmp_path, monkeypatch):
+    fs = make_fs(tmp_path, {"a.txt": b"a"})
+    for i in range(8):
+        (tmp_path / f"g{i}.txt").write_bytes(b"group %d" % i)
+    sock = str(tmp_path / "zvfs.sock")
+    fsyncs = []
+    real_fsync = zvfs.os.fsync
+    monkeypatch.setattr(zvfs.os, "fsync", lambda fd: (fsyncs.append(fd), real_fsync(fd)))
+
+    async def scenario():
+        server = zvfs_server.ZvfsServer(fs)
+        async with await server.start(sock):
+            requests = [{"op": "add", "path": str(tmp_path / f"g{i}.txt")} for i in range(8)]
+            requests.append({"op": "add", "path": str(tmp_path / "g0.txt")})     # already exists -> fails alone
+            responses = await asyncio.gather(*(server.execute(r) for r in requests))
+        server.close()
+        return responses
+
+    responses = asyncio.run(scenario())
+    assert [r["ok"] for r in responses] == [True] * 8 + [False]
+    assert len(fsyncs) < 8      # far less than one commit per file
+    assert sorted(contents(fs)) == ["a.txt"] + [f"g{i}.txt" for i in range(8)]
+
+def test_daemon_group_fails_as_a_whole_if_the_commit_fails(tmp_path, monkeypatch):
+    fs = make_fs(tmp_path, {"a.txt": b"a"})
+    for name in ("b.txt", "c.txt"):
+        (tmp_path / name).write_bytes(name.encode())
+    group = [("add", {"op": "add", "path": str(tmp_path / name)}, None) for name in ("b.txt", "c.txt")]
+    server = zvfs_server.ZvfsServer(fs)
+    fail_fsync(monkeypatch, 1)
+    responses = server.run_group(group)
+    monkeypatch.undo()
+    assert [r["ok"] for r in responses] == [False, False] and all("No space" in r["error"] for r in responses)
+    assert [r["ok"] for r in server.run_group(group)] == [True, True]     # nothing of it was committed before
+    server.close()
+    assert sorted(contents(fs)) == ["a.txt", "b.txt", "c.txt"]
+
+def test_daemon_checks_field_types(tmp_path):
+    fs = make_fs(tmp_path, {"a.txt": b"hello"})
+    bad = [{"op": "get", "name": "a.txt", "dest": 3}, {"op": "get", "name": "a.txt", "dest": "out.txt"},
+           {"op": "get", "name": ["a.txt"], "dest": str(tmp_path / "out.txt")}, {"op": "add", "path": 123},
+           {"op": "add", "path": str(tmp_path / "a.txt"), "compress": ["zlib"]},
+           {"op": "add", "path": str(tmp_path / "a.txt"), "dedup": "yes"}, {"op": "cat", "name": None},
+           {"op": "rm", "name": "a.txt", "punch": 1}]
+
+    async def scenario():
+        server = zvfs_server.ZvfsServer(fs)
+        responses = [await server.execute(request) for request in bad]
+        server.close()
+        return responses
+
+    responses = asyncio.run(scenario())
+    assert [response["ok"] for response in responses] == [False] * len(bad)
+    assert contents(fs) == {"a.txt": b"hello"}      # header untouched, nothing removed
+
+def test_read_write_lock_serializes_writers():
+    async def scenario():
+        lock = zvfs_server.ReadWriteLock()
+        log = []
+        async def reader(i):
+            async with lock.read():
+                log.append(("r", i))
+                await asyncio.sleep(0.01)
+                log.append(("r-done", i))
+        async def writer():
+            async with lock.write():
+                log.append("w")
+                await asyncio.sleep(0.01)
+                log.append("w-done")
+        await asyncio.gather(reader(0), reader(1), writer(), writer())
+        return log
+
+    log = asyncio.run(scenario())
+    assert log[:2] == [("r", 0), ("r", 1)]      # readers at the same time
+    assert log[4:] == ["w", "w-done", "w", "w-done"]  # writers after the readers, one at a time
+
+#endregion
+
+
+#region ######################## Test deduplication fixes #########################
+
+def test_dfrgfs_with_empty_file_next_to_real_file(tmp_path, capsys):
+    fs = make_fs(tmp_path, {"a.txt": b"a" * 100, "e.txt": b"", "b.txt": b"b" * 100})
+    zvfs.rmfs(fs, "a.txt")
+    zvfs.dfrgfs(fs)
+    with zvfs.ZvfsImage(fs) as image:
+        assert image.read_data(image.lookup("b.txt")) == b"b" * 100
+        assert image.lookup("e.txt").length == 0
+    assert zvfs.fsckfs(fs) == []
+
+def test_dedup_finds_remaining_copy_and_gifs_counts_shared_data_once(tmp_path, capsys):
+    data = os.urandom(1000)
+    fs = make_fs(tmp_path, {})
+    with zvfs.ZvfsImage(fs, writable=True) as image:
+        image.add_bytes("x1", data)     # two copies, added without dedup
+        image.add_bytes("x2", data)
+        image.remove("x1")
+        image.add_bytes("x3", data, dedup=True)
+        assert image.lookup("x3").start == image.lookup("x2").start
+    capsys.readouterr()
+    zvfs.gifs(fs)
+    assert "Total space used: 2000 bytes" in capsys.readouterr().out   # deleted x1 + the shared extent once
+
+#endregion
+
+
+#region ######################## Test locking #########################
+
+def test_readers_share_the_lock_writers_dont(tmp_path):
+    fs = make_fs(tmp_path, {"a.txt": b"a"})
+    with zvfs.ZvfsImage(fs) as reader:
+        with zvfs.ZvfsImage(fs, lock_timeout=0) as other_reader:   # readers at the same time
+            assert other_reader.lookup("a.txt") is not None
+        try:
+            zvfs.ZvfsImage(fs, writable=True, lock_timeout=0.05)
+            assert False, "writer got in next to a reader"
+        except ValueError as e:
+            assert "locked" in str(e)
+    with zvfs.ZvfsImage(fs, writable=True, lock_timeout=0):        # free again
+        pass
+
+def add_many_in_process(fs, folder, worker):
+    for i in range(10):
+        path = os.path.join(folder, f"w{worker}_{i}.txt")
+        with open(path, "wb") as f:
+            f.write(f"worker {worker} file {i}".encode() * 50)
+        zvfs.addfs(fs, path)
+
+def test_parallel_addfs_processes_dont_overwrite_each_other(tmp_path):
+    fs = str(tmp_path / "test.zvfs")
+    zvfs.mkfs(fs, zvfs.VERSION_2, 8)
+    ctx = multiprocessing.get_context("fork")
+    workers = [ctx.Process(target=add_many_in_process, args=(fs, str(tmp_path), w)) for w in range(4)]
+    for p in workers:
+        p.start()
+    for p in workers:
+        p.join()
+    with zvfs.ZvfsImage(fs) as image:
+        files = {entry.name: image.read_data(entry) for slot, entry in image.active_entries()}
+        assert image.header.file_count == 40
+    assert files == {f"w{w}_{i}.txt": f"worker {w} file {i}".encode() * 50 for w in range(4) for i in range(10)}
+    assert zvfs.fsckfs(fs) == []
+
+#endregion
+
+
+#region ######################## Test journal / crash safety #########################
+
+class Crash(Exception):
+    pass
+
+def crash_at_write(monkeypatch, fs, n):
+    # the n-th os.pwrite only writes half of its bytes and the image is copied as it is at that moment (= the crash)
+    real_pwrite = os.pwrite
+    count = [0]
+    snapshot = []
+    def pwrite(fd, data, offset):
+        count[0] += 1
+        if count[0] == n:
+            real_pwrite(fd, bytes(data[:len(data) // 2]), offset)
+            with open(fs, "rb") as f:
+                snapshot.append(f.read())
+            raise Crash()
+        return real_pwrite(fd, data, offset)
+    monkeypatch.setattr(zvfs.os, "pwrite", pwrite)
+    return count, snapshot
+
+def contents(fs):
+    with zvfs.ZvfsImage(fs) as image:
+        return {entry.name: b"".join(image.iter_data(entry)) for slot, entry in image.active_entries()}
+
+def test_dfrgfs_survives_a_crash_at_any_write(tmp_path, monkeypatch, capsys):
+    for version in (zvfs.VERSION, zvfs.VERSION_2):
+        fs = str(tmp_path / f"v{version}.zvfs")
+        zvfs.mkfs(fs, version, 8)
+        with zvfs.ZvfsImage(fs, writable=True) as image:
+            for i in range(6):
+                image.add_bytes(f"gap{i}", os.urandom(700))
+                image.add_bytes(f"f{i}", os.urandom(300 * (i + 1)), compress="zlib" if i == 2 else None)
+            image.add_bytes("big", os.urandom(5000))     # moves over its own old place
+            image.add_bytes("copy", image.read_data(image.lookup("f3")), dedup=True)
+            image.add_bytes("empty", b"")
+            for i in range(6):
+                image.remove(f"gap{i}")
+        expected = contents(fs)
+        with open(fs, "rb") as f:
+            original = f.read()
+
+        count, snapshot = crash_at_write(monkeypatch, fs, 0)    # dry run: how many writes does dfrgfs do
+        zvfs.dfrgfs(fs)
+        total = count[0]
+        assert contents(fs) == expected and total > 5
+
+        for n in range(1, total + 1):
+            with open(fs, "wb") as f:
+                f.write(original)
+            count, snapshot = crash_at_write(monkeypatch, fs, n)
+            try:
+                with zvfs.ZvfsImage(fs, writable=True) as image:
+                    image.compact()
+            except Crash:
+                pass
+            monkeypatch.undo()
+            with open(fs, "wb") as f:
+                f.write(snapshot[0])
+            assert contents(fs) == expected, (version, n)   # opening repairs the image if a commit was cut short
+            assert zvfs.fsckfs(fs) == []
+    capsys.readouterr()
+
+def test_add_is_all_or_nothing_after_a_crash(tmp_path, monkeypatch):
+    fs = make_fs(tmp_path, {"a.txt": b"a" * 100})
+    with open(fs, "rb") as f:
+        original = f.read()
+    count, snapshot = crash_at_write(monkeypatch, fs, 0)
+    with zvfs.ZvfsImage(fs, writable=True) as image:
+        image.add_bytes("b.txt", b"b" * 500)
+    monkeypatch.undo()
+    results = set()
+    for n in range(1, count[0] + 1):
+        with open(fs, "wb") as f:
+            f.write(original)
+        count, snapshot = crash_at_write(monkeypatch, fs, n)
+        try:
+            with zvfs.ZvfsImage(fs, writable=True) as image:
+                image.add_bytes("b.txt", b"b" * 500)
+        except Crash:
+            pass
+        monkeypatch.undo()
+        if snapshot:
+            with open(fs, "wb") as f:
+                f.write(snapshot[0])
+        files = contents(fs)
+        assert files in ({"a.txt": b"a" * 100}, {"a.txt": b"a" * 100, "b.txt": b"b" * 500})
+        results.add(len(files))
+    assert results == {1, 2}    # crashed before and after the commit point
+
+def fail_fsync(monkeypatch, n):
+    # the n-th os.fsync fails like a full disk
+    real_fsync = os.fsync
+    count = [0]
+    def fsync(fd):
+        count[0] += 1
+        if count[0] == n:
+            raise OSError(28, "No space left on device")
+        return real_fsync(fd)
+    monkeypatch.setattr(zvfs.os, "fsync", fsync)
+    return count
+
+def test_failed_commit_is_rolled_back(tmp_path, monkeypatch):
+    fs = make_fs(tmp_path, {"a.txt": b"a" * 100})
+    size = os.path.getsize(fs)
+    with zvfs.ZvfsImage(fs, writable=True) as image:
+        fail_fsync(monkeypatch, 1)      # the fsync of the journal record
+        try:
+            with image.batch():
+                image.add_bytes("b.txt", b"b" * 500)
+                image.add_bytes("c.txt", b"c" * 50)
+            assert False
+        except OSError:
+            pass
+        monkeypatch.undo()
+        assert image.lookup("b.txt") is None and image.lookup("c.txt") is None
+        assert os.path.getsize(fs) == size
+        with image.batch():     # the same group again works
+            image.add_bytes("b.txt", b"b" * 500)
+            image.add_bytes("c.txt", b"c" * 50)
+    assert contents(fs) == {"a.txt": b"a" * 100, "b.txt": b"b" * 500, "c.txt": b"c" * 50}
+
+    with zvfs.ZvfsImage(fs, writable=True) as image:
+        fail_fsync(monkeypatch, 2)      # after the commit point: done in place before the next commit
+        try:
+            image.remove("c.txt")
+            assert False
+        except OSError:
+            pass
+        monkeypatch.undo()
+        assert image.lookup("c.txt") is None
+        image.add_bytes("d.txt", b"d")
+    assert contents(fs) == {"a.txt": b"a" * 100, "b.txt": b"b" * 500, "d.txt": b"d"} and zvfs.fsckfs(fs) == []
+
+def test_file_data_is_never_taken_for_a_journal_record(tmp_path):
+    fs = make_fs(tmp_path, {"a.txt": b"a" * 100})
+    with zvfs.ZvfsImage(fs) as image:
+        start = image.header.next_free_offset
+    record = zvfs.pack_journal([(0, b"HACKED!!" + b"\x00" * 44)], start, 0)   # would overwrite the header and cut the image to 0
+    with zvfs.ZvfsImage(fs, writable=True) as image:
+        image.add_bytes("evil.bin", record)
+    assert os.path.getsize(fs) == start + len(record)  # complete record with a good crc at the very end
+    expected = {"a.txt": b"a" * 100, "evil.bin": record}
+    assert contents(fs) == expected
+
+    with open(fs, "r+b") as f:      # even a mark pointing at it: the record is inside committed data
+        for offset, data in zvfs.pack_journal_mark(start):
+            f.seek(offset)
+            f.write(data)
+    assert contents(fs) == expected
+    with zvfs.ZvfsImage(fs, writable=True) as image:
+        assert image.lookup("evil.bin") is not None
+    with open(fs, "rb") as f:
+        assert zvfs.journal_mark(f.read(zvfs.HEADER_SIZE)) == 0    # a writable open clears a mark without a record
+    assert contents(fs) == expected and zvfs.fsckfs(fs) == []
+
+#endregion
+
+
+#region ######################## Test read_range / preadfs #########################
+
+def test_read_range_raw_and_compressed(tmp_path, monkeypatch):
+    monkeypatch.setattr(zvfs, "CHUNK_SIZE", 1000)
+    data = bytes(range(256)) * 40
+    fs = make_fs(tmp_path, {"raw.bin": data})
+    with zvfs.ZvfsImage(fs, writable=True) as image:
+        image.add_bytes("packed.bin", data, compress="zlib")
+        assert image.lookup("packed.bin").is_compressed()
+
+    reads = []
+    real_pread = os.pread
+    monkeypatch.setattr(zvfs.os, "pread", lambda fd, n, off: reads.append(n) or real_pread(fd, n, off))
+    assert zvfs.read_range(fs, "raw.bin", 5000, 10) == data[5000:5010]
+    assert reads[-1] == 10      # only the slice is read
+    for name in ("raw.bin", "packed.bin"):
+        assert zvfs.read_range(fs, name, 0, 16) == data[:16]
+        assert zvfs.read_range(fs, name, 2500, 3000) == data[2500:5500]     # across chunks
+        assert zvfs.read_range(fs, name, -100, 1000) == data[-100:]         # tail
+        assert zvfs.read_range(fs, name, len(data) + 5, 10) == b""
+    try:
+        zvfs.read_range(fs, "missing.bin", 0, 1)
+        assert False
+    except ValueError:
+        pass
+
+#endregion
+
+
+#region ######################## Test stats / --format json #########################
+
+def test_stats_single_read_and_json(tmp_path, monkeypatch, capsys):
+    fs = make_fs(tmp_path, {"a.txt": b"a" * 100, "b.txt": b"b" * 10})
+    zvfs.rmfs(fs, "b.txt")
+    zvfs._stats_cache.clear()
+
+    reads = []
+    real_pread = os.pread
+    monkeypatch.setattr(zvfs.os, "pread", lambda fd, n, off: reads.append((n, off)) or real_pread(fd, n, off))
+    result = zvfs.stats(fs)
+    assert reads == [(zvfs.DATA_START, 0)]     # ONE read of header and table, the journal mark is in the header
+    assert result["files_present"] == 1 and result["deleted_files"] == 1
+    assert result["files"][0]["name"] == "a.txt" and result["files"][0]["size"] == 100
+    assert zvfs.stats(fs) is result and len(reads) == 1    # unchanged image -> cached
+
+    capsys.readouterr()
+    zvfs.lsfs(fs, "json")
+    assert json.loads(capsys.readouterr().out)["files"][0]["name"] == "a.txt"
+    zvfs.gifs(str(tmp_path / "missing.zvfs"), "json")
+    assert "error" in json.loads(capsys.readouterr().out)
+
+
+def test_stats_many_in_process_pool(tmp_path):
+    images = []
+    for i in range(3):
+        fs = str(tmp_path / f"img{i}.zvfs")
+        zvfs.mkfs(fs, version=zvfs.VERSION_2 if i == 2 else zvfs.VERSION)
+        with zvfs.ZvfsImage(fs, writable=True) as image:
+            for j in range(i):
+                image.add_bytes(f"f{j}", b"x" * 70)
+        images.append(fs)
+    zvfs._stats_cache.clear()
+    results = zvfs.stats_many(images + [str(tmp_path / "nope.zvfs")], workers=2)
+    assert [r.get("files_present") for r in results] == [0, 1, 2, None]
+    assert "error" in results[3]
+    assert zvfs.stats_many(images[:1])[0] is results[0]    # results of the workers are cached too
+
+def test_truncated_images_are_errors(tmp_path, capsys):
+    v1 = make_fs(tmp_path, {"a.txt": b"a" * 100})
+    v2 = str(tmp_path / "v2.zvfs")
+    zvfs.mkfs(v2, zvfs.VERSION_2, 8)
+    with zvfs.ZvfsImage(v2, writable=True) as image:
+        image.add_bytes("a.txt", b"a")
+    broken = []
+    for name, data in (("empty", b""), ("short", b"\x01" * 10), ("v1", open(v1, "rb").read()[:100]), ("v2", open(v2, "rb").read()[:zvfs.HEADER_SIZE])):
+        (tmp_path / name).write_bytes(data)
+        broken.append(str(tmp_path / name))
+    try:
+        zvfs.ZvfsImage(broken[0])
+        assert False
+    except ValueError as e:
+        assert "too short" in str(e)
+    results = zvfs.stats_many(broken, workers=2)
+    assert all("not a valid .zvfs filesystem" in r["error"] for r in results)
+    capsys.readouterr()
+    for fs in broken:
+        zvfs.lsfs(fs)
+        zvfs.gifs(fs)
+        assert capsys.readouterr().out.count("Error:") == 2
+
+#endregion
+
+
+#region ######################## Test bulk table decoding #########################
+
+def test_decode_entries_matches_unpack(tmp_path):
+    fs = make_fs(tmp_path, {"a.txt": b"a" * 100, "é.txt": b"b" * 10})
+    with zvfs.ZvfsImage(fs) as image:
+        raw = image.raw_table
+    decoded = zvfs.decode_entries(raw)
+    assert len(decoded) == zvfs.FILE_CAPACITY
+    for slot, entry in enumerate(decoded):
+        single = zvfs.FileEntry().unpack(raw[slot * zvfs.ENTRY_SIZE:(slot + 1) * zvfs.ENTRY_SIZE])
+        assert vars(entry) == vars(single)
+    assert decoded[1].name == "é.txt"
+
+
+def test_table_summary_with_and_without_numpy(tmp_path, monkeypatch):
+    fs = str(tmp_path / "test.zvfs")
+    zvfs.mkfs(fs, version=zvfs.VERSION_2)
+    with zvfs.ZvfsImage(fs, writable=True) as image:
+        for i in range(300):    # more than one table block
+            image.add_bytes(f"f{i}", b"x" * (i % 7), dedup=True)
+        for i in range(0, 300, 3):
+            image.remove(f"f{i}")
+    with zvfs.ZvfsImage(fs) as image:
+        expected = {
+            "active": [slot for slot, entry in enumerate(image.entries) if entry.flag == 0 and entry.name],
+            "deleted": len(image.deleted_slots),
+            "empty": len(image.empty_slots),
+            "total_size": sum({entry.start: entry.length for entry in image.entries if entry.length}.values()),
+        }
+        assert zvfs.table_summary(image.raw_table) == expected
+        monkeypatch.setattr(zvfs, "numpy", None)
+        assert zvfs.table_summary(image.raw_table) == expected
+
+def test_heavy_modules_are_imported_on_first_use():
+    code = ("import sys, zvfs; print(' '.join(m for m in ('lzma', 'tempfile', 'threading', 'ctypes', 'numpy', "
+            "'concurrent.futures', 'multiprocessing') if m in sys.modules))")
+    result = subprocess.run([sys.executable, "-c", code], cwd=os.path.dirname(zvfs.__file__), capture_output=True, text=True)
+    assert result.returncode == 0 and result.stdout.split() == []
+
+#endregion
+
+
+#region ######################## Test bench_zvfs #########################
+
+def test_bench_runs_every_command(tmp_path):
+    report = bench_zvfs.run(files=6, sizes="uniform:0:3000", delete=0.5, repeat=2, version=zvfs.VERSION_2,
+                            work_dir=str(tmp_path))
+    results = report["results"]
+    assert set(results) == {"mkfs", "addfs", "catfs", "getfs", "rmfs", "lsfs", "gifs", "dfrgfs"}
+    assert results["addfs"]["ops"] == 6 and results["rmfs"]["ops"] == 3
+    assert results["addfs"]["fsyncs"] >= 6 and results["dfrgfs"]["bytes_freed"] > 0
+    assert all(0 <= result["peak_rss_growth_kb"] <= result["peak_rss_kb"] for result in results.values())
+    assert os.listdir(tmp_path) == []   # temporary files are removed
+
+    slower = dict(results, lsfs=dict(results["lsfs"], ops_per_sec=results["lsfs"]["ops_per_sec"] / 2))
+    assert [name for name, old, new in bench_zvfs.compare(report, dict(report, results=slower))] == ["lsfs"]
+
+#endregion
+
+
+#region ######################## Test sparse files / hole punching #########################
+
+def test_mkfs_and_padding_without_zero_writes(tmp_path, monkeypatch):
+    writes = []
+    real_pwrite = os.pwrite
+    def pwrite(fd, data, off):
+        if off not in zvfs.JOURNAL_MARK_OFFSETS:    # the 2-byte journal mark fields of the header are not padding
+            writes.append(data)
+        return real_pwrite(fd, data, off)
+    monkeypatch.setattr(zvfs.os, "pwrite", pwrite)
+    fs = str(tmp_path / "test.zvfs")
+    zvfs.mkfs(fs)
+    with open(fs, "rb") as f:
+        image_bytes = f.read()
+    assert len(image_bytes) == zvfs.DATA_START and image_bytes[zvfs.HEADER_SIZE:] == b"\x00" * (zvfs.DATA_START - zvfs.HEADER_SIZE)
+
+    with zvfs.ZvfsImage(fs, writable=True) as image:
+        image.add_bytes("a.txt", b"a" * 10)
+    assert not any(data and data.count(0) == len(data) for data in writes)  # no block of only zeros was written
+    with open(fs, "rb") as f:
+        assert f.read()[zvfs.DATA_START:] == b"a" * 10 + b"\x00" * 54
+
+
+def test_rmfs_punch_gives_space_back(tmp_path, capsys):
+    fs = make_fs(tmp_path, {"big.bin": b"\xff" * (1 << 20), "small.txt": b"s" * 10})
+    blocks_before = os.stat(fs).st_blocks
+    zvfs.rmfs(fs, "big.bin", punch=True)
+    with zvfs.ZvfsImage(fs) as image:
+        assert image.find("big.bin", include_deleted=True) is None     # nothing left to recover
+        assert len(image.empty_slots) == zvfs.FILE_CAPACITY - 1
+        assert image.read_data(image.lookup("small.txt")) == b"s" * 10
+    with open(fs, "rb") as f:
+        assert f.read(zvfs.DATA_START + (1 << 20))[zvfs.DATA_START:] == b"\x00" * (1 << 20)
+    if zvfs.load_fallocate() is not None:
+        assert os.stat(fs).st_blocks < blocks_before
+
+    zvfs.rmfs(fs, "small.txt")      # without --punch the file can still be recovered
+    with zvfs.ZvfsImage(fs) as image:
+        assert image.read_data(image.find("small.txt", include_deleted=True)) == b"s" * 10
+
+
+def test_punch_waits_for_the_commit(tmp_path, monkeypatch):
+    fs = make_fs(tmp_path, {"a.txt": b"a" * 100})
+    punched = []
+    monkeypatch.setattr(zvfs, "punch_hole", lambda fd, offset, length: punched.append((offset, length)))
+    with zvfs.ZvfsImage(fs, writable=True) as image:
+        try:
+            with image.batch():
+                image.remove("a.txt", punch=True)
+                assert punched == []
+                raise ValueError("rollback")
+        except ValueError:
+            pass
+        assert punched == [] and image.lookup("a.txt") is not None
+        image.remove("a.txt", punch=True)
+    assert punched == [(zvfs.DATA_START, 128)]
+
+
+def test_punch_reaps_older_deleted_files_once(tmp_path):
+    fs = str(tmp_path / "test.zvfs")
+    zvfs.mkfs(fs)
+    with zvfs.ZvfsImage(fs, writable=True) as image:
+        image.add_bytes("a.txt", b"x" * 1000, dedup=True)
+        image.add_bytes("b.txt", b"x" * 1000, dedup=True)     # same data as a.txt
+        image.remove("a.txt")
+        image.remove("b.txt", punch=True)       # the deleted a.txt loses its data too
+        assert image.empty_slots == list(range(zvfs.FILE_CAPACITY))
+        image.add_bytes("c.txt", b"c")
+        image.add_bytes("d.txt", b"d")
+    with zvfs.ZvfsImage(fs) as image:
+        assert image.index == {"c.txt": 0, "d.txt": 1}
+
+#endregion
+
+
+#region ######################## Test FUSE adapter #########################
+
+def test_fuse_adapter_reads_in_place(tmp_path, monkeypatch):
+    data = bytes(range(256)) * 100
+    fs = make_fs(tmp_path, {"raw.bin": data})
+    with zvfs.ZvfsImage(fs, writable=True) as image:
+        image.add_bytes("packed.bin", data, compress="zlib")
+        image.add_bytes("gone.txt", b"x")
+        image.remove("gone.txt")
+
+    ops = zvfs_fuse.ZvfsFuse(fs)
+    try:
+        assert sorted(ops.readdir("/", None)) == [".", "..", "packed.bin", "raw.bin"]
+        assert ops.getattr("/raw.bin")["st_size"] == len(data)
+        assert ops.getattr("/packed.bin")["st_size"] == len(data)
+        assert ops.getattr("/")["st_mode"] & zvfs_fuse.stat.S_IFDIR
+        for path in ("/gone.txt", "/raw.bin/x"):
+            try:
+                ops.getattr(path)
+                assert False
+            except zvfs_fuse.FuseOSError as e:
+                assert e.errno == zvfs_fuse.errno.ENOENT
+
+        reads = []
+        real_pread = os.pread
+        monkeypatch.setattr(zvfs.os, "pread", lambda fd, n, off: reads.append(n) or real_pread(fd, n, off))
+        for name in ("raw.bin", "packed.bin"):
+            fh = ops.open("/" + name, os.O_RDONLY)
+            assert ops.read("/" + name, 4096, 1000, fh) == data[1000:5096]
+            assert ops.read("/" + name, 4096, len(data) - 10, fh) == data[-10:]
+            assert ops("read", "/" + name, 10, len(data) + 5, fh) == b""
+            ops.release("/" + name, fh)
+        assert reads[:2] == [4096, 10]      # raw file: one pread of the requested bytes per read()
+
+        try:
+            ops.open("/raw.bin", os.O_WRONLY)
+            assert False
+        except zvfs_fuse.FuseOSError as e:
+            assert e.errno == zvfs_fuse.errno.EROFS
+        try:
+            ops.unlink("/raw.bin")
+            assert False
+        except zvfs_fuse.FuseOSError as e:
+            assert e.errno == zvfs_fuse.errno.EROFS
+    finally:
+        ops.close()
+
+#endregion
+
+
+#region ######################## Test exportfs / importfs #########################
+
+def export_bytes(fs, since=0):
+    out = io.BytesIO()
+    zvfs.exportfs(fs, out, since)
+    return out.getvalue()
+
+
+def test_export_import_roundtrip(tmp_path, capsys):
+    fs = make_fs(tmp_path, {"a.txt": b"a" * 1000, "b.txt": b"b" * 10, "empty.txt": b""})
+    with zvfs.ZvfsImage(fs, writable=True) as image:
+        image.add_bytes("packed.txt", b"log line\n" * 500, compress="zlib")
+        image.add_bytes("copy.txt", b"a" * 1000, dedup=True)
+        image.remove("b.txt")
+    stream = export_bytes(fs)
+    assert len(stream) < 2500       # no table, deleted file, padding or second copy of the shared data
+
+    restored = str(tmp_path / "restored.zvfs")
+    zvfs.importfs(restored, io.BytesIO(stream))
+    assert contents(restored) == contents(fs)
+    with zvfs.ZvfsImage(restored) as image, zvfs.ZvfsImage(fs) as original:
+        assert image.lookup("packed.txt").is_compressed()
+        assert image.lookup("copy.txt").start == image.lookup("a.txt").start
+        assert image.lookup("a.txt").created == original.lookup("a.txt").created
+        assert image.deleted_slots == [] and image.verify()[1] == []
+
+
+def test_incremental_export(tmp_path, capsys):
+    fs = make_fs(tmp_path, {"old.txt": b"o" * 100, "gone.txt": b"g" * 100})
+    with zvfs.ZvfsImage(fs, writable=True) as image:
+        for slot, entry in image.active_entries():     # make them older than the incremental export
+            entry.created = 1000
+            image._write_entry(slot)
+    backup = str(tmp_path / "backup.zvfs")
+    zvfs.importfs(backup, io.BytesIO(export_bytes(fs)))
+
+    with zvfs.ZvfsImage(fs, writable=True) as image:
+        image.remove("gone.txt")
+        image.add_bytes("new.txt", b"n" * 100, created_ts=2000)
+    stream = export_bytes(fs, since=2000)
+    assert b"o" * 100 not in stream and b"n" * 100 in stream
+    zvfs.importfs(backup, io.BytesIO(stream), replace=True)
+    assert contents(backup) == contents(fs) == {"old.txt": b"o" * 100, "new.txt": b"n" * 100}
+
+    empty = str(tmp_path / "empty.zvfs")     # an incremental stream needs the files of the previous export
+    zvfs.mkfs(empty)
+    zvfs.importfs(empty, io.BytesIO(stream))
+    assert "not in the filesystem" in capsys.readouterr().out and contents(empty) == {}
+
+    cut = str(tmp_path / "cut.zvfs")         # incomplete stream -> nothing imported, no image left behind
+    zvfs.importfs(cut, io.BytesIO(export_bytes(fs)[:-10]))
+    assert "incomplete" in capsys.readouterr().out and not os.path.exists(cut)
+
+def test_import_into_existing_image_only_replaces_when_asked(tmp_path, capsys):
+    fs = make_fs(tmp_path, {"a.txt": b"a" * 100, "b.txt": b"b" * 10})
+    stream = export_bytes(fs)
+    other = str(tmp_path / "other.zvfs")
+    zvfs.mkfs(other)
+    with zvfs.ZvfsImage(other, writable=True) as image:
+        image.add_bytes("mine.txt", b"m")
+    zvfs.importfs(other, io.BytesIO(stream))       # merged, nothing removed
+    assert contents(other) == {"mine.txt": b"m", "a.txt": b"a" * 100, "b.txt": b"b" * 10}
+
+    with zvfs.ZvfsImage(other, writable=True) as image:
+        image.remove("b.txt")
+        image.add_bytes("b.txt", b"changed")
+    zvfs.importfs(other, io.BytesIO(stream))       # a name that is already there -> nothing imported
+    assert "already exists" in capsys.readouterr().out
+    assert contents(other) == {"mine.txt": b"m", "a.txt": b"a" * 100, "b.txt": b"changed"}
+
+    zvfs.importfs(other, io.BytesIO(stream), replace=True)
+    assert "removed 1 file(s)" in capsys.readouterr().out
+    assert contents(other) == contents(fs)
+
+#endregion
+
+
+#region ######################## Test log-structured ingest #########################
+
+def count_fsyncs(monkeypatch):
+    fsyncs = []
+    real_fsync = os.fsync
+    monkeypatch.setattr(zvfs.os, "fsync", lambda fd: fsyncs.append(fd) or real_fsync(fd))
+    return fsyncs
+
+
+def test_ingest_fsync_policies(tmp_path, monkeypatch):
+    for policy, expected in (("always", 2 * 20), ("interval", 2), ("never", 0)):
+        fs = make_fs(tmp_path, {"old.txt": b"o" * 1000})
+        zvfs.rmfs(fs, "old.txt")    # a hole the ingest doesn't fill
+        fsyncs = count_fsyncs(monkeypatch)
+        with zvfs.IngestWriter(fs, fsync=policy, interval=60, flush_bytes=1 << 20) as writer:
+            for i in range(20):
+                writer.add(f"f{i}", b"x" * 100)
+        monkeypatch.undo()
+        assert len(fsyncs) == expected, policy
+        with zvfs.ZvfsImage(fs) as image:
+            starts = [image.lookup(f"f{i}").start for i in range(20)]
+            assert starts == sorted(starts) and starts[0] >= zvfs.DATA_START + 1024    # appended one after the other
+            assert all(image.read_data(image.lookup(f"f{i}")) == b"x" * 100 for i in range(20))
+        os.remove(fs)
+
+
+def test_ingest_flushes_on_bytes_and_interval(tmp_path):
+    fs = make_fs(tmp_path, {})
+    with zvfs.IngestWriter(fs, interval=60, flush_bytes=1000) as writer:
+        for i in range(10):
+            writer.add(f"f{i}", b"x" * 300)
+        assert writer.flushes == 2 and writer.pending_files == 2    # after 1000 bytes: 4th and 8th file
+
+    with zvfs.IngestWriter(fs, interval=0.05) as writer:
+        writer.add("late.txt", b"l")
+        for _ in range(100):    # the background thread commits it without another add
+            if writer.flushes:
+                break
+            time.sleep(0.01)
+        assert writer.flushes == 1 and writer.pending_files == 0
+
+
+def test_ingest_bad_file_keeps_the_others(tmp_path, capsys, monkeypatch):
+    fs = make_fs(tmp_path, {})
+    with zvfs.IngestWriter(fs, interval=60) as writer:
+        writer.add("a.txt", b"a")
+        try:
+            writer.add("a.txt", b"again")
+            assert False
+        except ValueError:
+            pass
+        writer.add("b.txt", b"b")
+    assert contents(fs) == {"a.txt": b"a", "b.txt": b"b"}
+
+    paths = []
+    for name in ("c.txt", "d.txt"):
+        path = tmp_path / name
+        path.write_bytes(name.encode())
+        paths.append(str(path))
+    monkeypatch.setattr(zvfs.sys, "stdin", io.StringIO("\n".join(paths + [str(tmp_path / "missing.txt")]) + "\n"))
+    zvfs.ingestfs(fs, [])
+    out = capsys.readouterr().out
+    assert "missing.txt" in out and "Ingested 2 file(s)" in out
+    assert contents(fs)["d.txt"] == b"d.txt"
+
+#endregion
+
+
+#region ######################## Test version 1 slot map #########################
+
+def test_slot_map_lookup_decodes_only_candidates(tmp_path, monkeypatch):
+    fs = make_fs(tmp_path, {f"f{i}.txt": str(i).encode() for i in range(20)})
+    zvfs.rmfs(fs, "f3.txt")
+    with zvfs.ZvfsImage(fs) as image:
+        header = image.header
+        active, used, fingerprints = zvfs.read_slot_map(header)
+        assert active == sum(1 << slot for slot, entry in image.active_entries())
+        assert used == (1 << 20) - 1
+        assert header.reserved2 == zvfs.pack_slot_map(header, image.entries)
+
+    unpacked = []
+    real_unpack = zvfs.FileEntry.unpack
+    monkeypatch.setattr(zvfs.FileEntry, "unpack", lambda self, data: unpacked.append(1) or real_unpack(self, data))
+    with zvfs.ZvfsImage(fs, load_table=False) as image:
+        assert image.entries is None
+        assert image.lookup("f7.txt").name == "f7.txt"
+        assert image.lookup("f3.txt") is None and image.lookup("nope.txt") is None
+    assert len(unpacked) < 10       # not all 20 slots
+    assert zvfs.read_range(fs, "f12.txt", 0, 10) == b"12"
+
+
+def test_stale_slot_map_is_ignored(tmp_path, capsys):
+    fs = make_fs(tmp_path, {"a.txt": b"a"})
+    with open(fs, "r+b") as f:     # what the Java implementation does on addfs: entry + header, reserved2 kept as it is
+        header = zvfs.Header().unpack(f.read(zvfs.HEADER_SIZE))
+        entry = zvfs.FileEntry("java.txt", start=zvfs.DATA_START + 64, length=4)
+        f.seek(zvfs.HEADER_SIZE + zvfs.ENTRY_SIZE)
+        f.write(entry.pack())
+        f.seek(zvfs.DATA_START + 64)
+        f.write(b"java")
+        header.file_count += 1
+        header.next_free_offset = zvfs.DATA_START + 128
+        f.seek(0)
+        f.write(header.pack())
+    with zvfs.ZvfsImage(fs, load_table=False) as image:
+        assert zvfs.read_slot_map(image.header) is None
+        assert image.entries is not None       # the whole table was read instead
+        assert image.lookup("java.txt").length == 4
+    zvfs.rmfs(fs, "a.txt")      # the next change writes an up to date map again
+    with open(fs, "rb") as f:
+        assert zvfs.read_slot_map(zvfs.Header().unpack(f.read(zvfs.HEADER_SIZE))) is not None
+    assert zvfs.read_range(fs, "java.txt", 0, 4) == b"java"
+
+#endregion
+
+
+#region ######################## Test AsyncZvfs #########################
+
+def test_async_operations(tmp_path):
+    fs = make_fs(tmp_path, {"a.txt": b"a" * 100})
+
+    async def main():
+        async with zvfs_async.AsyncZvfs(fs, lock_timeout=0) as afs:
+            # lock_timeout=0: two writes at the same time would fail on the flock if they weren't serialized
+            entries = await asyncio.gather(*(afs.add(f"f{i}", str(i).encode() * 50, compress="zlib") for i in range(8)))
+            assert [entry.name for entry in entries] == [f"f{i}" for i in range(8)]
+            assert await afs.read("f3") == b"3" * 50
+            assert await afs.read_range("a.txt", -10, 100) == b"a" * 10
+            await afs.remove("a.txt")
+            assert [entry.name for entry in await afs.list()] == [f"f{i}" for i in range(8)]
+            assert [entry.name for entry in await afs.list("f[0-2]")] == ["f0", "f1", "f2"]
+            assert (await afs.stats())["files_present"] == 8
+            try:
+                await afs.read("a.txt")
+                assert False
+            except ValueError:
+                pass
+
+    asyncio.run(main())
+
+
+def test_async_slow_fsync_doesnt_block(tmp_path, monkeypatch):
+    slow = make_fs(tmp_path, {})
+    other = str(tmp_path / "other.zvfs")
+    zvfs.mkfs(other)
+    with zvfs.ZvfsImage(other, writable=True) as image:
+        image.add_bytes("b.txt", b"b")
+
+    release = threading.Event()
+    real_fsync = os.fsync
+    def stuck_fsync(fd):    # fsync of the slow image hangs until the test lets it go
+        if os.path.samefile(os.readlink(f"/proc/self/fd/{fd}"), slow):
+            release.wait(5)
+        return real_fsync(fd)
+    monkeypatch.setattr(zvfs.os, "fsync", stuck_fsync)
+
+    async def main():
+        executor = zvfs_async.ThreadPoolExecutor(max_workers=4)
+        slow_fs = zvfs_async.AsyncZvfs(slow, executor=executor)
+        other_fs = zvfs_async.AsyncZvfs(other, executor=executor)
+        add = asyncio.create_task(slow_fs.add("a.txt", b"a"))
+        await asyncio.sleep(0.05)
+        assert not add.done()
+        # the event loop and the other image go on while the fsync hangs
+        assert await asyncio.wait_for(other_fs.read("b.txt"), 2) == b"b"
+        release.set()
+        assert (await add).name == "a.txt"
+        executor.shutdown()
+
+    asyncio.run(main())
+
+#endregion
+#region ######################## Test directories / long paths #########################
+
+def test_path_trie_lists_directories_and_patterns():
+    trie = zvfs.PathTrie({"a.txt": 0, "photos/x.jpg": 1, "photos/2024/y.jpg": 2, "photos/2024/z.png": 3, "docs/x.txt": 4})
+    assert trie.select("/") == (["docs/", "photos/"], [("a.txt", 0)])
+    assert trie.select("photos/") == (["photos/2024/"], [("photos/x.jpg", 1)])
+    assert trie.select("photos/2024/y.jpg") == ([], [("photos/2024/y.jpg", 2)])
+    assert trie.select("nothing") == ([], [])
+    assert trie.select("photos/*/*.jpg") == ([], [("photos/2024/y.jpg", 2)])
+    assert trie.select("**/x.*") == ([], [("docs/x.txt", 4), ("photos/x.jpg", 1)])
+    assert [name for name, slot in trie.glob("photos/**")] == ["photos/2024/y.jpg", "photos/2024/z.png", "photos/x.jpg"]
+    trie.remove("docs/x.txt")       # last file -> directory is gone too
+    trie.remove("photos/2024/y.jpg")
+    assert trie.select("") == (["photos/"], [("a.txt", 0)])
+    assert trie.node("photos/2024").files == {"z.png": 3}
+
+
+def test_long_paths_use_name_slots(tmp_path):
+    fs = str(tmp_path / "v2.zvfs")
+    zvfs.mkfs(fs, zvfs.VERSION_2, 4)
+    long_name = "projects/" + "ü" * 40 + "/notes/readme.txt"     # 106 bytes in UTF-8
+    with zvfs.ZvfsImage(fs, writable=True) as image:
+        image.add_bytes("short.txt", b"s")
+        slot, entry = image.add_bytes(long_name, b"long")
+        assert len(image._name_slots[slot]) == 3 and image.lookup(long_name) is entry
+        try:
+            image.add_bytes("x" * 256, b"")
+            assert False
+        except ValueError:
+            pass
+
+    with zvfs.ZvfsImage(fs) as image:
+        assert [entry.name for slot, entry in image.active_entries()] == ["short.txt", long_name]
+        raw_name = image.raw_table[slot * zvfs.ENTRY_SIZE:slot * zvfs.ENTRY_SIZE + 32]
+        assert long_name.encode().startswith(raw_name.rstrip(b"\x00")) and raw_name[-1] == 0    # first part in the entry
+        assert image.header.file_capacity > 4 and len(image.empty_slots) == image.header.file_capacity - 5
+        assert zvfs.stats(fs)["files_present"] == 2
+    with zvfs.ZvfsImage(fs, load_table=False) as image:    # through the hash index
+        assert image.read_data(image.lookup(long_name)) == b"long"
+
+    with zvfs.ZvfsImage(fs, writable=True) as image:
+        image.remove(long_name)
+    with zvfs.ZvfsImage(fs, writable=True) as image:
+        assert image.read_data(image.find(long_name, include_deleted=True)) == b"long"    # still recoverable
+        image.compact()
+        assert len(image.empty_slots) == image.header.file_capacity - 1
+
+
+def test_names_are_checked_for_version_and_clashes(tmp_path, monkeypatch, capsys):
+    fs = make_fs(tmp_path, {"a": b"a"})
+    with zvfs.ZvfsImage(fs, writable=True) as image:
+        # version 1: max 31 bytes, "a" is already a file, only clean relative paths
+        for name in ("n" * 32, "", "a/b.txt", "/abs", "x//y", "../up", "d/../e", ".", "dir/"):
+            try:
+                image.add_bytes(name, b"x")
+                assert False, name
+            except ValueError:
+                pass
+        image.add_bytes("dir/b.txt", b"b")
+        try:
+            image.add_bytes("dir", b"x")
+            assert False
+        except ValueError as e:
+            assert "dir/b.txt" in str(e)
+        image.remove("a")
+        image.add_bytes("a/b.txt", b"ab")
+    with zvfs.ZvfsImage(fs) as image:
+        assert sorted(image.index) == ["a/b.txt", "dir/b.txt"]
+
+    add_foreign(monkeypatch, fs, "../up", b"u")
+    stream = export_bytes(fs)
+    dst = str(tmp_path / "dst.zvfs")
+    zvfs.mkfs(dst)
+    with zvfs.ZvfsImage(dst, writable=True) as image:
+        try:
+            image.import_stream(io.BytesIO(stream))
+            assert False
+        except ValueError as e:
+            assert "'../up'" in str(e)
+    assert contents(dst) == {}
+
+
+def test_long_host_file_names_follow_the_version(tmp_path, capsys):
+    host = tmp_path / ("h" * 40 + ".txt")
+    host.write_bytes(b"long")
+    v1 = make_fs(tmp_path, {})
+    zvfs.addfs(v1, str(host))
+    assert "too long" in capsys.readouterr().out and contents(v1) == {}
+    v2 = str(tmp_path / "v2.zvfs")
+    zvfs.mkfs(v2, zvfs.VERSION_2, 8)
+    zvfs.addfs(v2, str(host))
+    server = zvfs_server.ZvfsServer(v2)
+    assert server.run_one("rm", {"name": host.name})["ok"]
+    assert server.run_one("add", {"path": str(host)})["ok"]
+    assert server.run_one("rm", {"name": host.name})["ok"]
+    server.close()
+    with zvfs.IngestWriter(v2) as writer:
+        writer.add_file(str(host))
+    assert contents(v2) == {host.name: b"long"}
+    capsys.readouterr()
+
+
+def make_tree(root, files):     # host directory tree from {relative path: bytes}
+    for name, data in files.items():
+        path = root / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(data)
+    return root
+
+
+def test_addfs_directory_tree(tmp_path, monkeypatch, capsys):
+    fs = str(tmp_path / "v2.zvfs")
+    zvfs.mkfs(fs, zvfs.VERSION_2)
+    tree = make_tree(tmp_path / "photos", {"a.jpg": b"a" * 100, "2024/summer/b.jpg": b"b" * 10,
+                                           "2024/c.png": b"c", "very_long_directory_name/" * 3 + "d.jpg": b"d"})
+    (tmp_path / "photos" / "empty").mkdir()
+    fsyncs = count_fsyncs(monkeypatch)
+    zvfs.addfs(fs, str(tree))
+    assert len(fsyncs) == 2         # one transaction for the whole tree
+    expected = {"photos/a.jpg": b"a" * 100, "photos/2024/summer/b.jpg": b"b" * 10, "photos/2024/c.png": b"c",
+                "photos/" + "very_long_directory_name/" * 3 + "d.jpg": b"d"}
+    assert contents(fs) == expected
+    assert "Added 4 file(s)" in capsys.readouterr().out
+
+    zvfs.lsfs(fs, path="photos/2024")
+    out = capsys.readouterr().out
+    assert "photos/2024/summer/" in out and "photos/2024/c.png" in out and "photos/a.jpg" not in out
+    zvfs.lsfs(fs, "json", "photos/**/*.jpg")
+    listed = json.loads(capsys.readouterr().out)
+    assert [file["name"] for file in listed["files"]] == sorted(name for name in expected if name.endswith(".jpg"))
+    zvfs.lsfs(fs, path="nothing/*")
+    assert "No files found for 'nothing/*'." in capsys.readouterr().out
+
+    os.makedirs(tmp_path / "out")
+    monkeypatch.chdir(tmp_path / "out")
+    zvfs.getfs(fs, "photos/2024/summer/b.jpg")
+    assert (tmp_path / "out" / "photos" / "2024" / "summer" / "b.jpg").read_bytes() == b"b" * 10
+    assert zvfs.getfs_all(fs, str(tmp_path / "restore")) == 4
+    assert (tmp_path / "restore" / "photos" / "2024" / "c.png").read_bytes() == b"c"
+
+
+def test_addfs_tree_is_all_or_nothing(tmp_path, capsys):
+    fs = make_fs(tmp_path, {})      # version 1: the long path doesn't fit
+    tree = make_tree(tmp_path / "docs", {"a.txt": b"a", "sub/" * 8 + "b.txt": b"b"})
+    zvfs.addfs(fs, str(tree))
+    assert "Nothing was added." in capsys.readouterr().out
+    assert contents(fs) == {}
+
+
+def test_export_import_long_paths(tmp_path, capsys):
+    src = str(tmp_path / "src.zvfs")
+    zvfs.mkfs(src, zvfs.VERSION_2, 8)
+    long_name = "a/" + "b" * 60 + "/c.txt"
+    with zvfs.ZvfsImage(src, writable=True) as image:
+        image.add_bytes(long_name, b"c" * 100)
+        image.add_bytes("d/e.txt", b"e")
+    dst = str(tmp_path / "dst.zvfs")
+    zvfs.mkfs(dst, zvfs.VERSION_2, 8)
+    with zvfs.ZvfsImage(dst, writable=True) as image:
+        image.add_bytes("d", b"a file where the stream has a directory")
+    zvfs.importfs(dst, io.BytesIO(export_bytes(src)))
+    assert "clashes" in capsys.readouterr().out     # without --replace the file "d" stays
+    zvfs.importfs(dst, io.BytesIO(export_bytes(src)), replace=True)
+    assert contents(dst) == {long_name: b"c" * 100, "d/e.txt": b"e"}
+
+
+def test_daemon_lists_a_directory_from_its_tree(tmp_path):
+    fs = str(tmp_path / "v2.zvfs")
+    zvfs.mkfs(fs, zvfs.VERSION_2, 8)
+    with zvfs.ZvfsImage(fs, writable=True) as image:
+        for name in ("top.txt", "docs/a.txt", "docs/2024/" + "r" * 40 + ".txt", "docs/b.md"):
+            image.add_bytes(name, b"x")
+    server = zvfs_server.ZvfsServer(fs)
+    listing = server.run_one("ls", {"path": "docs"})
+    assert listing["dirs"] == ["docs/2024/"] and [f["name"] for f in listing["files"]] == ["docs/a.txt", "docs/b.md"]
+    trie = server.image.paths()
+    assert [f["name"] for f in server.run_one("ls", {"path": "**/*.txt"})["files"]] == ["docs/2024/" + "r" * 40 + ".txt", "docs/a.txt", "top.txt"]
+    assert server.image.paths() is trie     # kept between requests, not built again
+    assert server.run_one("add", {"path": str(make_tree(tmp_path / "host", {"c.txt": b"c"}) / "c.txt")})["ok"]
+    assert [f["name"] for f in server.run_one("ls", {"path": "/"})["files"]] == ["c.txt", "top.txt"]
+    assert not server.run_one("ls", {"path": 3})["ok"]
+    server.close()
+
+def test_fuse_adapter_shows_directories(tmp_path, monkeypatch):
+    fs = str(tmp_path / "v2.zvfs")
+    zvfs.mkfs(fs, zvfs.VERSION_2, 8)
+    with zvfs.ZvfsImage(fs, writable=True) as image:
+        image.add_bytes("top.txt", b"t")
+        image.add_bytes("docs/2024/" + "r" * 40 + ".txt", b"report")
+    add_foreign(monkeypatch, fs, "../evil.txt", b"x")   # not a path in the tree, left out
+    ops = zvfs_fuse.ZvfsFuse(fs)
+    try:
+        assert sorted(ops.readdir("/", None)) == [".", "..", "docs", "top.txt"]
+        assert ops.readdir("/docs/2024", None) == [".", "..", "r" * 40 + ".txt"]
+        assert ops.getattr("/docs")["st_mode"] & zvfs_fuse.stat.S_IFDIR
+        path = "/docs/2024/" + "r" * 40 + ".txt"
+        assert ops.read(path, 100, 0, ops.open(path, os.O_RDONLY)) == b"report"
+    finally:
+        ops.close()
+
+#endregion
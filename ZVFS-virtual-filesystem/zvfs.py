@@ -4,7 +4,25 @@ import struct  # we need struct to pack/unpack binary formats exactly
 import os      # for file and filesystem operations like exists, replace, fsync
 import sys     # for command-line argument parsing in the __main__ block
 import time    # for timestamps (created field)
+import mmap    # for the zero-copy read path of catfs/getfs
+import codecs  # incremental utf-8 decoder so catfs can print big files chunk by chunk
+from contextlib import contextmanager   # for ZvfsImage.batch()
+import bisect  # keeps the free-extent map and the free-slot lists sorted
+import array   # bucket array of the version 2 hash index
+import zlib    # crc32 as hash function for the version 2 hash index and as checksum of file data
+import json    # --format json output of lsfs/gifs/stats
+import fnmatch # glob patterns of lsfs
 from pathlib import Path    # Path makes path operations easier and portable
+# imported only where they are needed, so a command that doesn't use them doesn't pay for loading them:
+# concurrent.futures (fsckfs, getfs --all, stats of many images), threading (ingestfs), lzma (second codec),
+# tempfile (compressed adds), ctypes (hole punching, see load_fallocate) and numpy (see load_numpy)
+try:
+    import fcntl   # flock() for reader/writer locking of an image (Unix only)
+except ImportError:
+    fcntl = None   # no locking available (e.g. Windows), everything else still works
+_fallocate = False  # fallocate() from libc to punch holes into an image (Linux only), False = not loaded yet
+numpy = False       # optional: the file table as a structured array, so gifs/lsfs/stats filter and sum without a
+                    # python loop, False = not imported yet, None = not installed (struct.iter_unpack is used instead)
 
 
 """
@@ -23,6 +41,38 @@ FILE_CAPACITY = 32                      # exactly 32 file entry slots
 ENTRY_SIZE = 64                         # each file entry fixed 64 bytes
 DATA_START = HEADER_SIZE + FILE_CAPACITY * ENTRY_SIZE  # 64 + 32*64 = 2112
 MAX_OFFSET = 2**32                      # 4 GB limit
+CHUNK_SIZE = 1024 * 1024                # bytes handled at once when streaming file data (1 MB)
+LOCK_TIMEOUT = 10.0                     # seconds a command waits for another process to release the image lock
+
+# version 2: table made of chained table blocks + on-disk hash index name -> slot, everything else as in version 1
+VERSION_2 = 2
+TABLE_BLOCK_FMT = '<8sIIH46s'           # magic, offset of next block (0 = last), first slot, nb of slots, reserved = 64 bytes
+TABLE_BLOCK_MAGIC = b"ZVFSTBL2"
+BLOCK_HEADER_SIZE = 64
+BLOCK_SLOTS = 256                       # max slots per table block
+MAX_SLOTS_V2 = 65535                    # file_capacity is stored in 2 bytes
+INDEX_LOCATION_FMT = '<II18s'           # reserved2 of a version 2 header: hash index offset, nb of buckets, reserved
+INDEX_BUCKET_FMT = '<I'                 # bucket = slot + 1, 0 = empty
+SLOT_MAP_FMT = '<IIH16s'                # reserved2 of a version 1 header: active slots bitmap, used slots (active or deleted) bitmap,
+                                        # check, 4-bit name fingerprint per slot = 26 bytes
+INDEX_BUCKET_SIZE = 4
+
+# journal: the metadata writes of a commit are first written as one record behind the end of the image
+JOURNAL_MAGIC = b"ZVFSJRNL"
+JOURNAL_TRAILER_FMT = '<8sQQIII28s'     # magic, record offset, image size to cut back to, body length, nb of writes, crc32 of body, reserved = 64 bytes
+JOURNAL_TRAILER_SIZE = 64
+JOURNAL_WRITE_FMT = '<QI'               # every write in the body: offset, length, then the bytes
+JOURNAL_MARK_OFFSETS = (10, 18)         # reserved0 and reserved1 of the header: low and high 16 bits of (record offset / 64) while a commit runs
+
+# export stream (exportfs/importfs): the active files one after the other, without table, deleted files or padding
+EXPORT_MAGIC = b"ZVFSEXP1"
+EXPORT_HEADER_FMT = '<8sBQ'             # magic, version of the exported image, since (0 = full export)
+EXPORT_RECORD_FMT = '<c32sBBQIII'       # kind, name, type, has checksum, created, stored length, size, crc32 (+ stored bytes for b"F")
+EXPORT_FILE = b"F"                      # file followed by its stored bytes (compressed files stay compressed)
+EXPORT_LINK = b"L"                      # file with the same data as an earlier record of the stream (dedup), length = record nb
+EXPORT_KEEP = b"K"                      # incremental only: file that is older than since and still there
+EXPORT_END = b"E"                       # end of the stream, length = nb of records before it
+EXPORT_PATH = b"P"                      # whole name of the next record (longer than the name field), length = nb of name bytes that follow
 
 
 class Header:
@@ -34,7 +84,7 @@ class Header:
         self.file_count = file_count                    # current nb of active entries (files present and not marked as deleted)
         self.file_capacity = FILE_CAPACITY              # fixed
         self.file_entry_size = ENTRY_SIZE               # fixed
-        self.reserved1 = 0                              # padding
+        self.reserved1 = 0                              # padding, high half of the journal mark
         self.file_table_offset = HEADER_SIZE            # fixed, start of file entries
         self.data_start_offset = DATA_START             # fixed, where data region begins
         
@@ -96,8 +146,76 @@ class Header:
         ) = struct.unpack(HEADER_FMT, data)
         return self
 
+    def index_location(self):      # version 2: (offset, nb of buckets) of the hash index, stored in reserved2
+        offset, buckets, _ = struct.unpack(INDEX_LOCATION_FMT, self.reserved2)
+        return offset, buckets
+
+    def set_index_location(self, offset, buckets):
+        self.reserved2 = struct.pack(INDEX_LOCATION_FMT, offset, buckets, b"\x00" * 18)
+
+
+def pack_table_block(next_block, first_slot, slot_count):     # 64-byte header of a version 2 table block
+    return struct.pack(TABLE_BLOCK_FMT, TABLE_BLOCK_MAGIC, next_block, first_slot, slot_count, b"\x00" * 46)
+
+
+def name_hash(name):            # hash of a file name for the version 2 index (must never change, it is stored on disk)
+    return zlib.crc32(name.encode("utf-8"))
+
+
+def slot_fingerprint(name):     # 4 bits of the name hash, stored per slot in the version 1 slot map
+    return name_hash(name) >> 28
+
+
+def _slot_map_check(header, maps):
+    # 16 bits over the header counters and the map, never 0 so the zero bytes of older images or of the Java
+    # implementation never count as a map; a program that changes files without knowing about the map changes
+    # the counters but not the check, so the map is known to be out of date then
+    counters = struct.pack("<HHII", header.file_count, header.deleted_files, header.next_free_offset, header.free_entry_offset)
+    return (zlib.crc32(maps, zlib.crc32(counters)) & 0xFFFF) or 1
+
+
+def pack_slot_map(header, entries):     # reserved2 of a version 1 header with the counters of header for these entries
+    active = used = 0
+    fingerprints = bytearray(16)
+    for slot, entry in enumerate(entries):
+        if entry.flag == 0 and entry.name:
+            active |= 1 << slot
+            fingerprints[slot // 2] |= slot_fingerprint(entry.name) << (4 * (slot % 2))
+        if not entry.is_empty():
+            used |= 1 << slot
+    maps = struct.pack("<II", active, used) + bytes(fingerprints)
+    return struct.pack(SLOT_MAP_FMT, active, used, _slot_map_check(header, maps), bytes(fingerprints))
+
+
+def read_slot_map(header):
+    # (active bitmap, used bitmap, fingerprints) from a version 1 header, None if it has no map or an out of date one
+    if header.version != VERSION:
+        return None
+    active, used, check, fingerprints = struct.unpack(SLOT_MAP_FMT, header.reserved2)
+    if check != _slot_map_check(header, header.reserved2[:8] + fingerprints) or bin(active).count("1") != header.file_count:
+        return None
+    return active, used, fingerprints
+
+
+def index_bucket_count(file_capacity):  # power of 2, at least twice the nb of slots so probing stays short
+    buckets = 64
+    while buckets < 2 * file_capacity:
+        buckets *= 2
+    return buckets
+
 FILE_ENTRY_FORMAT = "<32s I I B B H Q 12s"  # File entry struct format; spaces allowed for readability # <32s I I B B H Q 12s = 32 bytes name + 4 + 4 + 1 + 1 + 2 + 8 + 12 = 64
-TYPE = 0
+TYPE = 0                                    # data stored as it is
+TYPE_ZLIB = 1                               # data stored zlib compressed
+TYPE_LZMA = 2                               # data stored lzma (xz) compressed
+CODECS = {"zlib": TYPE_ZLIB, "lzma": TYPE_LZMA}
+RESERVED1_FMT = "<II4s"                     # reserved1 of a file entry: crc32 of the stored data, size before compression, 4 bytes still unused
+ENTRY_HAS_CHECKSUM = 0x0001                 # bit in reserved0 of a file entry: reserved1 holds a valid crc32
+ENTRY_LONG_NAME = 0x0002                    # bit in reserved0: the name goes on in name slots (version 2), the first one is in the free bytes of reserved1
+FLAG_NAME_SLOT = 2                          # flag of a slot that holds a piece of a long name instead of a file (see NameSlot)
+NAME_BYTES = 31                             # bytes of a name that fit in the entry itself (+ null byte = 32)
+NAME_PIECE = 32                             # bytes of a name per name slot
+MAX_PATH_BYTES = 255                        # longest name of a version 2 filesystem (version 1: NAME_BYTES)
+PATH_SEP = "/"                              # names are paths: "photos/2024/a.jpg" is a.jpg in directory photos/2024
 
 class FileEntry:
     def __init__(self, name=b"", start=0, length=0, flag=0, created=None):
@@ -122,6 +240,7 @@ class FileEntry:
     def pack(self):
         # encode name to 32 bytes, null-padded
         name_bytes = self.name.encode("utf-8") if isinstance(self.name, str) else self.name
+        name_bytes = split_name(name_bytes)[0]      # a longer name goes on in name slots
         name_bytes = name_bytes.ljust(32, b'\x00')  #add null bytes on the right until it is exactly 32 bytes long
 
         return struct.pack(
@@ -155,110 +274,1930 @@ class FileEntry:
     def mark_deleted(self):
         self.flag = 1
 
+    def is_empty(self):     # slot was never used (or was wiped by dfrgfs)
+        return self.flag == 0 and not self.name and self.length == 0
+
+    def checksum(self):     # crc32 of the stored data, None for entries written without one (e.g. by the Java version)
+        if not self.reserved0 & ENTRY_HAS_CHECKSUM:
+            return None
+        return struct.unpack(RESERVED1_FMT, self.reserved1)[0]
+
+    def set_checksum(self, crc):
+        _, raw_length, free = struct.unpack(RESERVED1_FMT, self.reserved1)
+        self.reserved1 = struct.pack(RESERVED1_FMT, crc, raw_length, free)
+        self.reserved0 |= ENTRY_HAS_CHECKSUM
+
+    def is_compressed(self):
+        return self.type != TYPE
+
+    def data_length(self):  # size of the file itself (length is what is stored, so after compression)
+        if not self.is_compressed():
+            return self.length
+        return struct.unpack(RESERVED1_FMT, self.reserved1)[1]
+
+    def set_compressed(self, codec_type, raw_length):
+        crc, _, free = struct.unpack(RESERVED1_FMT, self.reserved1)
+        self.reserved1 = struct.pack(RESERVED1_FMT, crc, raw_length, free)
+        self.type = codec_type
+
+    def name_slot(self):    # first name slot of an entry with a long name, None otherwise
+        if not self.reserved0 & ENTRY_LONG_NAME:
+            return None
+        return struct.unpack("<I", struct.unpack(RESERVED1_FMT, self.reserved1)[2])[0]
+
+    def set_name_slot(self, slot):
+        crc, raw_length, _ = struct.unpack(RESERVED1_FMT, self.reserved1)
+        self.reserved1 = struct.pack(RESERVED1_FMT, crc, raw_length, struct.pack("<I", slot))
+        self.reserved0 |= ENTRY_LONG_NAME
+
+
+class NameSlot(FileEntry):
+    # slot of a version 2 table holding NAME_PIECE bytes of a name that is longer than NAME_BYTES:
+    # the entry of the file has the first NAME_BYTES (so tools that don't know name slots still show something),
+    # the rest is split over a chain of name slots, start = next name slot + 1 (0 = last piece)
+    # it is neither active, deleted nor empty, so everything that only looks at files skips it
+    def __init__(self, piece, next_slot=None):
+        super().__init__(created=0)
+        self.piece = piece
+        self.flag = FLAG_NAME_SLOT
+        self.set_next(next_slot)
+
+    def set_next(self, next_slot):
+        self.start = 0 if next_slot is None else next_slot + 1
 
-######################### helper function ##############################
+    def pack(self):
+        return struct.pack(FILE_ENTRY_FORMAT, self.piece, self.start, 0, TYPE, FLAG_NAME_SLOT, 0, 0, b'\x00' * 12)
 
-def addfs_bytes(fs_name, file_name, data_bytes, created_ts=None):
-    # helper for dfrgfs -> does the re-adding of active files to filesystem
-    # add file into existing filesystem and preserve created_ts
-    # was copied from addfs and changed to accepts bytes and created timestamp 
 
-    # assume fs exists
-    with open(fs_name, "r+b") as f:
-        f.seek(0)
-        header = Header().unpack(f.read(HEADER_SIZE))
+######################### bulk table decoding ##############################
+# the whole table (or one version 2 block) is decoded in one go instead of one struct.unpack per slot
+
+ENTRY_DTYPE = None  # numpy dtype with the same layout as FILE_ENTRY_FORMAT (reserved1 split like RESERVED1_FMT)
+
 
-        if header.flags == 1:   # no more free entries
-            print("Error: filesystem entry table is full, cannot add more files.")
+def load_numpy():   # the numpy module, or None if it isn't installed (imported on first use, it takes a while)
+    global numpy, ENTRY_DTYPE
+    if numpy is False:
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        else:
+            ENTRY_DTYPE = numpy.dtype([("name", "S32"), ("start", "<u4"), ("length", "<u4"), ("type", "u1"), ("flag", "u1"),
+                                       ("reserved0", "<u2"), ("created", "<u8"),
+                                       ("crc", "<u4"), ("raw_length", "<u4"), ("free", "S4")])
+    return numpy
+
+
+def decode_entries(raw):    # list of FileEntry for raw table bytes (a multiple of 64 bytes)
+    entries = []
+    for raw_name, start, length, entry_type, flag, reserved0, created, reserved1 in struct.iter_unpack(FILE_ENTRY_FORMAT, raw):
+        entry = FileEntry.__new__(FileEntry)    # skips __init__, the fields come from disk
+        entry.name = raw_name.split(b'\x00', 1)[0].decode('utf-8', errors='ignore') if raw_name[0] else ""
+        entry.start = start
+        entry.length = length
+        entry.type = entry_type
+        entry.flag = flag
+        entry.reserved0 = reserved0
+        entry.created = created
+        entry.reserved1 = reserved1
+        entries.append(entry)
+    return entries
+
+
+def table_summary(raw):
+    # counts and sizes of raw table bytes without making FileEntry objects:
+    # active = slot numbers of active files, deleted, empty = nb of slots, total_size = bytes of data stored
+    # (data shared by deduplicated files counts once)
+    # with numpy these are array operations on the table, otherwise one pass over struct.iter_unpack
+    if load_numpy() is not None:
+        table = numpy.frombuffer(raw, ENTRY_DTYPE)
+        named = numpy.frombuffer(raw, numpy.uint8)[::ENTRY_SIZE] != 0  # first byte of the name (same test as FileEntry)
+        used = table["length"] > 0
+        starts, first = numpy.unique(table["start"][used], return_index=True)
+        return {
+            "active": numpy.flatnonzero((table["flag"] == 0) & named).tolist(),
+            "deleted": int(numpy.count_nonzero(table["flag"] == 1)),
+            "empty": int(numpy.count_nonzero((table["flag"] == 0) & ~named & ~used)),
+            "total_size": int(table["length"][used][first].sum(dtype=numpy.uint64)),
+        }
+    active = []
+    deleted = empty = total_size = 0
+    counted = set()
+    for slot, (raw_name, start, length, entry_type, flag, *_) in enumerate(struct.iter_unpack(FILE_ENTRY_FORMAT, raw)):
+        if flag == 0 and raw_name[0]:
+            active.append(slot)
+        elif flag == 1:
+            deleted += 1
+        elif flag == 0 and length == 0:
+            empty += 1
+        if length > 0 and start not in counted:
+            counted.add(start)
+            total_size += length
+    return {"active": active, "deleted": deleted, "empty": empty, "total_size": total_size}
+
+
+######################### paths ##############################
+# a file name can be a path with "/" between directories, directories themselves are not stored: they exist as
+# long as a file is in them, like prefixes in an object store
+# the directory tree is kept in memory as a PathTrie, so listing one directory or a glob pattern only visits the
+# branches it needs instead of every file of the table
+
+def split_name(name_bytes):     # (part stored in the entry itself, rest for the name slots) of an encoded name
+    if len(name_bytes) <= NAME_BYTES:
+        return name_bytes, b""
+    cut = NAME_BYTES
+    while name_bytes[cut] & 0xC0 == 0x80:   # don't cut a UTF-8 character in two
+        cut -= 1
+    return name_bytes[:cut], name_bytes[cut:]
+
+
+def check_path(name):   # raises ValueError if name isn't a clean relative path ("a/b.txt", not "/a", "a//b" or "../a")
+    if any(part in ("", ".", "..") for part in name.split(PATH_SEP)):
+        raise ValueError(f"{name!r} is not a valid path (no empty, '.' or '..' parts, no '/' at the start or end).")
+
+
+def host_path(name):
+    # relative host path a file of the filesystem is extracted to, directories included
+    # names written by other tools that could leave the destination ("../x") are cut down to their last part
+    try:
+        check_path(name)
+        return Path(*name.split(PATH_SEP))
+    except ValueError:
+        base = os.path.basename(name)
+        if base in ("", ".", ".."):
+            raise ValueError(f"file name {name!r} can't be used on the host")
+        return Path(base)
+
+
+def has_glob(pattern):
+    return any(char in pattern for char in "*?[")
+
+
+class PathTrie:
+    # directory tree of file names, one node per directory: dirs = name -> PathTrie of the sub directory,
+    # files = name -> slot of the files directly in it
+    def __init__(self, index=None):     # index: name -> slot (ZvfsImage.index)
+        self.dirs = {}
+        self.files = {}
+        for name, slot in (index or {}).items():
+            self.insert(name, slot)
+
+    def insert(self, name, slot):
+        *dirs, base = name.split(PATH_SEP)
+        node = self
+        for part in dirs:
+            node = node.dirs.setdefault(part, PathTrie())
+        node.files[base] = slot
+
+    def remove(self, name):     # directories left empty disappear with their last file
+        *dirs, base = name.split(PATH_SEP)
+        path = [self]
+        for part in dirs:
+            path.append(path[-1].dirs.get(part))
+            if path[-1] is None:
+                return
+        path[-1].files.pop(base, None)
+        for parent, part, node in reversed(list(zip(path, dirs, path[1:]))):
+            if node.dirs or node.files:
+                break
+            del parent.dirs[part]
+
+    def node(self, path):       # PathTrie of directory path ("" = top), None if there is no such directory
+        node = self
+        for part in path.split(PATH_SEP) if path else []:
+            node = node.dirs.get(part)
+            if node is None:
+                return None
+        return node
+
+    def walk(self, prefix=""):  # (name, slot) of every file below this node, prefix = path of the node + "/"
+        for base, slot in self.files.items():
+            yield prefix + base, slot
+        for part, node in self.dirs.items():
+            yield from node.walk(prefix + part + PATH_SEP)
+
+    def glob(self, pattern):
+        # sorted (name, slot) of the files matching pattern: fnmatch rules per part ("*" doesn't go into sub
+        # directories), "**" = any nb of directories, parts without wildcards are dict lookups
+        matches = {}
+        self._glob(pattern.split(PATH_SEP), "", matches)
+        return sorted(matches.items())
+
+    def _glob(self, parts, prefix, matches):
+        part, rest = parts[0], parts[1:]
+        if part == "**":
+            if rest:
+                self._glob(rest, prefix, matches)
+            else:
+                matches.update(self.walk(prefix))
+            for name, node in self.dirs.items():
+                node._glob(parts, prefix + name + PATH_SEP, matches)
+        elif not rest:
+            if has_glob(part):
+                matches.update((prefix + name, slot) for name, slot in self.files.items() if fnmatch.fnmatchcase(name, part))
+            elif part in self.files:
+                matches[prefix + part] = self.files[part]
+        else:
+            names = [name for name in self.dirs if fnmatch.fnmatchcase(name, part)] if has_glob(part) else [part]
+            for name in names:
+                if name in self.dirs:
+                    self.dirs[name]._glob(rest, prefix + name + PATH_SEP, matches)
+
+    def select(self, path):
+        # what lsfs shows for path: (sorted sub directories with "/" at the end, sorted (name, slot) of files)
+        # a directory lists what is directly in it ("" or "/" = top), a pattern the matching files, a file itself
+        path = path.strip(PATH_SEP)
+        if has_glob(path):
+            return [], self.glob(path)
+        node = self.node(path)
+        if node is None:
+            parent = self.node(path.rpartition(PATH_SEP)[0])
+            base = path.rpartition(PATH_SEP)[2]
+            return [], [(path, parent.files[base])] if parent is not None and base in parent.files else []
+        prefix = path + PATH_SEP if path else ""
+        return sorted(prefix + name + PATH_SEP for name in node.dirs), sorted((prefix + name, slot) for name, slot in node.files.items())
+
+
+######################### streaming copy ##############################
+
+def copy_range(src_fd, dst_fd, src_offset, dst_offset, length):
+    # copy length bytes between two files without ever holding more than CHUNK_SIZE bytes in memory
+    # tries copy_file_range first (data never leaves the kernel), then sendfile, then plain pread/pwrite chunks
+    copied = 0
+    if hasattr(os, "copy_file_range"):
+        try:
+            while copied < length:
+                n = os.copy_file_range(src_fd, dst_fd, min(length - copied, CHUNK_SIZE),
+                                       src_offset + copied, dst_offset + copied)
+                if n == 0:
+                    break
+                copied += n
+        except OSError:     # not supported for these files/this kernel -> continue with the next method
+            pass
+    if copied < length and hasattr(os, "sendfile"):
+        try:
+            os.lseek(dst_fd, dst_offset + copied, os.SEEK_SET)     # sendfile writes at the current position of dst
+            while copied < length:
+                n = os.sendfile(dst_fd, src_fd, src_offset + copied, min(length - copied, CHUNK_SIZE))
+                if n == 0:
+                    break
+                copied += n
+        except OSError:
+            pass
+    while copied < length:
+        chunk = os.pread(src_fd, min(length - copied, CHUNK_SIZE), src_offset + copied)
+        if not chunk:
+            break
+        os.pwrite(dst_fd, chunk, dst_offset + copied)
+        copied += len(chunk)
+    if copied < length:
+        raise ValueError(f"source ended after {copied} of {length} bytes (file changed while copying?)")
+
+
+def compressor(codec_type):
+    if codec_type == TYPE_ZLIB:
+        return zlib.compressobj(6)
+    import lzma
+    return lzma.LZMACompressor()
+
+
+def decompress_chunks(codec_type, chunks):
+    # decompresses a stream of compressed chunks, never yields more than CHUNK_SIZE bytes at once
+    # (so a small but very well compressed file can't blow up memory)
+    if codec_type == TYPE_ZLIB:
+        d = zlib.decompressobj()
+        for chunk in chunks:
+            while chunk:
+                out = d.decompress(chunk, CHUNK_SIZE)
+                if out:
+                    yield out
+                chunk = d.unconsumed_tail
+        out = d.flush()
+        if out:
+            yield out
+    elif codec_type == TYPE_LZMA:
+        import lzma
+        d = lzma.LZMADecompressor()
+        for chunk in chunks:
+            out = d.decompress(chunk, CHUNK_SIZE)
+            while True:
+                if out:
+                    yield out
+                if d.eof or d.needs_input:
+                    break
+                out = d.decompress(b"", CHUNK_SIZE)
+    else:
+        raise ValueError(f"unknown compression type {codec_type}")
+
+
+def range_checksum(fd, offset, length):     # crc32 of length bytes at offset, read in CHUNK_SIZE pieces
+    crc = 0
+    done = 0
+    while done < length:
+        chunk = os.pread(fd, min(length - done, CHUNK_SIZE), offset + done)
+        if not chunk:
+            raise ValueError(f"data ends after {done} of {length} bytes")
+        crc = zlib.crc32(chunk, crc)     # crc32 releases the GIL for big buffers, so several threads can hash at once
+        done += len(chunk)
+    return crc
+
+
+######################### sparse files ##############################
+# zero bytes that are not there yet are never written: ftruncate() makes them (the host filesystem doesn't store
+# them, the file is sparse), and the data space of removed files can be given back to the host filesystem by
+# punching a hole into the image (the range reads as zeros afterwards, the size of the image stays the same)
+
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+
+
+def load_fallocate():   # fallocate() of libc, None if the system doesn't have it (loaded on first use)
+    global _fallocate
+    if _fallocate is False:
+        try:
+            import ctypes
+            _fallocate = ctypes.CDLL(None, use_errno=True).fallocate
+            _fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+        except (ImportError, OSError, AttributeError):
+            _fallocate = None   # no hole punching, the space of removed files is only reused by zvfs itself
+    return _fallocate
+
+
+def punch_hole(fd, offset, length):     # True if the range was deallocated, False if the system can't do it
+    if length <= 0 or load_fallocate() is None:
+        return False
+    if _fallocate(fd, FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE, offset, length) != 0:
+        return False    # e.g. EOPNOTSUPP on filesystems without hole support, the data simply stays
+    return True
+
+
+def zero_fill(fd, offset, length):
+    # makes length bytes at offset zero: past the end of the file ftruncate() extends it with a hole, inside the
+    # file (reused space) the zeros have to be written
+    if length <= 0:
+        return
+    if os.fstat(fd).st_size <= offset:
+        os.ftruncate(fd, offset + length)
+    else:
+        os.pwrite(fd, b"\x00" * length, offset)
+
+
+######################### journal ##############################
+# a commit writes all of its metadata changes (entries, table block headers, index buckets, header) as one record
+# behind the end of the image: body with the writes, then a 64-byte trailer that is the very last thing in the file
+# the header gets a mark with the offset of the record (reserved0/reserved1, see JOURNAL_MARK_OFFSETS), so bytes
+# of a stored file (or payload left behind by a crash) that only look like a record are never taken for one
+# one fsync makes the payloads, the record and the mark durable -> the commit can't get lost anymore
+# then the writes are done in place (the header one keeps the mark), fsync, the mark is cleared and the record cut off
+# after a crash, an image with a mark and a complete record there (crc ok) gets the writes done again when it is
+# opened (doing them twice is harmless), an incomplete record is ignored because nothing was changed in place yet
+
+def pack_journal(writes, journal_start, truncate_to):
+    body = b"".join(struct.pack(JOURNAL_WRITE_FMT, offset, len(data)) + data for offset, data in writes)
+    trailer = struct.pack(JOURNAL_TRAILER_FMT, JOURNAL_MAGIC, journal_start, truncate_to, len(body), len(writes), zlib.crc32(body), b"")
+    return body + trailer
+
+
+def pack_journal_mark(journal_start):   # (offset, bytes) writes that point the header at the record (0 = no commit running)
+    mark = journal_start // 64
+    return [(JOURNAL_MARK_OFFSETS[0], struct.pack("<H", mark & 0xFFFF)), (JOURNAL_MARK_OFFSETS[1], struct.pack("<H", mark >> 16))]
+
+
+def mark_header(data, journal_start):   # header bytes with the mark set
+    data = bytearray(data)
+    for offset, field in pack_journal_mark(journal_start):
+        data[offset:offset + len(field)] = field
+    return bytes(data)
+
+
+def journal_mark(header):   # offset of the record of the commit that was running when the header was read, 0 if none
+    if len(header) < HEADER_SIZE:
+        return 0
+    low, high = (struct.unpack_from("<H", header, offset)[0] for offset in JOURNAL_MARK_OFFSETS)
+    return (low | high << 16) * 64
+
+
+def read_journal(fd, header):   # (writes, truncate_to) of the complete record the header bytes point at, or None
+    journal_start = journal_mark(header)
+    if not journal_start or journal_start < Header().unpack(header[:HEADER_SIZE]).next_free_offset:  # never inside committed data
+        return None
+    size = os.fstat(fd).st_size
+    if size < journal_start + JOURNAL_TRAILER_SIZE:
+        return None
+    magic, record_start, truncate_to, body_length, count, crc, _ = struct.unpack(
+        JOURNAL_TRAILER_FMT, os.pread(fd, JOURNAL_TRAILER_SIZE, size - JOURNAL_TRAILER_SIZE))
+    if magic != JOURNAL_MAGIC or record_start != journal_start or journal_start + body_length + JOURNAL_TRAILER_SIZE != size or truncate_to > journal_start:
+        return None
+    body = os.pread(fd, body_length, journal_start)
+    if zlib.crc32(body) != crc:
+        return None
+    writes = []
+    pos = 0
+    for _ in range(count):
+        offset, length = struct.unpack_from(JOURNAL_WRITE_FMT, body, pos)
+        pos += struct.calcsize(JOURNAL_WRITE_FMT)
+        writes.append((offset, body[pos:pos + length]))
+        pos += length
+    return writes, truncate_to
+
+
+def apply_journal(fd, writes, truncate_to, durable=True):
+    for offset, data in writes:
+        os.pwrite(fd, data, offset)
+    if durable:
+        os.fsync(fd)
+    for offset, data in pack_journal_mark(0):   # commit is finished
+        os.pwrite(fd, data, offset)
+    os.ftruncate(fd, truncate_to)   # record is done (if the mark or this doesn't make it to disk, it is only done once more)
+
+
+######################### export stream ##############################
+# exportfs/importfs, see EXPORT_RECORD_FMT, ZvfsImage.export and ZvfsImage.import_stream
+
+def read_stream(inp, n):    # exactly n bytes from a binary stream, ValueError if it ends before
+    data = inp.read(n)
+    while len(data) < n:        # pipes can return less than asked
+        more = inp.read(n - len(data))
+        if not more:
+            raise ValueError("export stream is incomplete.")
+        data += more
+    return data
+
+
+def read_export_header(inp):    # (version, since) of an export stream, raises ValueError if it isn't one
+    magic, version, since = struct.unpack(EXPORT_HEADER_FMT, read_stream(inp, struct.calcsize(EXPORT_HEADER_FMT)))
+    if magic != EXPORT_MAGIC or version not in (VERSION, VERSION_2):
+        raise ValueError("not a zvfs export stream (bad magic).")
+    return version, since
+
+
+######################### in-memory image ##############################
+
+class ZvfsImage:
+    # keeps one open handle on a .zvfs image together with its header and the whole file entry table
+    # the table is read with ONE bulk read per table block when the image is opened, and a name -> slot dict is kept
+    # in sync on add/remove, so looking up a file is a dict lookup instead of 32 seeks + 32 reads
+    # the in-memory copy is only there so we never have to read the table back, every change still goes to disk
+
+    # use_mmap maps a read-only image into memory, view() then hands out slices of the mapping without copying
+    # load_table=False skips reading the table of a read-only version 2 image, lookup() then uses the on-disk hash
+    # index instead (a couple of small reads, no matter how many entries the table has), for version 1 it skips
+    # decoding the table if the header has an up to date slot map
+
+    # locking: the image is flock()ed as long as it is open, shared by readers and exclusive by writers, so several
+    # readers run at the same time but a writer has the image (header + table + free space) to itself and nobody
+    # reads a half written table. Taken before the header is read, so the in-memory copy is never stale.
+    # lock_timeout = seconds to wait for other processes (None = forever, 0 = don't wait), ValueError if it runs out
+    # (the Java implementation doesn't lock, don't use both on the same image at the same time)
+
+    # an image left with an unfinished commit (see journal) is repaired when it is opened, a read-only open does
+    # that through a short writable open first
+
+    def __init__(self, fs_name, writable=False, use_mmap=False, load_table=True, lock_timeout=None):
+        self.fs_name = fs_name
+        self.writable = writable
+        self.f = open(fs_name, "r+b" if writable else "rb", buffering=0)    # unbuffered: data is also written with os.pwrite on the same fd
+        self._map = None
+        self._batching = False      # inside batch(): entry/header/metadata writes are collected and written on commit
+        self._dirty_slots = set()
+        self._dirty_header = False
+        self._pending_meta = {}     # offset -> bytes, table block headers and hash index buckets
+        self._pending_free = []     # data space given back inside a batch, only reusable after the commit
+        self._pending_punch = []    # data space of removed files to give back to the host filesystem after the commit
+        self.durable = True         # False: commits still go through the journal but without fsync (safe if the
+                                    # process crashes, changes since the OS last wrote them back are lost if the machine does)
+        self.append_only = False    # True: new data always goes to the end (sequential writes), holes are left to dfrgfs
+        self._trie = None           # PathTrie of the active files, see paths()
+        self._reserved_names = {}   # slot -> name slots taken by _reserve_slot for it, written by _commit_add
+        self._unfinished = None     # (writes, truncate_to) of a commit whose in place writes failed, see batch()
+        try:
+            self._lock(lock_timeout)
+            first = os.pread(self.f.fileno(), DATA_START, 0)    # header + version 1 table in ONE read
+            while journal_mark(first):      # last commit was interrupted
+                record = read_journal(self.f.fileno(), first)
+                if writable and record is not None:
+                    apply_journal(self.f.fileno(), *record)
+                elif writable:              # the record never made it to disk, nothing was changed in place
+                    for offset, data in pack_journal_mark(0):
+                        os.pwrite(self.f.fileno(), data, offset)
+                elif record is None:
+                    break
+                else:
+                    self._unlock()
+                    recover_image(fs_name, lock_timeout)
+                    self._lock(lock_timeout)
+                first = os.pread(self.f.fileno(), DATA_START, 0)
+            if len(first) < HEADER_SIZE:
+                raise ValueError(f"{fs_name} is not a valid .zvfs filesystem (too short).")
+            self.header = Header().unpack(first[:HEADER_SIZE])
+            self._prefetched = first if self.header.version == VERSION else None
+            if self.header.magic != MAGIC:
+                raise ValueError(f"{fs_name} is not a valid .zvfs filesystem (bad magic).")
+            if self.header.version not in (VERSION, VERSION_2):
+                raise ValueError(f"{fs_name} has unsupported version {self.header.version}.")
+            # version 1 without the table: only with an up to date slot map, lookups decode just the slots whose
+            # name fingerprint matches (from the bytes read above)
+            self._slot_map = read_slot_map(self.header) if not (load_table or writable) else None
+            if load_table or writable or (self.header.version == VERSION and self._slot_map is None):
+                self._load_table()
+            else:
+                self._table_bytes = first
+                self.entries = None
+                self.raw_table = None
+                self._load_blocks()
+            if use_mmap and not writable:   # a writable image can grow, so it is never mapped
+                self._map = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        except Exception:
+            self.f.close()
+            raise
+
+    def _lock(self, timeout):
+        if fcntl is None:
             return
+        mode = fcntl.LOCK_EX if self.writable else fcntl.LOCK_SH
+        if timeout is None:
+            fcntl.flock(self.f.fileno(), mode)
+            return
+        deadline = time.monotonic() + timeout
+        delay = 0.001
+        while True:
+            try:
+                fcntl.flock(self.f.fileno(), mode | fcntl.LOCK_NB)
+                return
+            except BlockingIOError:
+                if time.monotonic() >= deadline:
+                    raise ValueError(f"{self.fs_name} is locked by another process.")
+                time.sleep(min(delay, max(0.0, deadline - time.monotonic())))
+                delay = min(delay * 2, 0.1)
+
+    def _unlock(self):
+        if fcntl is not None:
+            fcntl.flock(self.f.fileno(), fcntl.LOCK_UN)
 
-        # choose next free entry slot (free_entry_offset points to byte offset of free slot)
-        file_entry_index = header.free_entry_offset
-        if file_entry_index == 0:   # if free_entry_offset is 0 = fs is full no more data can be added
-            print("Error: filesystem is full, cannot add more data.")
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):            # views handed out by view() have to be released before this
+        if self._map is not None:
+            try:
+                self._map.close()
+            except BufferError:     # a view is still used somewhere, the mapping goes away together with it
+                pass
+            self._map = None
+        if not self.f.closed:
+            self.f.close()
+
+    ######## table blocks ########
+    # version 1: one block of 32 slots right after the header
+    # version 2: chain of table blocks, each one a 64-byte block header followed by its slots
+    # self._blocks holds (block header offset or None, offset of first slot, first slot number, nb of slots)
+
+    def _read_block_header(self, offset, data):
+        magic, next_block, first_slot, slot_count, _ = struct.unpack(TABLE_BLOCK_FMT, data)
+        if magic != TABLE_BLOCK_MAGIC:
+            raise ValueError(f"{self.fs_name}: broken table block chain at offset {offset}.")
+        return next_block, first_slot, slot_count
+
+    def _walk_blocks(self, with_slots):     # yields (block tuple, raw slot bytes or None) for every block in the chain
+        header = self.header
+        if header.version == VERSION:
+            table_end = header.file_table_offset + header.file_capacity * ENTRY_SIZE
+            prefetched, self._prefetched = self._prefetched, None     # only good for the first read after opening
+            if not with_slots:
+                raw = None
+            elif prefetched is not None and len(prefetched) >= table_end:
+                raw = prefetched[header.file_table_offset:table_end]
+            else:
+                raw = self._read_table(header.file_capacity * ENTRY_SIZE, header.file_table_offset)
+            yield (None, header.file_table_offset, 0, header.file_capacity), raw
+            return
+        offset = header.file_table_offset
+        while offset:
+            if with_slots:      # block header and its slots in one read
+                slot_count = struct.unpack_from("<H", self._read_table(2, offset + 16))[0]
+                data = self._read_table(BLOCK_HEADER_SIZE + slot_count * ENTRY_SIZE, offset)
+            else:
+                data = self._read_table(BLOCK_HEADER_SIZE, offset)
+            next_block, first_slot, slot_count = self._read_block_header(offset, data[:BLOCK_HEADER_SIZE])
+            yield (offset, offset + BLOCK_HEADER_SIZE, first_slot, slot_count), (data[BLOCK_HEADER_SIZE:] if with_slots else None)
+            offset = next_block
+
+    def _read_table(self, size, offset):    # table bytes, ValueError if the image ends before them
+        data = os.pread(self.f.fileno(), size, offset)
+        if len(data) < size:
+            raise ValueError(f"{self.fs_name} is not a valid .zvfs filesystem (cut off in the entry table).")
+        return data
+
+    def _set_blocks(self, blocks):
+        self._blocks = blocks
+        self._block_starts = [block[2] for block in blocks]
+
+    def _load_blocks(self):     # only the block chain, not the slots (for lookups through the on-disk index)
+        self._set_blocks([block for block, raw in self._walk_blocks(with_slots=False)])
+
+    def _load_table(self):  # one read per table block, each block decoded in one go
+        self.entries = []   # FileEntry per slot, index in the list = slot number
+        self.index = {}     # name -> slot, only for active (not deleted) files
+        blocks = []
+        raws = []
+        for block, raw in self._walk_blocks(with_slots=True):
+            blocks.append(block)
+            raws.append(raw)
+            self.entries.extend(decode_entries(raw))
+        self.raw_table = b"".join(raws)     # table bytes as loaded (for table_summary), not updated by later changes
+        self._read_long_names()
+        for slot, entry in enumerate(self.entries):
+            if entry.flag == 0 and entry.name:
+                self.index.setdefault(entry.name, slot)    # first slot wins, like the old linear scans did
+        self._set_blocks(blocks)
+        self._load_index()
+        self._build_free_space()
+        self._build_dedup_index()
+
+    def _ensure_table(self):
+        if self.entries is None:
+            self._load_table()
+
+    def _read_long_names(self):     # name slots become NameSlot objects, entries with a long name get their full name
+        self._name_slots = {}       # slot of a file (active or deleted) with a long name -> its name slots in order
+        self._reserved_names = {}
+        self._trie = None
+        raw = self.raw_table
+        if self.header.version == VERSION or FLAG_NAME_SLOT not in raw[41::ENTRY_SIZE]:    # flag byte of every slot
+            return
+        long_names = []
+        for slot, entry in enumerate(self.entries):
+            if entry.flag == FLAG_NAME_SLOT:
+                self.entries[slot] = NameSlot(raw[slot * ENTRY_SIZE:slot * ENTRY_SIZE + NAME_PIECE].rstrip(b"\x00"),
+                                              entry.start - 1 if entry.start else None)
+            elif entry.reserved0 & ENTRY_LONG_NAME:
+                long_names.append(slot)
+        for slot in long_names:
+            entry = self.entries[slot]
+            entry.name, self._name_slots[slot] = self._long_name(entry, lambda s: raw[s * ENTRY_SIZE:(s + 1) * ENTRY_SIZE])
+
+    def _long_name(self, entry, read_slot):
+        # (full name, name slots) of an entry with ENTRY_LONG_NAME, read_slot(slot) returns the 64 bytes of a slot
+        # a broken chain (e.g. changed by a tool that doesn't know name slots) ends the name where it breaks
+        name = entry.name.encode("utf-8")
+        slots = []
+        slot = entry.name_slot()
+        while slot is not None and slot < self.header.file_capacity and slot not in slots:
+            piece, next_slot, _, _, flag, *_ = struct.unpack(FILE_ENTRY_FORMAT, read_slot(slot))
+            if flag != FLAG_NAME_SLOT:
+                break
+            name += piece.rstrip(b"\x00")
+            slots.append(slot)
+            slot = next_slot - 1 if next_slot else None
+        return name.decode("utf-8", errors="ignore"), slots
+
+    def slot_offset(self, slot):    # byte offset of a slot in the image
+        block = self._blocks[0] if len(self._blocks) == 1 else self._blocks[bisect.bisect_right(self._block_starts, slot) - 1]
+        return block[1] + (slot - block[2]) * ENTRY_SIZE
+
+    def _meta_extents(self):    # (start, padded_length) of table blocks and hash index that live in the data region
+        if self.header.version == VERSION:
+            return []
+        extents = [(block[0], BLOCK_HEADER_SIZE + block[3] * ENTRY_SIZE) for block in self._blocks
+                   if block[0] >= self.header.data_start_offset]
+        index_offset, buckets = self.header.index_location()
+        if buckets:
+            extents.append((index_offset, ((buckets * INDEX_BUCKET_SIZE + 63) // 64) * 64))
+        return extents
+
+    def _grow_table(self):
+        # version 2 only: chain one more table block (placed like file data) to the end of the table
+        header = self.header
+        slot_count = min(BLOCK_SLOTS, MAX_SLOTS_V2 - header.file_capacity)
+        if header.version == VERSION or slot_count <= 0:
+            raise ValueError("filesystem entry table is full, cannot add more files.")
+        block_offset = self._take_space(BLOCK_HEADER_SIZE + slot_count * ENTRY_SIZE)
+        first_slot = header.file_capacity
+        os.pwrite(self.f.fileno(), pack_table_block(0, first_slot, slot_count), block_offset)
+        zero_fill(self.f.fileno(), block_offset + BLOCK_HEADER_SIZE, slot_count * ENTRY_SIZE)
+
+        last = self._blocks[-1]     # link it: next pointer of the block that was last so far
+        self._write_meta(last[0], pack_table_block(block_offset, last[2], last[3]))
+        self._set_blocks(self._blocks + [(block_offset, block_offset + BLOCK_HEADER_SIZE, first_slot, slot_count)])
+        self.entries.extend(FileEntry(created=0) for _ in range(slot_count))
+        self.empty_slots.extend(range(first_slot, first_slot + slot_count))
+        header.file_capacity += slot_count
+        if index_bucket_count(header.file_capacity) > header.index_location()[1]:
+            self._rebuild_index()
+        self._write_header()
+
+    ######## on-disk hash index (version 2) ########
+    # open addressing with linear probing, bucket = slot + 1 (0 = empty)
+    # buckets are never cleared when a file is removed, a lookup just checks the entry it points to and goes on,
+    # the index is rebuilt when it gets too full of such stale buckets or when the table grows
+
+    def _load_index(self):
+        offset, buckets = self.header.index_location()
+        self._buckets = None
+        if self.header.version == VERSION_2 and buckets:
+            self._buckets = array.array("I", self._read_table(buckets * INDEX_BUCKET_SIZE, offset))
+            if sys.byteorder != "little":
+                self._buckets.byteswap()
+            self._buckets_used = sum(1 for bucket in self._buckets if bucket)
+
+    def _index_insert(self, name, slot):
+        if self._buckets is None:
+            return
+        if (self._buckets_used + 1) * 4 > len(self._buckets) * 3:   # more than 3/4 used -> start over without stale buckets
+            self._rebuild_index()
             return
+        mask = len(self._buckets) - 1
+        b = name_hash(name) & mask
+        while self._buckets[b] and self._buckets[b] != slot + 1:
+            b = (b + 1) & mask
+        if not self._buckets[b]:
+            self._buckets[b] = slot + 1
+            self._buckets_used += 1
+            offset = self.header.index_location()[0]
+            self._write_meta(offset + b * INDEX_BUCKET_SIZE, struct.pack(INDEX_BUCKET_FMT, slot + 1))
+
+    def _build_buckets(self, bucket_count):     # fresh bucket array for all active files
+        buckets = array.array("I", bytes(bucket_count * INDEX_BUCKET_SIZE))
+        mask = bucket_count - 1
+        for name, slot in self.index.items():
+            b = name_hash(name) & mask
+            while buckets[b]:
+                b = (b + 1) & mask
+            buckets[b] = slot + 1
+        return buckets
+
+    def _buckets_bytes(self, buckets):
+        if sys.byteorder != "little":
+            buckets = array.array("I", buckets)
+            buckets.byteswap()
+        return buckets.tobytes()
+
+    def _rebuild_index(self):
+        # new index is written to new space, the old one is only given back after the commit
+        old_offset, old_buckets = self.header.index_location()
+        bucket_count = index_bucket_count(self.header.file_capacity)
+        buckets = self._build_buckets(bucket_count)
+        offset = self._take_space(((bucket_count * INDEX_BUCKET_SIZE + 63) // 64) * 64)
+        os.pwrite(self.f.fileno(), self._buckets_bytes(buckets), offset)
+        if old_buckets:
+            self._free_extent(old_offset, ((old_buckets * INDEX_BUCKET_SIZE + 63) // 64) * 64)
+        self.header.set_index_location(offset, bucket_count)
+        self._buckets = buckets
+        self._buckets_used = len(self.index)
+        self._write_header()
+
+    def _index_lookup(self, name):  # lookup through the on-disk index, without the table in memory
+        if self.header.version == VERSION:      # version 1: candidates from the slot map in the header
+            active, used, fingerprints = self._slot_map
+            fingerprint = slot_fingerprint(name)
+            for slot in range(self.header.file_capacity):
+                if active >> slot & 1 and fingerprints[slot // 2] >> (4 * (slot % 2)) & 0xF == fingerprint:
+                    offset = self.slot_offset(slot)
+                    entry = FileEntry().unpack(self._table_bytes[offset:offset + ENTRY_SIZE])
+                    if entry.flag == 0 and entry.name == name:
+                        return entry
+            return None
+        offset, bucket_count = self.header.index_location()
+        mask = bucket_count - 1
+        b = name_hash(name) & mask
+        for _ in range(bucket_count):
+            bucket = struct.unpack(INDEX_BUCKET_FMT, os.pread(self.f.fileno(), INDEX_BUCKET_SIZE, offset + b * INDEX_BUCKET_SIZE))[0]
+            if not bucket:
+                return None
+            entry = FileEntry().unpack(os.pread(self.f.fileno(), ENTRY_SIZE, self.slot_offset(bucket - 1)))
+            if entry.flag == 0 and entry.reserved0 & ENTRY_LONG_NAME and name.startswith(entry.name):
+                entry.name = self._long_name(entry, lambda slot: os.pread(self.f.fileno(), ENTRY_SIZE, self.slot_offset(slot)))[0]
+            if entry.flag == 0 and entry.name == name:
+                return entry
+            b = (b + 1) & mask
+        return None
+
+    ######## lookups and reads ########
+
+    def lookup(self, name):         # active entry for name or None, O(1)
+        if self.entries is None:
+            return self._index_lookup(name)
+        slot = self.index.get(name)
+        return None if slot is None else self.entries[slot]
+
+    def find(self, name, include_deleted=False):    # like lookup, optionally falls back to files marked as deleted
+        entry = self.lookup(name)
+        if entry is None and include_deleted:
+            self._ensure_table()
+            for candidate in self.entries:
+                if candidate.flag == 1 and candidate.name == name:
+                    return candidate
+        return entry
+
+    def active_entries(self):       # (slot, entry) for every active file in slot order
+        self._ensure_table()
+        return [(slot, self.entries[slot]) for slot in sorted(self.index.values())]
+
+    def paths(self):                # PathTrie of the active files, made on first use and kept up to date on add/remove
+        self._ensure_table()
+        if self._trie is None:
+            self._trie = PathTrie(self.index)
+        return self._trie
+
+    def read_data(self, entry):     # payload bytes of an entry (without padding)
+        return os.pread(self.f.fileno(), entry.length, entry.start)
+
+    def iter_data(self, entry):
+        # the file data in chunks of at most CHUNK_SIZE bytes, decompressed on the fly if the entry is compressed
+        # (with mmap the chunks of an uncompressed entry are slices of the mapping)
+        if self._map is not None and entry.start + entry.length <= len(self._map):
+            stored = (memoryview(self._map)[pos:min(pos + CHUNK_SIZE, entry.start + entry.length)]
+                      for pos in range(entry.start, entry.start + entry.length, CHUNK_SIZE))
+        else:
+            stored = (os.pread(self.f.fileno(), min(CHUNK_SIZE, entry.start + entry.length - pos), pos)
+                      for pos in range(entry.start, entry.start + entry.length, CHUNK_SIZE))
+        if not entry.is_compressed():
+            yield from stored
+        else:
+            yield from decompress_chunks(entry.type, stored)
+
+    def read_range(self, entry, offset, length):
+        # length bytes of the file starting at offset (negative offset = counted from the end, like a[-100:])
+        # shorter if the file ends before, raw files are read with one pread, compressed ones are decompressed up to
+        # the end of the range (everything before is thrown away chunk by chunk)
+        size = entry.data_length()
+        if offset < 0:
+            offset = max(0, size + offset)
+        length = max(0, min(length, size - offset))
+        if not entry.is_compressed():
+            return os.pread(self.f.fileno(), length, entry.start + offset)
+        parts = []
+        pos = 0     # position of the next chunk in the decompressed file
+        for chunk in self.iter_data(entry):
+            if pos + len(chunk) > offset:
+                parts.append(chunk[max(0, offset - pos):offset + length - pos])
+            pos += len(chunk)
+            if pos >= offset + length:
+                break
+        return b"".join(parts)
+
+    def view(self, entry):
+        # memoryview over the payload of an entry (without padding)
+        # with mmap this is a slice of the mapping -> no copy, the data is only paged in when it is used
+        # use it as "with image.view(entry) as data:" so the view is released before the image is closed
+        end = entry.start + entry.length
+        if self._map is not None and end <= len(self._map):
+            return memoryview(self._map)[entry.start:end]
+        return memoryview(self.read_data(entry))     # no mapping -> fall back to a normal read
+
+    ######## writing ########
+
+    def _write_entry(self, slot):
+        if self._batching:
+            self._dirty_slots.add(slot)
+            return
+        os.pwrite(self.f.fileno(), self.entries[slot].pack(), self.slot_offset(slot))
+        if self.header.version == VERSION:     # keep the slot map in the header up to date
+            self._write_header()
 
-        # align data start to 64
-        start = ((header.next_free_offset + 63) // 64) * 64
+    def _write_header(self):
+        if self._batching:
+            self._dirty_header = True
+            return
+        os.pwrite(self.f.fileno(), self._header_bytes(), 0)
 
-        data_length = len(data_bytes)
-        if start + data_length > MAX_OFFSET:
-            raise RuntimeError("Data is too big for this filesystem")
+    def _header_bytes(self):        # header to write, for version 1 with the slot map of the current table
+        if self.header.version == VERSION:
+            self.header.reserved2 = pack_slot_map(self.header, self.entries)
+        return self.header.pack()
 
-        # write data and padding
-        f.seek(start)
-        f.write(data_bytes)                                                         # THIS IS DIFFERENT TO ADDFS
-        padded_length = ((data_length + 63) // 64) * 64
-        if padded_length > data_length:
-            f.write(b'\x00' * (padded_length - data_length))
+    def _write_meta(self, offset, data):
+        if self._batching:
+            self._pending_meta[offset] = data
+            return
+        os.pwrite(self.f.fileno(), data, offset)
 
-        # create file entry with provided created timestamp if given
-        new_entry = FileEntry(
+    def sync(self):                 # make everything written so far durable (postponed to the commit inside batch())
+        if self._batching or not self.durable:
+            return
+        os.fsync(self.f.fileno())
+
+    def _reload(self):              # throw away the in-memory state and read header + table from disk again
+        self.header = Header().unpack(os.pread(self.f.fileno(), HEADER_SIZE, 0))
+        self._load_table()
+
+    @contextmanager
+    def batch(self):
+        # groups several changes into one transaction:
+        # payloads are written as usual, but entries, table block headers, index buckets and the header are only
+        # written when the block ends without error (neighbouring dirty slots with one write each), through the
+        # journal: record + payloads with ONE fsync, then in place with a second fsync (see journal)
+        # so the cost of a commit doesn't depend on how many files it adds or removes -> group several changes
+        # if anything fails up to the fsync of the journal record (also that fsync itself) the table and header on
+        # disk were never touched, so none of the changes is visible, the in-memory state is reloaded and payload
+        # bytes appended at the end are cut off again
+        # if doing the writes in place fails after that, the commit is done anyway: the in-memory state stays, and
+        # the writes are done again before the next commit (or by the next open)
+        if self._batching:              # nested batch -> part of the outer one
+            yield self
+            return
+        if self._unfinished is not None:
+            apply_journal(self.f.fileno(), *self._unfinished, self.durable)
+            self._unfinished = None
+        size_before = os.fstat(self.f.fileno()).st_size
+        self._batching = True
+        committing = False
+        try:
+            yield self
+            self._batching = False
+            writes = self._table_writes(sorted(self._dirty_slots)) + sorted(self._pending_meta.items())
+            if self._dirty_header or (self._dirty_slots and self.header.version == VERSION):    # slot map is in the header
+                writes.append((0, self._header_bytes()))
+            committing = True
+            record = self._commit(writes)
+        except BaseException:
+            self._batching = False
+            self._dirty_slots.clear()
+            self._dirty_header = False
+            self._pending_meta.clear()
+            self._pending_free.clear()
+            self._pending_punch.clear()
+            self.f.truncate(size_before)
+            if committing:              # the header may already point at the record that was just cut off
+                for offset, data in pack_journal_mark(0):
+                    os.pwrite(self.f.fileno(), data, offset)
+            self._reload()
+            raise
+        self._dirty_slots.clear()
+        self._dirty_header = False
+        self._pending_meta.clear()
+        if record is not None:
+            self._unfinished = record
+            apply_journal(self.f.fileno(), *record, self.durable)
+            self._unfinished = None
+        pending_punch, self._pending_punch = self._pending_punch, []
+        for start, padded_length in pending_punch:  # only now, a crash before the commit still needs the old data
+            punch_hole(self.f.fileno(), start, padded_length)
+        pending_free, self._pending_free = self._pending_free, []
+        for start, padded_length in pending_free:   # space freed in this transaction can be reused from now on
+            self._free_extent(start, padded_length)
+
+    def _commit(self, writes):      # writes the journal record, (writes, truncate_to) to do in place once it is durable
+        fd = self.f.fileno()
+        if not writes:
+            self.sync()
+            return None
+        size = os.fstat(fd).st_size
+        journal_start = ((size + 63) // 64) * 64
+        writes = [(offset, mark_header(data, journal_start) if offset == 0 else data) for offset, data in writes]
+        os.pwrite(fd, pack_journal(writes, journal_start, size), journal_start)
+        for offset, data in pack_journal_mark(journal_start):
+            os.pwrite(fd, data, offset)
+        if self.durable:
+            os.fsync(fd)                # payloads + record + mark are on disk, the commit is done
+        return writes, size
+
+    def _table_writes(self, slots):     # (offset, bytes) with one write per run of neighbouring slots in the same block
+        writes = []
+        run_start = 0
+        for i in range(1, len(slots) + 1):
+            if i == len(slots) or slots[i] != slots[i - 1] + 1 or self.slot_offset(slots[i]) != self.slot_offset(slots[i - 1]) + ENTRY_SIZE:
+                run = slots[run_start:i]
+                writes.append((self.slot_offset(run[0]), b"".join(self.entries[slot].pack() for slot in run)))
+                run_start = i
+        return writes
+
+    ######## free space ########
+
+    def _build_free_space(self):
+        # free-extent map + free-slot lists, built from the table whenever it is (re)loaded
+        # free extents are the gaps between the data of active files below next_free_offset, so space of deleted
+        # files counts as free, and so does what is left over when a smaller file was put into a bigger hole
+        self.free_extents = []      # sorted [start, length] pairs, 64-byte aligned
+        cursor = self.header.data_start_offset
+        for start, padded_length in sorted(self._live_extents()):
+            if start > cursor:
+                self.free_extents.append([cursor, start - cursor])
+            cursor = max(cursor, start + padded_length)
+        if self.header.next_free_offset > cursor:
+            self.free_extents.append([cursor, ((self.header.next_free_offset + 63) // 64) * 64 - cursor])
+        self.empty_slots = [slot for slot, entry in enumerate(self.entries) if entry.is_empty()]     # sorted
+        self.deleted_slots = [slot for slot, entry in enumerate(self.entries) if entry.flag == 1]   # sorted
+        self._used_end = max((slot + 1 for slot, entry in enumerate(self.entries) if not entry.is_empty()), default=0)
+
+    def _live_extents(self):        # (start, padded_length) of the data of every active file + table blocks/index
+        return [(entry.start, ((entry.length + 63) // 64) * 64) for slot, entry in self.active_entries() if entry.length > 0] + self._meta_extents()
+
+    def _best_fit(self, padded_length):     # index of the smallest free extent that fits, or None
+        best = None
+        for i, (start, length) in enumerate(self.free_extents):
+            if length >= padded_length and (best is None or length < self.free_extents[best][1]):
+                best = i
+        return best
+
+    def _take_space(self, padded_length):
+        # best-fit free extent (space of deleted files), if nothing fits it is appended at next_free_offset
+        # returns the start offset, raises ValueError if it doesn't fit in the filesystem anymore
+        header = self.header
+        hole = self._best_fit(padded_length) if padded_length > 0 and not self.append_only else None
+        if hole is None:
+            start = ((header.next_free_offset + 63) // 64) * 64     # next 64-aligned offset, works even if already aligned
+            if start + padded_length >= MAX_OFFSET:     # 4GB, next_free_offset has to fit in 4 bytes
+                raise ValueError("Data is too big for this filesystem")
+            header.next_free_offset = max(header.next_free_offset, start + padded_length)
+            return start
+
+        start = self.free_extents[hole][0]
+        if self.free_extents[hole][1] == padded_length:
+            self.free_extents.pop(hole)
+        else:
+            self.free_extents[hole] = [start + padded_length, self.free_extents[hole][1] - padded_length]
+        for other in list(self.deleted_slots):  # deleted files whose data gets overwritten can't be recovered anymore
+            entry = self.entries[other]
+            if entry.start < start + padded_length and start < entry.start + entry.length:
+                self._reap(other)
+        return start
+
+    def _free_extent(self, start, padded_length):   # give data space back to the free-extent map, merging neighbours
+        if padded_length == 0:
+            return
+        if self._batching:          # the old data is still referenced on disk until the commit
+            self._pending_free.append((start, padded_length))
+            return
+        i = bisect.bisect_left(self.free_extents, [start, 0])
+        self.free_extents.insert(i, [start, padded_length])
+        if i + 1 < len(self.free_extents) and start + padded_length == self.free_extents[i + 1][0]:
+            self.free_extents[i][1] += self.free_extents.pop(i + 1)[1]
+        if i > 0 and self.free_extents[i - 1][0] + self.free_extents[i - 1][1] == start:
+            self.free_extents[i - 1][1] += self.free_extents.pop(i)[1]
+
+    def _reap(self, slot):          # wipe a deleted entry (its slot or its data is being reused), slot becomes empty
+        self.deleted_slots.remove(slot)
+        self.entries[slot] = FileEntry(created=0)
+        self.header.deleted_files = max(0, self.header.deleted_files - 1)
+        self._write_entry(slot)
+        bisect.insort(self.empty_slots, slot)
+        self._free_name_slots(slot)
+        while self._used_end > 0 and self.entries[self._used_end - 1].is_empty():
+            self._used_end -= 1
+
+    def _free_name_slots(self, slot):   # the name slots of a file whose entry was wiped become empty
+        for name_slot in self._name_slots.pop(slot, []):
+            self.entries[name_slot] = FileEntry(created=0)
+            self._write_entry(name_slot)
+            bisect.insort(self.empty_slots, name_slot)
+
+    def _update_free_entry_offset(self):
+        # free_entry_offset always points at the first slot of the empty tail of the table (what Java's addfs expects),
+        # empty slots below it (left by reaped entries) are only reused through the free-slot list
+        header = self.header
+        header.free_entry_offset = self.slot_offset(self._used_end) if self._used_end < header.file_capacity else 0
+        header.flags = 1 if header.free_entry_offset == 0 else 0
+
+    ######## add / remove ########
+
+    def _reserve(self, file_name, data_length):
+        # checks that file_name can be added with data_length bytes and picks where it goes
+        # slot: see _reserve_slot
+        # data: see _take_space
+        # returns (slot, start, padded_length), raises ValueError if it can't be added
+        slot = self._reserve_slot(file_name)
+        padded_length = ((data_length + 63) // 64) * 64
+        try:
+            start = self._take_space(padded_length)
+        except ValueError:      # the slots are still empty, so a batch that goes on after this error stays consistent
+            self._release_slots([slot] + self._reserved_names.pop(slot, []))
+            raise
+        return slot, start, padded_length
+
+    def _check_name(self, file_name):
+        # raises ValueError if file_name can't be added: empty, too long for the version, not a clean relative path,
+        # already there, or it would make a name a file and a directory at the same time
+        name_bytes = file_name.encode("utf-8")
+        limit = NAME_BYTES if self.header.version == VERSION else MAX_PATH_BYTES
+        if not name_bytes:
+            raise ValueError("file name must contain at least one character.")
+        if b"\x00" in name_bytes:
+            raise ValueError("file name can't contain null bytes.")
+        if len(name_bytes) > limit:
+            raise ValueError(f"file name is too long in bytes (max {limit} bytes in UTF-8).")
+        check_path(file_name)
+        if file_name in self.index:
+            raise ValueError(f"file '{file_name}' already exists in filesystem.")
+        clashes = self._clashes(file_name)
+        if clashes:
+            raise ValueError(f"'{file_name}' clashes with '{clashes[0]}' in filesystem (a name can't be a file and a directory).")
+
+    def _clashes(self, file_name):
+        # active files in the way of file_name: files named like one of its directories ("a" for "a/b.txt"),
+        # files in a directory named file_name ("a/b.txt" for "a")
+        parts = file_name.split(PATH_SEP)
+        clashes = [PATH_SEP.join(parts[:i]) for i in range(1, len(parts)) if PATH_SEP.join(parts[:i]) in self.index]
+        node = self.paths().node(file_name)
+        if node is not None:
+            clashes.extend(name for name, slot in node.walk(file_name + PATH_SEP))
+        return clashes
+
+    def _reserve_slot(self, file_name):
+        # checks file_name and picks its slot, a name longer than NAME_BYTES also gets its name slots here
+        # (kept in _reserved_names until _commit_add writes them), raises ValueError if there is no room
+        self._check_name(file_name)
+        slot = self._take_slot()
+        name_slots = []
+        try:
+            for _ in range(0, len(split_name(file_name.encode("utf-8"))[1]), NAME_PIECE):
+                name_slots.append(self._take_slot())
+        except ValueError:
+            self._release_slots([slot] + name_slots)
+            raise
+        if name_slots:
+            self._reserved_names[slot] = name_slots
+        return slot
+
+    def _release_slots(self, slots):    # slots taken by _take_slot that are not used after all
+        for slot in slots:
+            bisect.insort(self.empty_slots, slot)
+
+    def _take_slot(self):
+        # lowest empty slot, then the lowest slot of a deleted file, then (version 2) a new table block
+        if not self.empty_slots and not self.deleted_slots:
+            self._grow_table()
+
+        if self.empty_slots:
+            slot = self.empty_slots.pop(0)
+        else:
+            slot = self.deleted_slots[0]
+            self._reap(slot)
+            self.empty_slots.remove(slot)
+        self._used_end = max(self._used_end, slot + 1)
+        return slot
+
+    def _pad(self, start, data_length, padded_length):     # zero padding up to the 64-byte boundary
+        zero_fill(self.f.fileno(), start + data_length, padded_length - data_length)
+
+    def _commit_add(self, slot, file_name, start, data_length, created_ts, crc=None, codec_type=TYPE, raw_length=None):
+        # data is already written -> create the file entry and update the header
+        entry = FileEntry(
             name=file_name,
             start=start,
             length=data_length,
             flag=0,
-            created=(created_ts if created_ts is not None else int(time.time()))    # THIS IS DIFFERENT TO ADDFS
+            created=(created_ts if created_ts is not None else int(time.time()))
         )
+        if crc is not None:
+            entry.set_checksum(crc)
+        if codec_type != TYPE:
+            entry.set_compressed(codec_type, raw_length)
+        name_slots = self._reserved_names.pop(slot, [])
+        if name_slots:      # the part of the name that doesn't fit in the entry
+            rest = split_name(file_name.encode("utf-8"))[1]
+            for i, name_slot in enumerate(name_slots):
+                next_slot = name_slots[i + 1] if i + 1 < len(name_slots) else None
+                self.entries[name_slot] = NameSlot(rest[i * NAME_PIECE:(i + 1) * NAME_PIECE], next_slot)
+                self._write_entry(name_slot)
+            entry.set_name_slot(name_slots[0])
+            self._name_slots[slot] = name_slots
+        self.entries[slot] = entry
+        self.index[file_name] = slot
+        if self._trie is not None:
+            self._trie.insert(file_name, slot)
+        self._add_ref(entry)
+        self._index_insert(file_name, slot)
+        self._write_entry(slot)
+
+        self.header.file_count += 1      # update header values
+        self._update_free_entry_offset()
+        self._write_header()
+        return slot, entry
+
+    def add_bytes(self, file_name, data_bytes, created_ts=None, checksum=True, compress=None, dedup=False):
+        # add file into the image, raises ValueError if it can't be added
+        # checksum=True stores the crc32 of the stored data in the entry (checked by fsckfs)
+        # compress="zlib"/"lzma" stores the data compressed, but only if that makes it smaller
+        # dedup=True points the new entry at the data of an existing file with the same bytes instead of
+        # writing them again (the checksum is always stored then, it is what finds the other file)
+        # returns (slot, entry) of the new file entry
+        if file_name in self.index:
+            raise ValueError(f"file '{file_name}' already exists in filesystem.")
+        raw_length = len(data_bytes)
+        codec_type = TYPE
+        if compress:
+            c = compressor(CODECS[compress])
+            packed = c.compress(data_bytes) + c.flush()
+            if len(packed) < raw_length:        # doesn't pay off -> keep the raw bytes
+                codec_type, data_bytes = CODECS[compress], packed
+
+        with self.batch():
+            data_length = len(data_bytes)
+            crc = zlib.crc32(data_bytes) if checksum or dedup else None
+            start = self._find_duplicate(crc, data_length, codec_type, lambda pos, n: data_bytes[pos:pos + n]) if dedup else None
+            if start is not None:
+                slot = self._reserve_slot(file_name)
+            else:
+                slot, start, padded_length = self._reserve(file_name, data_length)
+                os.pwrite(self.f.fileno(), data_bytes, start)   # write data and padding
+                self._pad(start, data_length, padded_length)
+            return self._commit_add(slot, file_name, start, data_length, created_ts, crc, codec_type, raw_length)
+
+    def add_file(self, file_name, src, created_ts=None, checksum=True, compress=None, dedup=False):
+        # like add_bytes, but streams the data from an open host file (binary mode) instead of holding it in memory
+        # the copy is done in the kernel if possible (copy_file_range/sendfile), otherwise in CHUNK_SIZE pieces,
+        # with checksum=True the crc32 is computed afterwards from what was written to the image (a second read,
+        # but it usually comes from the page cache, and the copy itself can stay in the kernel)
+        # with compress the file is first compressed chunk by chunk into a temporary file, so the compressed size
+        # is known before space is picked for it
+        # with dedup the file is read once more up front to get the checksum that finds a possible duplicate
+        if file_name in self.index:
+            raise ValueError(f"file '{file_name}' already exists in filesystem.")
+        src_fd = src.fileno()
+        raw_length = os.fstat(src_fd).st_size
+        codec_type = TYPE
+        data_length = raw_length
+        packed = None
+        try:
+            if compress:
+                import tempfile
+                packed = tempfile.TemporaryFile()
+                c = compressor(CODECS[compress])
+                for pos in range(0, raw_length, CHUNK_SIZE):
+                    packed.write(c.compress(os.pread(src_fd, CHUNK_SIZE, pos)))
+                packed.write(c.flush())
+                packed.flush()
+                if packed.tell() < raw_length:  # doesn't pay off -> keep the raw bytes
+                    codec_type, data_length, src_fd = CODECS[compress], packed.tell(), packed.fileno()
+
+            dedup_crc = range_checksum(src_fd, 0, data_length) if dedup else None
+            with self.batch():
+                start = self._find_duplicate(dedup_crc, data_length, codec_type, lambda pos, n: os.pread(src_fd, n, pos)) if dedup else None
+                if start is not None:
+                    slot = self._reserve_slot(file_name)
+                    crc = dedup_crc
+                else:
+                    slot, start, padded_length = self._reserve(file_name, data_length)
+                    copy_range(src_fd, self.f.fileno(), 0, start, data_length)
+                    self._pad(start, data_length, padded_length)
+                    crc = range_checksum(self.f.fileno(), start, data_length) if checksum or dedup else None
+                return self._commit_add(slot, file_name, start, data_length, created_ts, crc, codec_type, raw_length)
+        finally:
+            if packed is not None:
+                packed.close()
+
+    def remove(self, file_name, punch=False):
+        # mark active file as deleted, returns its entry or None if not found
+        # punch=True: the data space is given back to the host filesystem right away (punch_hole after the commit),
+        # the file can't be recovered with getfs anymore, so its entry is wiped instead of marked as deleted
+        if file_name not in self.index:
+            return None
+        with self.batch():
+            slot = self.index.pop(file_name)
+            if self._trie is not None:
+                self._trie.remove(file_name)
+            entry = self.entries[slot]
+            entry.mark_deleted()
+            padded_length = ((entry.length + 63) // 64) * 64
+            if self._drop_ref(entry):                               # data space can be reused, unless
+                self._free_extent(entry.start, padded_length)       # other files still share it
+                if punch and padded_length:
+                    self._pending_punch.append((entry.start, padded_length))
+                    self.entries[slot] = FileEntry(created=0)
+                    bisect.insort(self.empty_slots, slot)
+                    self._free_name_slots(slot)
+                    for other in list(self.deleted_slots):     # older deleted files in that space are gone too
+                        if self.entries[other].start < entry.start + padded_length and entry.start < self.entries[other].start + self.entries[other].length:
+                            self._reap(other)
+            if self.entries[slot] is entry:
+                bisect.insort(self.deleted_slots, slot)             # slot can be reused
+                self.header.deleted_files += 1
+            self._write_entry(slot)
+            self.header.file_count -= 1
+            self._write_header()
+        return entry
+
+    ######## export stream ########
+
+    def export(self, out, since=0):
+        # writes the active files to the binary stream out (see EXPORT_RECORD_FMT), returns the nb of files with data
+        # since > 0: incremental, only files created at or after since (same second included, a file added right
+        # after the previous export started is not missed) get their data, the others are only listed as kept
+        # files sharing data (dedup) are linked to the first record with that data instead of being sent again
+        out.write(struct.pack(EXPORT_HEADER_FMT, EXPORT_MAGIC, self.header.version, since))
+        sent = {}       # start of extent -> nb of the record that sent its data
+        records = 0
+        files = 0
+        for slot, entry in self.active_entries():
+            name = entry.name.encode("utf-8")
+            if len(name) > NAME_BYTES:      # the record has room for NAME_BYTES, the whole name goes before it
+                out.write(struct.pack(EXPORT_RECORD_FMT, EXPORT_PATH, b"", 0, 0, 0, len(name), 0, 0) + name)
+                name = split_name(name)[0]
+            crc = entry.checksum()
+            fields = (name, entry.type, crc is not None, entry.created, entry.length, entry.data_length(), crc or 0)
+            if since and entry.created < since:
+                out.write(struct.pack(EXPORT_RECORD_FMT, EXPORT_KEEP, *fields))
+            elif entry.length > 0 and entry.start in sent:
+                out.write(struct.pack(EXPORT_RECORD_FMT, EXPORT_LINK, name, entry.type, crc is not None, entry.created,
+                                      sent[entry.start], entry.data_length(), crc or 0))
+            else:
+                out.write(struct.pack(EXPORT_RECORD_FMT, EXPORT_FILE, *fields))
+                for pos in range(0, entry.length, CHUNK_SIZE):      # stored bytes as they are, chunk by chunk
+                    out.write(os.pread(self.f.fileno(), min(CHUNK_SIZE, entry.length - pos), entry.start + pos))
+                if entry.length > 0:    # an empty file's start can be where the next file's data is
+                    sent.setdefault(entry.start, records)
+            if not since or entry.created >= since:
+                files += 1
+            records += 1
+        out.write(struct.pack(EXPORT_RECORD_FMT, EXPORT_END, b"", 0, 0, 0, records, 0, 0))
+        return files
+
+    def import_stream(self, inp, header=None, replace=False):
+        # loads an export stream from the binary stream inp in ONE transaction (one table write for all files)
+        # the files of the stream are added next to the files of the image, a name that is already there is an error
+        # replace=True: files of the stream replace files with the same name, files of the image that are not in the
+        # stream (neither sent nor kept) are removed, so afterwards the image has the same files as the exported one
+        # header = (version, since) if the stream header was already read with read_export_header
+        # returns (nb of files loaded, nb of files removed), raises ValueError for a broken or incomplete stream or
+        # an incremental stream whose older files are not in the image (nothing is changed then)
+        if header is None:
+            read_export_header(inp)
+        record_size = struct.calcsize(EXPORT_RECORD_FMT)
+        records = []        # (start, stored length) of every record, for links
+        names = set()
+        long_name = None    # name of the next record, from an EXPORT_PATH record
+        loaded = 0
+        with self.batch():
+            while True:
+                kind, raw_name, codec_type, has_crc, created, length, raw_length, crc = struct.unpack(EXPORT_RECORD_FMT, read_stream(inp, record_size))
+                name = raw_name.split(b"\x00", 1)[0].decode("utf-8", errors="ignore")
+                if kind == EXPORT_END:
+                    if length != len(records) or long_name is not None:
+                        raise ValueError("export stream is incomplete.")
+                    break
+                if kind == EXPORT_PATH:
+                    if long_name is not None or length > MAX_PATH_BYTES:
+                        raise ValueError("export stream is broken.")
+                    long_name = read_stream(inp, length).decode("utf-8", errors="ignore")
+                    continue
+                if long_name is not None:
+                    name, long_name = long_name, None
+                if kind not in (EXPORT_FILE, EXPORT_LINK, EXPORT_KEEP) or not name or name in names:
+                    raise ValueError("export stream is broken.")
+                check_path(name)
+                names.add(name)
+                if kind == EXPORT_KEEP:
+                    if name not in self.index:
+                        raise ValueError(f"'{name}' is not in the filesystem, the incremental export needs the files of the previous one.")
+                    records.append(None)
+                    continue
+                if replace:
+                    for other in self._clashes(name):   # e.g. a file that became a directory, gone from the stream
+                        if other not in names:
+                            self.remove(other)
+                    self.remove(name)   # replaced by the one from the stream
+                if kind == EXPORT_LINK:
+                    if length >= len(records) or records[length] is None:
+                        raise ValueError("export stream is broken.")
+                    start, length = records[length]
+                    slot = self._reserve_slot(name)
+                else:
+                    slot, start, padded_length = self._reserve(name, length)
+                    for pos in range(0, length, CHUNK_SIZE):
+                        os.pwrite(self.f.fileno(), read_stream(inp, min(CHUNK_SIZE, length - pos)), start + pos)
+                    self._pad(start, length, padded_length)
+                    written = range_checksum(self.f.fileno(), start, length)
+                    if has_crc and written != crc:
+                        raise ValueError(f"checksum of '{name}' in the export stream is wrong.")
+                    crc = written
+                self._commit_add(slot, name, start, length, created, crc, codec_type, raw_length)
+                records.append((start, length))
+                loaded += 1
+            removed = [name for name in list(self.index) if name not in names] if replace else []
+            for name in removed:
+                self.remove(name)
+        return loaded, len(removed)
+
+    ######## deduplication ########
+    # files with the same bytes can share one data extent: their entries simply have the same start
+    # the table is the only record of that, the nb of active entries per extent (reference count) and the
+    # content -> extent dict are rebuilt from it whenever the table is loaded, so nothing can get out of sync
+
+    def _build_dedup_index(self):
+        self._extent_refs = {}      # start -> nb of active entries using the extent
+        self._dedup = {}            # (crc32, stored length, type) -> starts of extents with that content, only for files with a checksum
+        for slot, entry in self.active_entries():
+            self._add_ref(entry)
+
+    def _add_ref(self, entry):
+        if entry.length == 0:
+            return
+        refs = self._extent_refs.get(entry.start, 0)
+        self._extent_refs[entry.start] = refs + 1
+        if refs == 0 and entry.checksum() is not None:     # new extent
+            self._dedup.setdefault((entry.checksum(), entry.length, entry.type), []).append(entry.start)
+
+    def _drop_ref(self, entry):     # True if no other active entry uses the data of entry anymore
+        if entry.length == 0:
+            return True
+        refs = self._extent_refs.get(entry.start, 1) - 1
+        if refs > 0:
+            self._extent_refs[entry.start] = refs
+            return False
+        self._extent_refs.pop(entry.start, None)
+        key = (entry.checksum(), entry.length, entry.type)
+        starts = self._dedup.get(key, [])
+        if entry.start in starts:   # other extents with the same content (added without dedup) can still be found
+            starts.remove(entry.start)
+            if not starts:
+                del self._dedup[key]
+        return True
+
+    def shared_refs(self, entry):   # nb of active entries (entry included) that use the data of entry
+        return self._extent_refs.get(entry.start, 0) if entry.length else 0
+
+    def _find_duplicate(self, crc, length, codec_type, read_chunk):
+        # start of an existing extent with exactly the same bytes, or None
+        # the checksum only picks the candidates, the bytes are compared chunk by chunk to be sure
+        # read_chunk(pos, n) returns n bytes of the new data starting at pos
+        fd = self.f.fileno()
+        for start in (self._dedup.get((crc, length, codec_type), []) if length else []):
+            if all(os.pread(fd, min(CHUNK_SIZE, length - pos), start + pos) == read_chunk(pos, min(CHUNK_SIZE, length - pos))
+                   for pos in range(0, length, CHUNK_SIZE)):
+                return start
+        return None
+
+    ######## verification ########
+
+    def verify(self, workers=None):
+        # checks the crc32 of every active file that has one, spread over a thread pool
+        # (every worker reads with os.pread, so they don't share a file position)
+        # returns (ok, corrupt, unchecked): lists of entries
+        fd = self.f.fileno()
+        image_size = os.fstat(fd).st_size
+
+        def check(entry):
+            if entry.start + entry.length > image_size:
+                return False
+            try:
+                return range_checksum(fd, entry.start, entry.length) == entry.checksum()
+            except ValueError:
+                return False
+
+        entries = [entry for slot, entry in self.active_entries()]
+        checked = [entry for entry in entries if entry.checksum() is not None]
+        unchecked = [entry for entry in entries if entry.checksum() is None]
+        ok, corrupt = [], []
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for entry, good in zip(checked, pool.map(check, checked)):
+                (ok if good else corrupt).append(entry)
+        return ok, corrupt, unchecked
+
+    ######## extraction ########
+
+    def extract(self, entry, out_path):    # write the (decompressed) data of an entry into a host file
+        with open(out_path, "wb") as out:
+            if entry.is_compressed():
+                for chunk in self.iter_data(entry):
+                    out.write(chunk)
+            else:
+                copy_range(self.f.fileno(), out.fileno(), entry.start, 0, entry.length)
+
+    def extract_all(self, dest_dir, workers=None):
+        # writes every active file into dest_dir, several files at once in a thread pool
+        # the table is only read once and every worker reads with os.pread, so they don't share a file position
+        # returns the list of written host paths (in slot order)
+        dest_dir = Path(dest_dir)
+        dest_dir.mkdir(parents=True, exist_ok=True)
+        jobs = []
+        for slot, entry in self.active_entries():
+            jobs.append((entry, dest_dir / host_path(entry.name)))     # names written by other tools must not escape dest_dir
+        for parent in sorted({path.parent for entry, path in jobs}):   # directories of the files first
+            parent.mkdir(parents=True, exist_ok=True)
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(lambda job: self.extract(*job), jobs))   # list() -> errors of the workers are raised here
+        return [path for entry, path in jobs]
+
+    ######## defragmentation ########
+
+    def _move_range(self, src_offset, dst_offset, length):
+        # copies data inside the image with one CHUNK_SIZE buffer
+        # copying front to back is safe even if source and destination overlap, as long as the data moves towards
+        # the start of the image (dst_offset <= src_offset): every byte is read before anything is written over it
+        fd = self.f.fileno()
+        moved = 0
+        while moved < length:
+            chunk = os.pread(fd, min(length - moved, CHUNK_SIZE), src_offset + moved)
+            os.pwrite(fd, chunk, dst_offset + moved)
+            moved += len(chunk)
+
+    def compact(self):
+        # in-place defragmentation, every step is a commit, so a crash at any point leaves a valid image:
+        # 1. deleted entries are dropped
+        # 2. active files slide towards data_start_offset in offset order. Data is only ever copied over space that
+        #    no entry on disk points at: before a file is copied over the old place of a file whose move isn't
+        #    committed yet, the moves so far are committed (new start of their entries). A file that would
+        #    overlap its own old place is first copied behind the end of the image and committed there.
+        #    Usually that means only a few commits, no matter how many files are moved.
+        # 3. active entries move to the first slots, table + hash index + header are rewritten in one commit,
+        #    the image is cut after the last file
+        # table blocks and the hash index of a version 2 image stay where they are, files are moved around them
+        # returns (nb of deleted entries dropped, their data bytes)
+        header = self.header
+        deleted = [entry for entry in self.entries if entry.flag == 1]
+        try:
+            with self.batch():      # 1.
+                keep = set(self.index.values())
+                keep.update(name_slot for slot in self.index.values() for name_slot in self._name_slots.get(slot, []))
+                for slot, entry in enumerate(self.entries):
+                    if not entry.is_empty() and slot not in keep:   # deleted (or a stray duplicate) and their name slots
+                        self.entries[slot] = FileEntry(created=0)
+                        self._write_entry(slot)
+                self._name_slots = {slot: name_slots for slot, name_slots in self._name_slots.items() if slot in keep}
+                header.deleted_files = 0
+                self._write_header()
+
+            cursor = self._compact_moves()      # 2.
+
+            with self.batch():      # 3.
+                on_disk = b"".join(raw for block, raw in self._walk_blocks(with_slots=True))
+                active = self.active_entries()
+                entries = [entry for slot, entry in active]
+                name_slots = {}
+                for new_slot, (slot, entry) in enumerate(active):   # name slots follow the active entries
+                    pieces = [self.entries[name_slot] for name_slot in self._name_slots.get(slot, [])]
+                    if pieces:
+                        name_slots[new_slot] = list(range(len(entries), len(entries) + len(pieces)))
+                        entry.set_name_slot(len(entries))
+                        for piece in pieces:
+                            piece.set_next(len(entries) + 1 if piece is not pieces[-1] else None)
+                            entries.append(piece)
+                self.entries = entries + [FileEntry(created=0) for _ in range(header.file_capacity - len(entries))]
+                self._name_slots = name_slots
+                self._trie = None
+                self.index = {entry.name: slot for slot, entry in enumerate(self.entries) if entry.flag == 0 and entry.name}
+                for slot, entry in enumerate(self.entries):
+                    if entry.pack() != on_disk[slot * ENTRY_SIZE:(slot + 1) * ENTRY_SIZE]:  # incl. moves not committed yet
+                        self._write_entry(slot)
+                if self._buckets is not None:   # slots changed -> same index space, new content
+                    self._buckets = self._build_buckets(len(self._buckets))
+                    self._buckets_used = len(self.index)
+                    self._write_meta(header.index_location()[0], self._buckets_bytes(self._buckets))
+                header.file_count = len(active)
+                header.next_free_offset = max([cursor] + [start + length for start, length in self._meta_extents()])
+                self._build_free_space()
+                self._update_free_entry_offset()
+                self._write_header()
+        except BaseException:
+            self._reload()      # in-memory state may be half way, disk is always consistent
+            raise
+        self.f.truncate(header.next_free_offset)
+        self._build_free_space()
+        self._build_dedup_index()
+        return len(deleted), sum(entry.length for entry in deleted)
+
+    def _compact_moves(self):   # step 2 of compact, returns the end of the moved data
+        header = self.header
+        pinned = sorted(self._meta_extents())
+        fd = self.f.fileno()
+        bounce = ((max([os.fstat(fd).st_size, header.next_free_offset] + [s + l for s, l in pinned]) + 63) // 64) * 64
+        sharing = {}        # start -> slots of the files using that data (several with dedup)
+        for slot, entry in self.active_entries():
+            sharing.setdefault(entry.start if entry.length else None, []).append(slot)
+        empty = sharing.pop(None, [])
+
+        cursor = header.data_start_offset
+        moved_slots = []    # entries moved since the last commit
+        uncommitted = []    # (old start, padded length) of their data, on disk the entries still point there
+
+        def commit():
+            with self.batch():
+                for slot in moved_slots:
+                    self._write_entry(slot)
+                self._write_header()
+            moved_slots.clear()
+            uncommitted.clear()
+
+        for start in sorted(sharing):       # offset order -> destination is never after the source
+            slots = sharing[start]
+            length = self.entries[slots[0]].length
+            padded_length = ((length + 63) // 64) * 64
+            for pin_start, pin_length in pinned:    # skip table blocks/index the file would overlap
+                if pin_start < cursor + padded_length and cursor < pin_start + pin_length:
+                    cursor = pin_start + pin_length
+            if start == cursor:
+                cursor += padded_length
+                continue
+            if cursor + padded_length > start:      # overlaps its own old place -> copy it behind the image first
+                self._move_range(start, bounce, length)
+                for slot in slots:
+                    self.entries[slot].start = bounce
+                moved_slots.extend(slots)
+                header.next_free_offset = max(header.next_free_offset, bounce + padded_length)
+                commit()
+                start, bounce = bounce, bounce + padded_length
+            elif any(old < cursor + padded_length and cursor < old + old_length for old, old_length in uncommitted):
+                commit()
+            self._move_range(start, cursor, length)
+            self._pad(cursor, length, padded_length)
+            for slot in slots:
+                self.entries[slot].start = cursor
+            moved_slots.extend(slots)
+            uncommitted.append((start, padded_length))
+            cursor += padded_length
+        for slot in empty:
+            self.entries[slot].start = cursor
+        return cursor
 
-        # write entry into file table
-        f.seek(file_entry_index)
-        f.write(new_entry.pack())
 
-        # update header values
-        header.file_count += 1
-        # compute next free entry offset
-        next_entry_offset = file_entry_index + ENTRY_SIZE
-        header.free_entry_offset = next_entry_offset if next_entry_offset < header.data_start_offset else 0
-        header.next_free_offset = start + padded_length
-        header.flags = 1 if header.free_entry_offset == 0 else 0
+######################### helper function ##############################
 
-        # write header back
-        f.seek(0)
-        f.write(header.pack())
-        f.flush()
-        os.fsync(f.fileno())
+def recover_image(fs_name, lock_timeout=None):     # finishes an interrupted commit, needs write access to the image
+    try:
+        ZvfsImage(fs_name, writable=True, lock_timeout=lock_timeout).close()
+    except PermissionError:
+        raise ValueError(f"{fs_name} has an unfinished commit, open it once with write access to repair it.")
+
+
+def open_image(fs_name, **options):
+    # opens the image for a command, waits at most LOCK_TIMEOUT seconds for other processes using it
+    # prints the error and returns None if it can't be opened (bad format, locked)
+    try:
+        return ZvfsImage(fs_name, lock_timeout=LOCK_TIMEOUT, **options)
+    except ValueError as e:
+        print(f"Error: {e}")
+        return None
+
+
+def addfs_bytes(fs_name, file_name, data_bytes, created_ts=None):
+    # helper for dfrgfs -> does the re-adding of active files to filesystem
+    # add file into existing filesystem and preserve created_ts
+
+    # assume fs exists
+    image = open_image(fs_name, writable=True)
+    if image is None:
+        return
+    with image:
+        try:
+            image.add_bytes(file_name, data_bytes, created_ts)
+        except ValueError as e:
+            print(f"Error: {e}")
+
+
+######################### stats ##############################
+
+_stats_cache = {}   # image path -> (stat key, result), so asking again about an unchanged image costs one os.stat
+
+def stats(fs_name, files=True):
+    # machine-readable info about an image as a dict (ready for json.dumps): header values, space used,
+    # and with files=True the active files
+    # a version 1 image is read with ONE read of header + table, the result is reused while the image file is
+    # unchanged (same inode, size and modification time), don't modify the returned dict
+    # raises ValueError/OSError if the image can't be read
+    st = os.stat(fs_name)
+    key = (st.st_ino, st.st_size, st.st_mtime_ns, files)
+    cached = _stats_cache.get(fs_name)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+
+    with ZvfsImage(fs_name, lock_timeout=LOCK_TIMEOUT) as image:
+        header = image.header
+        summary = table_summary(image.raw_table)
+        result = {
+            "filesystem": fs_name,
+            "version": header.version,
+            "capacity": header.file_capacity,
+            "files_present": len(summary["active"]),
+            "free_entries": summary["empty"],
+            "deleted_files": summary["deleted"],
+            "total_space_used": summary["total_size"],
+            "free_space": sum(length for start, length in image.free_extents),
+            "next_free_offset": header.next_free_offset,
+            "image_size": st.st_size,
+        }
+        if files:
+            result["files"] = [{"name": entry.name, "size": entry.data_length(), "stored": entry.length,
+                                "offset": entry.start, "created": entry.created, "compressed": entry.is_compressed()}
+                               for entry in (image.entries[slot] for slot in summary["active"])]
+    _stats_cache[fs_name] = (key, result)
+    return result
+
+
+def _stats_or_error(fs_name, files=True):    # for stats_many: an image that can't be read doesn't stop the scan
+    try:
+        return stats(fs_name, files)
+    except (ValueError, OSError) as e:
+        return {"filesystem": fs_name, "error": str(e)}
+
+
+def stats_many(fs_names, files=False, workers=None):
+    # stats of many images, the ones that changed since the last call are read in parallel by a process pool
+    # (workers = nb of processes, default nb of CPUs), returns the results in the order of fs_names
+    results = {}
+    todo = []
+    for fs_name in fs_names:
+        try:
+            st = os.stat(fs_name)
+            cached = _stats_cache.get(fs_name)
+            if cached is not None and cached[0] == (st.st_ino, st.st_size, st.st_mtime_ns, files):
+                results[fs_name] = cached[1]
+                continue
+        except OSError:
+            pass
+        todo.append(fs_name)
+    if len(todo) > 1 and workers != 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for fs_name, result in zip(todo, pool.map(_stats_or_error, todo, [files] * len(todo))):
+                results[fs_name] = result
+                if "error" not in result:   # the worker's cache is gone with it, keep the result here
+                    st = os.stat(fs_name)
+                    if st.st_size == result["image_size"]:
+                        _stats_cache[fs_name] = ((st.st_ino, st.st_size, st.st_mtime_ns, files), result)
+    else:
+        for fs_name in todo:
+            results[fs_name] = _stats_or_error(fs_name, files)
+    return [results[fs_name] for fs_name in fs_names]
+
+
+def print_json(data):
+    print(json.dumps(data, indent=2))
+
+
+######################### log-structured ingest ##############################
+
+class IngestWriter:
+    # for many small files arriving one after the other: the image stays open (exclusive lock), the data of every
+    # file is appended at the end of the data region, and the entries and the header are written together
+    # (one journal commit) only every interval seconds or every flush_bytes bytes of data, by add() or by a
+    # background thread, instead of one commit with 2 fsyncs per file
+    # fsync policy: "always" = every file is committed and fsync'ed before add returns (like addfs),
+    #               "interval" = a flush fsyncs, files added since the last flush are lost if the process or the
+    #                            machine crashes, but the image stays valid
+    #               "never" = a flush goes through the journal without fsync (still safe if the process crashes,
+    #                         the OS decides when the data reaches the disk)
+    # a file that can't be added only raises for that file, the others stay pending
+    # use it as "with IngestWriter(fs_name) as writer:", close() flushes what is pending
+    FSYNC_POLICIES = ("always", "interval", "never")
+
+    def __init__(self, fs_name, fsync="interval", interval=1.0, flush_bytes=4 * 1024 * 1024, lock_timeout=LOCK_TIMEOUT):
+        # raises ValueError for a bad policy or an image that can't be opened
+        if fsync not in self.FSYNC_POLICIES:
+            raise ValueError(f"unknown fsync policy {fsync!r} (always, interval or never).")
+        self.image = ZvfsImage(fs_name, writable=True, lock_timeout=lock_timeout)
+        self.image.append_only = True
+        self.image.durable = fsync != "never"
+        self.fsync = fsync
+        self.interval = interval
+        self.flush_bytes = flush_bytes
+        import threading
+        self.lock = threading.Lock()
+        self.pending_files = 0
+        self.pending_bytes = 0
+        self.flushes = 0
+        self._batch = None          # open image.batch() that collects the pending files
+        self._last_flush = time.monotonic()
+        self._stop = threading.Event()
+        self._flusher = None
+        if fsync != "always" and interval:
+            self._flusher = threading.Thread(target=self._flush_loop, daemon=True)
+            self._flusher.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _flush_loop(self):      # background thread: pending files don't wait for the next add()
+        while not self._stop.wait(self.interval):
+            with self.lock:
+                if self.pending_files and time.monotonic() - self._last_flush >= self.interval:
+                    self._flush()
+
+    def add(self, file_name, data_bytes, created_ts=None, compress=None):
+        # appends one file, returns its entry, raises ValueError if this file can't be added
+        with self.lock:
+            if self._batch is None:
+                self._batch = self.image.batch()
+                self._batch.__enter__()
+            try:
+                slot, entry = self.image.add_bytes(file_name, data_bytes, created_ts, compress=compress)
+            except ValueError:
+                raise
+            except BaseException:      # I/O error: the image state can't be trusted, everything pending is dropped
+                batch, self._batch = self._batch, None
+                self.pending_files = self.pending_bytes = 0
+                batch.__exit__(*sys.exc_info())
+                raise
+            self.pending_files += 1
+            self.pending_bytes += entry.length
+            if (self.fsync == "always" or self.pending_bytes >= self.flush_bytes
+                    or time.monotonic() - self._last_flush >= self.interval):
+                self._flush()
+            return entry
+
+    def add_file(self, file_path, compress=None):   # appends a host file (small files: read at once)
+        with open(file_path, "rb") as src:
+            return self.add(host_file_name(file_path), src.read(), compress=compress)
+
+    def _flush(self):
+        self._last_flush = time.monotonic()
+        if self._batch is None:
+            return
+        batch, self._batch = self._batch, None
+        self.pending_files = self.pending_bytes = 0
+        batch.__exit__(None, None, None)    # one journal commit for everything since the last flush
+        self.flushes += 1
+
+    def flush(self):            # commits the pending files now
+        with self.lock:
+            self._flush()
+
+    def close(self):
+        self._stop.set()
+        if self._flusher is not None:
+            self._flusher.join()
+        try:
+            self.flush()
+        finally:
+            self.image.close()
 
 
 ######################### operations ##############################
 
-def mkfs(fs_name):              # make a new filesystem
+def mkfs(fs_name, version=VERSION, slots=BLOCK_SLOTS):    # make a new filesystem
+    # version 1: the classic layout with 32 slots (readable by the Java implementation)
+    # version 2: the table is a chain of table blocks (max BLOCK_SLOTS slots each) that grows when it is full,
+    #            slots = nb of slots to start with, plus a hash index name -> slot at the start of the data region
     if os.path.exists(fs_name) :# check filesystem doesn't already exist
         print(f"Error: {fs_name} already exists.")
         return
+    if version not in (VERSION, VERSION_2):
+        print(f"Error: unknown filesystem version {version}.")
+        return
+    if version == VERSION_2 and not 1 <= slots <= MAX_SLOTS_V2:
+        print(f"Error: number of slots must be between 1 and {MAX_SLOTS_V2}.")
+        return
 
     # create empty header
     header = Header()
 
+    if version == VERSION:
+        header.reserved2 = pack_slot_map(header, [])
+        with open(fs_name, "wb") as f:
+            f.write(header.pack())
+            f.truncate(DATA_START)  # body: empty file entries (32 entries of 64 bytes), zeros made by ftruncate
+        print(f"Created empty filesystem: {fs_name}")
+        return
+
+    # version 2: table blocks one after the other right after the header, each one pointing to the next
+    blocks = []
+    offset = HEADER_SIZE
+    for first_slot in range(0, slots, BLOCK_SLOTS):
+        slot_count = min(BLOCK_SLOTS, slots - first_slot)
+        blocks.append((offset, first_slot, slot_count))
+        offset += BLOCK_HEADER_SIZE + slot_count * ENTRY_SIZE
+    data_start = offset
+    buckets = index_bucket_count(slots)
+    index_size = ((buckets * INDEX_BUCKET_SIZE + 63) // 64) * 64
+
+    header.version = VERSION_2
+    header.file_capacity = slots
+    header.data_start_offset = data_start
+    header.next_free_offset = data_start + index_size   # the index is the first thing in the data region
+    header.set_index_location(data_start, buckets)
+
     with open(fs_name, "wb") as f:
         f.write(header.pack())
-        f.write(b"\x00" * (FILE_CAPACITY * ENTRY_SIZE)) # body: write empty file entries (32 entries of 64 bytes)
+        for i, (block_offset, first_slot, slot_count) in enumerate(blocks):
+            next_block = blocks[i + 1][0] if i + 1 < len(blocks) else 0
+            f.write(pack_table_block(next_block, first_slot, slot_count))
+            f.seek(slot_count * ENTRY_SIZE, os.SEEK_CUR)    # empty slots: skipped, they are zeros
+        f.truncate(data_start + index_size)                 # empty slots + empty index, never written
 
-    print(f"Created empty filesystem: {fs_name}")
+    print(f"Created empty filesystem: {fs_name} (version 2, {slots} slots)")
 
 
-def gifs(fs_name):              # get info of the filesystem
+def gifs(fs_name, output="text"):   # get info of the filesystem, output="json" prints the stats as JSON
+    if output == "json":
+        print_json(_stats_or_error(fs_name, files=False))
+        return
+
     if not os.path.exists(fs_name): # check if filesystem exists
         print(f"Error: {fs_name} doesn't exist.")
         return
 
-    with open(fs_name, "rb") as f:
-        # read header
-        header = Header().unpack(f.read(HEADER_SIZE))
+    image = open_image(fs_name)     # reads header + whole file entry table (any version)
+    if image is None:
+        return
+    with image:
+        header = image.header
 
         files_present = header.file_count   # number of files present (non deleted) 
-        free_entries = int((header.data_start_offset - header.free_entry_offset)/64) # remaining entries for new files (excluding deleted files) -> nb of actual empty spots
-                    # free_entries is the total nb of empty spots (spots with no active nor marked as deleted files), we don't want to allow overwritting on "marked as deleted" files 
+        free_entries = len(image.empty_slots) # remaining entries for new files (excluding deleted files) -> nb of actual empty spots
+                    # free_entries is the total nb of empty spots (spots with no active nor marked as deleted files)
                     # this way the user sees how many really free spots are left and if the filesystem has too many marked as deleted files he would first defragmentate before adding a new file       
         
-        # read all file entries to calculate total size
-        total_size = 0
-        f.seek(header.file_table_offset)  # make sure to start at the file entry table
-        for _ in range(header.file_capacity):
-            entry_data = f.read(ENTRY_SIZE)
-            entry = FileEntry().unpack(entry_data)
-            if entry.length > 0:
-                total_size += entry.length
+        # sizes of all file entries summed up from the raw table (data shared by deduplicated files counts once)
+        total_size = table_summary(image.raw_table)["total_size"]
 
         print(f"Filesystem: {fs_name}")
         print(f"Files present: {files_present}")
@@ -267,130 +2206,148 @@ def gifs(fs_name):              # get info of the filesystem
         print(f"Total space used: {total_size} bytes")
 
 
-def addfs(fs_name, file_path):  # add file to filesystem
+def host_file_name(file_path):  # name a host file gets inside the filesystem, raises ValueError if it can't be stored
+    host_file = Path(file_path)         # convert host file path -> a Path object for easier handling
+    if not host_file.exists():          # check whether the host file actually exists
+        raise ValueError(f"host file {file_path} does not exist.")
+
+    file_name = os.path.basename(file_path) # the length is checked against the version of the image when it is added
+    if len(file_name) == 0:
+        raise ValueError("file name must contain at least one character.")
+    return file_name
+
+
+def addfs(fs_name, file_path, compress=None, dedup=False):  # add file to filesystem
 # adds a file from the host computer into the .zvfs filesystem
 # throws an error if file already exists in filesystem
 # finds an available entry slot, writes the file's bytes into the data region (aligned to 64 bytes), 
 # updates the header, and creates a new file entry describing the stored file.
+# compress="zlib"/"lzma" stores the file compressed if that makes it smaller (the codec is kept in the entry type)
+# dedup=True reuses the data of a file with the same content that is already stored instead of writing it again
+# a directory is added with all the files in it, see addfs_tree
     
     if not os.path.exists(fs_name):     # check if filesystem exists
         print(f"Error: filesystem {fs_name} doesn't exist.")
         return
-    host_file = Path(file_path)         # convert host file path -> a Path object for easier handling
-    if not host_file.exists():          # check whether the host file actually exists
-        print(f"Error: host file {file_path} does not exist.")  # show error if host file is missing
-        return                          # stop function if file not found
+    if os.path.isdir(file_path):
+        addfs_tree(fs_name, file_path, compress, dedup)
+        return
+    try:
+        file_name = host_file_name(file_path)   # host file has to exist, its name is checked by the image
+    except ValueError as e:
+        print(f"Error: {e}")
+        return
 
-    data = host_file.read_bytes()       # read all bytes from the host file
-    data_length = len(data)             # get the real data length without padding
-    
-    file_name = os.path.basename(file_path) # get file name and check that length is valid
-    name_bytes = file_name.encode("utf-8")
-    if len(name_bytes) == 0:
-        print("Error: file name must contain at least one character.")
+    image = open_image(fs_name, writable=True)  # header + whole table are read once here
+    if image is None:
         return
-    if len(name_bytes) > 31:
-        print("Error: file name is too long in bytes (max 31 bytes in UTF-8).")
+    with image, open(file_path, "rb") as src:
+        try:
+            # data is streamed from the host file in chunks, so memory use doesn't depend on the file size
+            slot, entry = image.add_file(file_name, src, compress=compress, dedup=dedup)   # duplicate check is a dict lookup, no table scan
+        except ValueError as e:
+            print(f"Error: {e}")
+            return
+        shared = image.shared_refs(entry)
+
+    print(f"Added file: {file_name} ({entry.data_length()} bytes), information on that file is at entry {image.slot_offset(slot)}, the data is located at offset {entry.start}")  
+    if entry.is_compressed():
+        print(f"Stored {compress} compressed: {entry.length} bytes")
+    if shared > 1:
+        print(f"Same content as {shared - 1} other file(s), no data was written")
+
+
+def addfs_many(fs_name, file_paths, compress=None, dedup=False):   # add several files to filesystem in one transaction
+# same as calling addfs for every file, but all payloads are written first, then all entries, then the header,
+# and there is only ONE fsync at the end instead of one per file
+# all or nothing: if one of the files can't be added, none of them is
+
+    if not os.path.exists(fs_name):
+        print(f"Error: filesystem {fs_name} doesn't exist.")
         return
 
-    with open(fs_name, "r+b") as f:  # open the filesystem file for reading & writing in binary mode
-        f.seek(0)  # jump to the beginning of the filesystem
-        header = Header().unpack(f.read(HEADER_SIZE))   # read and unpack the header into a Header object
+    names = []
+    try:
+        for file_path in file_paths:    # validate everything before the first byte is written
+            file_name = host_file_name(file_path)
+            if file_name in names:
+                raise ValueError(f"file '{file_name}' is given more than once.")
+            names.append(file_name)
+    except ValueError as e:
+        print(f"Error: {e}")
+        print("Nothing was added.")
+        return
+    _add_all(fs_name, file_paths, names, compress, dedup)
 
-        # check that file we want to add doesn't already exist in filesystem
-        for i in range(header.file_capacity):           
-            f.seek(header.file_table_offset + i * ENTRY_SIZE)
-            raw = f.read(ENTRY_SIZE)
-            entry = FileEntry().unpack(raw)
 
-            if entry.flag == 0 and entry.name == file_name and entry.length > 0:
-                print(f"Error: file '{file_name}' already exists in filesystem.")
-                return
-        
-        # check if there is a free spot for a file entry
-        if header.flags == 1:   # no more free entries
-            print("Error: filesystem entry table is full, cannot add more files.")
-            return
-        
-        # find first free entry in filesystem table 
-        file_entry_index = header.free_entry_offset
-        if file_entry_index == 0:   # if free_entry_offset is 0 = fs is full no more data can be added
-            print("Error: filesystem is full, cannot add more data.")
-            return
+def addfs_tree(fs_name, dir_path, compress=None, dedup=False):    # add a host directory tree in one transaction
+# every file below dir_path keeps its path, starting with the name of dir_path itself:
+# "addfs fs photos" stores photos/2024/a.jpg as "photos/2024/a.jpg" (needs version 2 for paths over 31 bytes)
+# only regular files are added, empty directories are not stored (a directory exists through its files)
+# all or nothing like addfs_many
 
-        # calculate where file data should be written (next 64-aligned offset)
-        start = ((header.next_free_offset + 63) // 64) * 64 # works even if already aligned
+    if not os.path.exists(fs_name):
+        print(f"Error: filesystem {fs_name} doesn't exist.")
+        return
+    top = os.path.basename(os.path.abspath(dir_path))
+    if top in ("", ".", ".."):
+        print(f"Error: {dir_path} can't be added as a directory.")
+        return
 
-        # check that data to add is not longer than max allowed size
-        if start + data_length > MAX_OFFSET: # 4GB
-            print("Data is too big for this filesystem")
-            return
-        
-        f.seek(start)  # move pointer to where the file data will be stored
-        f.write(data)  # write the file data bytes into the filesystem
-
-        padded_length = ((data_length + 63) // 64) * 64         # compute padded size to remain 64-byte aligned
-        if padded_length > data_length:                         # check if padding is needed
-            f.write(b'\x00' * (padded_length - data_length))    # write zero padding bytes
-
-        # create and write new file entry
-        new_entry = FileEntry(          # create a new file entry object
-            name=file_name,             # store only the filename (not full path)
-            start=start,                # location where the file data starts
-            length=data_length,         # actual file length (without padding)
-            flag=0,                     # file is active (not deleted)
-            created=int(time.time())    # store creation timestamp
-        )  # end FileEntry constructor
-        f.seek(file_entry_index)        # move pointer to file entry slot
-        f.write(new_entry.pack())       # write packed file entry into filesystem
-
-        # update header
-        header.file_count += 1          # increase the number of active files
-        header.free_entry_offset = file_entry_index + 64 # move free_entry_offset to next slot for next file entry
-        header.next_free_offset = start + padded_length  # move next_free_offset to end of padded data
-        if header.free_entry_offset >= DATA_START:       # fs has no free file entries left
-            header.flags = 1
-            header.free_entry_offset = 0
-        if header.next_free_offset > MAX_OFFSET:         # fs is full (4GB)
-            print(f"After adding file {file_name} the filesystem is now full")
-            header.free_entry_offset = 0
-            return
+    file_paths = []
+    names = []
+    for dir_name, sub_dirs, file_names in os.walk(dir_path):
+        sub_dirs.sort()     # same order every time -> same slots
+        relative = os.path.relpath(dir_name, dir_path)
+        parts = [top] + ([] if relative == "." else relative.split(os.sep))
+        for file_name in sorted(file_names):
+            file_path = os.path.join(dir_name, file_name)
+            if os.path.isfile(file_path):   # no fifos, sockets, broken links...
+                file_paths.append(file_path)
+                names.append(PATH_SEP.join(parts + [file_name]))
+    if not file_paths:
+        print(f"Error: no files found in {dir_path}.")
+        return
+    _add_all(fs_name, file_paths, names, compress, dedup)
 
-        f.seek(0)                       # return pointer to beginning
-        f.write(header.pack())          # write updated header back to filesystem
-        f.flush()                       # flush Python buffer
-        os.fsync(f.fileno())            # ensure data is flushed to disk
 
-    print(f"Added file: {file_name} ({data_length} bytes), information on that file is at entry {file_entry_index}, the data is located at offset {start}")  
+def _add_all(fs_name, file_paths, names, compress, dedup):
+    # adds every file_paths[i] as names[i] in ONE batch, nothing is added if one of them fails
+    added = []
+    image = open_image(fs_name, writable=True)
+    if image is None:
+        return
+    with image:
+        try:
+            with image.batch():
+                for file_path, file_name in zip(file_paths, names):
+                    with open(file_path, "rb") as src:
+                        added.append(image.add_file(file_name, src, compress=compress, dedup=dedup))
+        except ValueError as e:     # batch() already rolled back everything
+            print(f"Error: {e}")
+            print("Nothing was added.")
+            return
+
+    for slot, entry in added:
+        print(f"Added file: {entry.name} ({entry.data_length()} bytes), information on that file is at entry {image.slot_offset(slot)}, the data is located at offset {entry.start}")
+    print(f"Added {len(added)} file(s) to {fs_name}")
 
 
 def getfs(fs_name, file_name):  # extract file from filesystem to disc
 # extracts a file stored inside the .zvfs filesystem back to the host computer
-# It searches the file-entry table for the requested filename, reads the file's data from the filesystem 
+# It looks the requested filename up in the file-entry table, reads the file's data from the filesystem 
 # using its stored offset and length, and writes it into a new file on the host
 
     if not os.path.exists(fs_name):  # ensure filesystem exists
         print(f"Error: filesystem {fs_name} not found.")  # show error if missing
         return  # stop function
 
-    with open(fs_name, "rb") as f:  # open filesystem for reading
-        f.seek(0)  # go to start
-        header = Header().unpack(f.read(HEADER_SIZE))  # load and unpack the header
-
-        if header.magic != MAGIC:
-            print("Error: invalid filesystem format.")
-            return
-
-        found_entry = None  # will store the matching file entry
-
-        for i in range(header.file_capacity):  # scan through all file entries
-            entry_offset = HEADER_SIZE + i * ENTRY_SIZE  # compute offset for entry i
-            f.seek(entry_offset)  # move pointer to entry
-            entry = FileEntry().unpack(f.read(ENTRY_SIZE))  # read and unpack entry
+    image = open_image(fs_name, use_mmap=True, load_table=False)   # lookup through the on-disk index (v2) or the slot map (v1)
+    if image is None:
+        return
 
-            if entry.name == file_name:
-                found_entry = entry  # store matching entry
-                break  # stop search
+    with image:
+        found_entry = image.find(file_name, include_deleted=True)  # active file first, deleted ones only as fallback
 
         if found_entry is None:  # if file not found
             print(f"Error: File '{file_name}' not found in filesystem.")  # print error
@@ -399,66 +2356,182 @@ def getfs(fs_name, file_name):  # extract file from filesystem to disc
         if found_entry.flag == 1:
             print(f"Warning: '{file_name}' is marked as deleted — recovering anyway.")
 
-        f.seek(found_entry.start)  # go to the start of the file’s data region
-        data = f.read(found_entry.length)  # read only the exact file length (exclude padding)
+        try:
+            out_path = host_path(found_entry.name)     # relative path of the file, directories are made if needed
+        except ValueError as e:
+            print(f"Error: {e}")
+            return
+        out_path.parent.mkdir(parents=True, exist_ok=True)
+        if out_path.exists():
+            print(f"Warning: file {out_path} already exists on host, it will be overwritten.")
+
+        with open(out_path, "wb") as out:  # open new host file for writing
+            if found_entry.is_compressed():
+                for chunk in image.iter_data(found_entry):     # decompressed chunk by chunk
+                    out.write(chunk)
+            else:
+                # the view covers only the exact file length (exclude padding) and goes straight from the mapping
+                # to the host file, the payload is never copied into a bytes object
+                with image.view(found_entry) as data:
+                    out.write(data)  # write extracted bytes to host system
+
+    print(f"Extracted file: {found_entry.name} ({found_entry.data_length()} bytes) from {fs_name}")
 
-    out_path = Path(found_entry.name)  # construct output path using file entry name
-    if out_path.exists():
-        print(f"Warning: file {out_path} already exists on host, it will be overwritten.")
 
-    with open(out_path, "wb") as out:  # open new host file for writing
-        out.write(data)  # write extracted bytes to host system
+def read_range(fs_name, file_name, offset, length):
+    # Python API: length bytes of a file in the filesystem starting at offset (negative offset = from the end)
+    # only the requested part is read, raises ValueError if the filesystem or the file doesn't exist
+    if not os.path.exists(fs_name):
+        raise ValueError(f"filesystem {fs_name} not found.")
+    with ZvfsImage(fs_name, load_table=False, lock_timeout=LOCK_TIMEOUT) as image:  # lookup through the on-disk index (v2) or the slot map (v1)
+        entry = image.lookup(file_name)
+        if entry is None:
+            raise ValueError(f"File '{file_name}' not found in filesystem.")
+        return image.read_range(entry, offset, length)
 
-    print(f"Extracted file: {found_entry.name} ({found_entry.length} bytes) from {fs_name}")
 
+def preadfs(fs_name, file_name, offset, length):   # write part of a file to stdout (raw bytes)
+    try:
+        data = read_range(fs_name, file_name, offset, length)
+    except ValueError as e:
+        print(f"Error: {e}")
+        return None
+    sys.stdout.buffer.write(data)
+    sys.stdout.buffer.flush()
+    return data
 
-def rmfs(fs_name, file_name):   # mark file of filesystem as deleted
-    # update flag, file_count changes as well (should return nb of active files and not marked as deleted)
+
+def getfs_all(fs_name, dest_dir, workers=None):    # extract every active file of the filesystem into dest_dir
+    # restoring a whole image: the header and table are parsed once and the files are written in parallel
+    # returns the nb of extracted files
 
+    if not os.path.exists(fs_name):
+        print(f"Error: filesystem {fs_name} not found.")
+        return 0
+
+    try:
+        with ZvfsImage(fs_name, lock_timeout=LOCK_TIMEOUT) as image:
+            paths = image.extract_all(dest_dir, workers)
+    except (ValueError, OSError) as e:
+        print(f"Error: {e}")
+        return 0
+
+    print(f"Extracted {len(paths)} file(s) from {fs_name} to {dest_dir}")
+    return len(paths)
+
+
+def ingestfs(fs_name, file_paths, fsync="interval", interval=1.0, flush_bytes=4 * 1024 * 1024):
+    # appends many small files through an IngestWriter, the paths come from file_paths or, if there are none,
+    # from stdin (one per line, as they arrive), a file that can't be added is reported and skipped
     if not os.path.exists(fs_name):
         print(f"Error: filesystem {fs_name} doesn't exist.")
         return
+    try:
+        writer = IngestWriter(fs_name, fsync, interval, flush_bytes)
+    except ValueError as e:
+        print(f"Error: {e}")
+        return
+    added = 0
+    with writer:
+        for file_path in file_paths or (line.rstrip("\n") for line in sys.stdin):
+            if not file_path:
+                continue
+            try:
+                writer.add_file(file_path)
+                added += 1
+            except (ValueError, OSError) as e:
+                print(f"Error: {file_path}: {e}")
+    print(f"Ingested {added} file(s) into {fs_name} ({writer.flushes} commit(s))")
+
+
+def exportfs(fs_name, out=None, since=0):
+    # writes the active files of the filesystem as an export stream to out (default: stdout), since > 0 only
+    # sends the files created since then (incremental), messages go to stderr because stdout is the stream
+    if not os.path.exists(fs_name):
+        print(f"Error: filesystem {fs_name} doesn't exist.", file=sys.stderr)
+        return
+    out = out if out is not None else sys.stdout.buffer
+    try:
+        with ZvfsImage(fs_name, lock_timeout=LOCK_TIMEOUT) as image:
+            sent = image.export(out, since)
+        out.flush()
+    except (ValueError, OSError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return
+    print(f"Exported {sent} file(s) from {fs_name}", file=sys.stderr)
+
+
+def importfs(fs_name, inp=None, replace=False):
+    # loads an export stream from inp (default: stdin) into the filesystem, made with the version of the exported
+    # image if it doesn't exist yet, an existing one keeps its files and gets the ones of the stream (nothing is
+    # imported if a name is already there), replace=True: it gets the same files as the exported image
+    inp = inp if inp is not None else sys.stdin.buffer
+    try:
+        header = read_export_header(inp)
+    except ValueError as e:
+        print(f"Error: {e}")
+        return
+    created = not os.path.exists(fs_name)
+    if created:
+        mkfs(fs_name, version=header[0])
 
-    with open(fs_name, "rb+") as f: # open filesystem for reading + writing
-        header = Header().unpack(f.read(HEADER_SIZE))
-        
-        f.seek(header.file_table_offset) # seek to the file entry table
-
-        found = False
-        for i in range(header.file_capacity):
-            pos = f.tell()                          # current position before reading, saves position of current start of file entry
-            entry_data = f.read(ENTRY_SIZE)         # this will move the pointer
-            entry = FileEntry().unpack(entry_data)
+    image = open_image(fs_name, writable=True)
+    if image is None:
+        return
+    with image:
+        try:
+            loaded, removed = image.import_stream(inp, header, replace)
+        except ValueError as e:     # batch() already rolled back everything
+            print(f"Error: {e}")
+            print("Nothing was imported.")
+            image.close()
+            if created:
+                os.remove(fs_name)
+            return
 
-            if entry.name == file_name and entry.flag == 0:
-                entry.flag = 1                      # mark as deleted
-                f.seek(pos)                         # go back to start of file entry
-                f.write(entry.pack())               # write updated entry back
+    print(f"Imported {loaded} file(s) into {fs_name}" + (f", removed {removed} file(s) that are gone" if removed else ""))
 
-                header.file_count -= 1              # update header
-                header.deleted_files += 1
 
-                f.seek(0)                           # write header back to disk
-                f.write(header.pack())
+def rmfs(fs_name, file_name, punch=False):     # mark file of filesystem as deleted
+    # update flag, file_count changes as well (should return nb of active files and not marked as deleted)
+    # punch=True gives the space of the file back to the host filesystem right away (the file can't be recovered)
 
-                print(f"Removed {file_name} from filesystem.")
-                found = True
-                break
+    if not os.path.exists(fs_name):
+        print(f"Error: filesystem {fs_name} doesn't exist.")
+        return
 
-        if not found:
+    image = open_image(fs_name, writable=True)  # open filesystem for reading + writing
+    if image is None:
+        return
+    with image:
+        if image.remove(file_name, punch=punch) is None:
             print(f"Error: file {file_name} not found in filesystem.")
+            return
+
+    print(f"Removed {file_name} from filesystem.")
+
 
+def lsfs(fs_name, output="text", path=None):  # list of all files stored in virtual filesystem, output="json" prints JSON
+    # path: only one directory (its files and sub directories, "/" = top) or the files matching a glob pattern
+    # ("photos/*/*.jpg", "**/*.txt"), picked through the PathTrie of the image
+    if output == "json":
+        result = _stats_or_error(fs_name)
+        if path is not None and "error" not in result:
+            files = result["files"]
+            dirs, selected = PathTrie({file["name"]: i for i, file in enumerate(files)}).select(path)
+            result = {**result, "path": path, "dirs": dirs, "files": [files[i] for name, i in selected]}
+        print_json(result)
+        return
 
-def lsfs(fs_name):              # list of all files stored in virtual filesystem
     if not os.path.exists(fs_name):                         # check if the file actually exists on disk
         print(f"Error: Filesystem '{fs_name}' not found.")
         return                                              # stop function
     
-    with open(fs_name, "rb") as f:                          # open file, read in binary 
-        
-        f.seek(0)                                           # read the header, position 0 
-        header_data = f.read(HEADER_SIZE)                   # read exactly 64 bytes (header size)
-        header = Header().unpack(header_data)               # convert binary data to Header object
+    image = open_image(fs_name)                             # reads header + whole file entry table (any version)
+    if image is None:
+        return
+    with image:
+        header = image.header
         
         # header tells num files in system, 32 slots
         print(f"Files in virtual filesystem: {fs_name}")    #displaying list header
@@ -469,26 +2542,20 @@ def lsfs(fs_name):              # list of all files stored in virtual filesystem
         found_files = False  # Flag to track if we found any files
         files_listed = 0     # Counter for actual files displayed
         
-        # Loop through ALL 32 possible file entry slots
-        for slot_number in range(header.file_capacity):
-            
-            # Calculate where this file entry is located in the file:
-            # Header (64 bytes) + (slot number × entry size 64 bytes)
-            entry_offset = HEADER_SIZE + (slot_number * ENTRY_SIZE)
-            
-            f.seek(entry_offset)
-            
-            # read 64 bytes 
-            entry_data = f.read(ENTRY_SIZE)
-            
-            # convert the binary data into a FileEntry object we can work with, unpack
-            entry = FileEntry().unpack(entry_data)
+        if path is None:
+            # active slots (not deleted, name exists) are filtered from the raw table in one go
+            dirs, slots = [], table_summary(image.raw_table)["active"]
+        else:
+            # only the part of the directory tree path needs, not every entry
+            dirs, selected = image.paths().select(path)
+            slots = [slot for name, slot in selected]
+        for dir_name in dirs:
+            print(f"{dir_name:<20} {'<DIR>':<12}")
+        for slot in slots:
+            entry = image.entries[slot]
             
-            # now checking real active file: not marked as deleted (entry.flag == 0), not a name, not just space
-            if (entry.flag == 0 and                    # Not deleted
-                entry.name and                         # name exists
-                entry.name.strip() and                 # name isn't just spaces
-                entry.length >= 0):                    # has valid size
+            # now checking real active file: name isn't just space
+            if entry.name.strip():
                 
                 found_files = True    # found at least one file
                 files_listed += 1     # counter
@@ -496,9 +2563,11 @@ def lsfs(fs_name):              # list of all files stored in virtual filesystem
                 # displaying 
                 created_time = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(entry.created))
                 
-                print(f"{entry.name:<20} {entry.length:<12} {created_time:<20}")
+                print(f"{entry.name:<20} {entry.data_length():<12} {created_time:<20}")  # original size if compressed
         
-        if not found_files:      # if no files were found: 
+        if path is not None and not found_files and not dirs:
+            print(f"No files found for '{path}'.")
+        elif not found_files and not dirs:      # if no files were found: 
             print("No active files found in the filesystem.")
             print("This filesystem is empty or all files are marked as deleted.")
         else:
@@ -506,72 +2575,32 @@ def lsfs(fs_name):              # list of all files stored in virtual filesystem
             print("-" * 60)
             print(f"Total files listed: {files_listed}")
             print(f"Filesystem capacity: {header.file_capacity} slots")
-            print(f"Free slots remaining: {int((header.data_start_offset - header.free_entry_offset)/64)}") # should print nb of actually empty slots (marked as deleted IS NOT an empty slot)
+            print(f"Free slots remaining: {len(image.empty_slots)}") # should print nb of actually empty slots (marked as deleted IS NOT an empty slot)
 
 
 def dfrgfs(fs_name):            # definitive deletion of marked files
-    # defragment by extracting active files, resetting the filesystem, and re-adding active files
-    # prints how many files were removed and how many bytes freed (counting padded bytes)
+    # defragment in place: active files are moved down over the gaps left by deleted files, chunk by chunk,
+    # so only one CHUNK_SIZE buffer of file data is ever held in memory, every step is committed through the journal
+    # prints how many files were removed and how many bytes freed (not counting padded bytes)
 
     if not os.path.exists(fs_name):
         print(f"Error: filesystem '{fs_name}' does not exist.")
         return
 
-    # read header and entries (read-only)
-    with open(fs_name, "rb") as f:
-        header = Header().unpack(f.read(HEADER_SIZE))
-
-        all_entries = []
-        for i in range(header.file_capacity):
-            f.seek(header.file_table_offset + i * ENTRY_SIZE)
-            raw = f.read(ENTRY_SIZE)
-            entry = FileEntry().unpack(raw)
-            all_entries.append(entry)
-
-        # collect active entries and deleted ones
-        active_infos = []  # list of tuples (name, bytes, time created)
-        deleted_count = 0
-        bytes_freed = 0
-
-        for e in all_entries:
-            if e.flag == 1:                 # deleted entry — add file size to freed bytes
-                file_data_freed = e.length 
-                bytes_freed += file_data_freed 
-                deleted_count += 1
-
-            elif e.name and e.length > 0:   # active file: read its data
-                f.seek(e.start)
-                data = f.read(e.length)
-                active_infos.append((e.name, data, e.created))
-
-    if deleted_count == 0:
-        print("No deleted files to remove. Filesystem already clean.")
-        return
-
-    print(f"Found {deleted_count} file(s) marked for deletion")
-    print(f"Found {len(active_infos)} active file(s)")
-
-    # reset filesystem in-place: create new empty header and zero the entry table region
-    empty_header = Header()
-    with open(fs_name, "r+b") as f:
-        # overwrite old header with new empty header
-        f.seek(0)
-        f.write(empty_header.pack())
-        # zero the file entry table region
-        f.seek(empty_header.file_table_offset)
-        f.write(b'\x00' * (FILE_CAPACITY * ENTRY_SIZE))
-        f.flush()
-        os.fsync(f.fileno())
-
-    # re-add active files using addfs_bytes (preserves creation time)
-    readded = 0
-    for name, data_bytes, created_ts in active_infos:
-        addfs_bytes(fs_name, name, data_bytes, created_ts)
-        readded += 1
-
-    # read new final header to report status after dfrgfs
-    with open(fs_name, "rb") as f:
-        final_header = Header().unpack(f.read(HEADER_SIZE))
+    image = open_image(fs_name, writable=True)
+    if image is None:
+        return
+    with image:
+        deleted_count = sum(1 for entry in image.entries if entry.flag == 1)   # count from the table, not the header counters
+        if deleted_count == 0 and not image.free_extents:  # holes can also be left over after reusing deleted space
+            print("No deleted files to remove. Filesystem already clean.")
+            return
+
+        print(f"Found {deleted_count} file(s) marked for deletion")
+        print(f"Found {len(image.index)} active file(s)")
+
+        deleted_count, bytes_freed = image.compact()
+        final_header = image.header
 
     print("Defragmentation complete!")
     print(f"Files removed: {deleted_count}")
@@ -579,6 +2608,32 @@ def dfrgfs(fs_name):            # definitive deletion of marked files
     print(f"Active files after defragmentation: {final_header.file_count}")
     print(f"Next free data offset: {final_header.next_free_offset}")
 
+
+def fsckfs(fs_name, workers=None):     # check the stored checksums of all files in the filesystem
+    # every active file with a checksum is read back and its crc32 compared with the one stored at addfs time,
+    # the files are spread over a thread pool so the check runs at disk speed
+    # returns the names of the corrupt files
+
+    if not os.path.exists(fs_name):
+        print(f"Error: filesystem '{fs_name}' does not exist.")
+        return []
+
+    image = open_image(fs_name)
+    if image is None:
+        return []
+    with image:
+        ok, corrupt, unchecked = image.verify(workers)
+        stale_map = image.header.version == VERSION and image.header.reserved2 != pack_slot_map(image.header, image.entries)
+
+    for entry in corrupt:
+        print(f"CORRUPT: {entry.name} ({entry.length} bytes at offset {entry.start})")
+    print(f"Checked {len(ok) + len(corrupt)} file(s) in {fs_name}: {len(ok)} ok, {len(corrupt)} corrupt")
+    if unchecked:
+        print(f"{len(unchecked)} file(s) have no checksum and were not checked")
+    if stale_map:   # e.g. changed by the Java implementation, harmless: it isn't used and is written again on the next change
+        print("Note: the slot map in the header is out of date, it is written again with the next change")
+    return [entry.name for entry in corrupt]
+
         
 def catfs(fs_name, file_name):  # print the contents of a file stored in the .zvfs filesystem to the console
     
@@ -586,34 +2641,41 @@ def catfs(fs_name, file_name):  # print the contents of a file stored in the .zv
         print(f"Error: filesystem '{fs_name}' does not exist.")
         return
 
-    with open(fs_name, "rb") as f:
-       
-        # Read header
-        header = Header().unpack(f.read(HEADER_SIZE))
-        
-        found_entry = None
-
-        # Search for file in file entries
-        for i in range(header.file_capacity):
-            entry_offset = HEADER_SIZE + i * ENTRY_SIZE
-            f.seek(entry_offset)
-            entry = FileEntry().unpack(f.read(ENTRY_SIZE))
-            
-            if entry.name == file_name and entry.flag == 0:  # active file only
-                found_entry = entry
-                break
+    image = open_image(fs_name, use_mmap=True, load_table=False)   # lookup through the on-disk index (v2) or the slot map (v1)
+    if image is None:
+        return
+    with image:
+        found_entry = image.lookup(file_name)   # active file only
 
         if found_entry is None:
             print(f"Error: File '{file_name}' not found in filesystem.")
             return
 
-        # Read the actual file data
-        f.seek(found_entry.start)
-        data = f.read(found_entry.length)
-
-        # Print raw bytes as string, no decode 
         print(f"Contents of '{file_name}':\n")
-        print(data.decode(errors='ignore'))  # ignore any invalid bytes, safe for beginners
+        # decode and print chunk by chunk from the mapped (and if needed decompressed) data,
+        # so a big file is never decoded in one piece
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")  # ignore any invalid bytes, safe for beginners
+        for chunk in image.iter_data(found_entry):
+            sys.stdout.write(decoder.decode(chunk))
+        sys.stdout.write(decoder.decode(b"", final=True) + "\n")
+
+
+def pop_flag(args, flag):       # removes "--flag" from the command line args, returns whether it was there
+    if flag not in args:
+        return False
+    args.remove(flag)
+    return True
+
+
+def pop_option(args, option, default=None):    # removes "--option value" from the command line args, returns value
+    if option not in args:
+        return default
+    i = args.index(option)
+    if i + 1 >= len(args):
+        return default
+    value = args[i + 1]
+    del args[i:i + 2]
+    return value
 
 
 if __name__ == "__main__":
@@ -624,28 +2686,91 @@ if __name__ == "__main__":
     command = sys.argv[1]
 
     if command == "mkfs":
-        mkfs(sys.argv[2])
+        if len(sys.argv) > 3 and sys.argv[3] != "--v2":
+            print("Usage: python zvfs.py mkfs <filesystem> [--v2 [initial_slots]]")
+            sys.exit(1)
+        if len(sys.argv) > 3:
+            mkfs(sys.argv[2], VERSION_2, int(sys.argv[4]) if len(sys.argv) > 4 else BLOCK_SLOTS)
+        else:
+            mkfs(sys.argv[2])
 
     if command == "gifs":
-        gifs(sys.argv[2])
+        output = pop_option(sys.argv, "--format", "text")
+        if output not in ("text", "json"):
+            print("Usage: python zvfs.py gifs <filesystem> [--format text|json]")
+            sys.exit(1)
+        gifs(sys.argv[2], output)
+
+    if command == "stats":     # python zvfs.py stats <filesystem> [more_filesystems ...] [--files] [--workers N], JSON
+        files = pop_flag(sys.argv, "--files")
+        workers = pop_option(sys.argv, "--workers")
+        results = stats_many(sys.argv[2:], files, int(workers) if workers else None)
+        print_json(results)
+        if any("error" in result for result in results):
+            sys.exit(1)
 
     if command == "addfs":
-        if len(sys.argv) < 4:
-            print("Usage: python zvfs.py addfs <filesystem> <file_to_add>")
+        compress = pop_option(sys.argv, "--compress")
+        dedup = pop_flag(sys.argv, "--dedup")
+        if len(sys.argv) < 4 or compress not in (None, *CODECS):
+            print("Usage: python zvfs.py addfs <filesystem> <file_or_directory_to_add> [--compress zlib|lzma] [--dedup]")
             sys.exit(1)
-        addfs(sys.argv[2], sys.argv[3])
+        addfs(sys.argv[2], sys.argv[3], compress, dedup)
+
+    if command == "addmanyfs":
+        compress = pop_option(sys.argv, "--compress")
+        dedup = pop_flag(sys.argv, "--dedup")
+        if len(sys.argv) < 4 or compress not in (None, *CODECS):
+            print("Usage: python zvfs.py addmanyfs <filesystem> <file_to_add> [more_files_to_add ...] [--compress zlib|lzma] [--dedup]")
+            sys.exit(1)
+        addfs_many(sys.argv[2], sys.argv[3:], compress, dedup)
 
     if command == "getfs":
-        if len(sys.argv) < 4:
+        if len(sys.argv) < 4 or (sys.argv[3] == "--all" and len(sys.argv) < 5):
             print("Usage: python zvfs.py getfs <filesystem> <file_to_extract>")
+            print("       python zvfs.py getfs <filesystem> --all <destination_folder>")
+            sys.exit(1)
+        if sys.argv[3] == "--all":
+            getfs_all(sys.argv[2], sys.argv[4])
+        else:
+            getfs(sys.argv[2], sys.argv[3])
+
+    if command == "preadfs":
+        try:
+            offset, length = int(sys.argv[4]), int(sys.argv[5])
+        except (IndexError, ValueError):
+            print("Usage: python zvfs.py preadfs <filesystem> <file> <offset> <length>   (negative offset = from the end)")
+            sys.exit(1)
+        if preadfs(sys.argv[2], sys.argv[3], offset, length) is None:
             sys.exit(1)
-        getfs(sys.argv[2], sys.argv[3])
+
+    if command == "ingestfs":  # python zvfs.py ingestfs <filesystem> [files ...] [--fsync always|interval|never] [--interval S] [--flush-bytes N]
+        fsync = pop_option(sys.argv, "--fsync", "interval")
+        try:
+            interval = float(pop_option(sys.argv, "--interval", "1"))
+            flush_bytes = int(pop_option(sys.argv, "--flush-bytes", str(4 * 1024 * 1024)))
+        except ValueError:
+            print("Usage: python zvfs.py ingestfs <filesystem> [files ...] [--fsync always|interval|never] [--interval SECONDS] [--flush-bytes N]")
+            sys.exit(1)
+        ingestfs(sys.argv[2], sys.argv[3:], fsync, interval, flush_bytes)
+
+    if command == "exportfs":  # python zvfs.py exportfs <filesystem> [--since TIMESTAMP] > backup
+        since = pop_option(sys.argv, "--since", "0")
+        if not since.isdigit():
+            print("Usage: python zvfs.py exportfs <filesystem> [--since TIMESTAMP]", file=sys.stderr)
+            sys.exit(1)
+        exportfs(sys.argv[2], since=int(since))
+
+    if command == "importfs":  # python zvfs.py importfs <filesystem> [--replace] < backup
+        replace = pop_flag(sys.argv, "--replace")
+        importfs(sys.argv[2], replace=replace)
 
     if command == "rmfs":
+        punch = pop_flag(sys.argv, "--punch")
         if len(sys.argv) < 4:
-            print("Usage: python zvfs.py rmfs <filesystem> <file_to_extract>")
+            print("Usage: python zvfs.py rmfs <filesystem> <file_to_extract> [--punch]")
             sys.exit(1)
-        rmfs(sys.argv[2], sys.argv[3])
+        rmfs(sys.argv[2], sys.argv[3], punch)
     
     if command == "catfs":
         if len(sys.argv) < 4:
@@ -654,11 +2779,33 @@ if __name__ == "__main__":
         catfs(sys.argv[2], sys.argv[3])
     
     if command == "lsfs":
-        if len(sys.argv) < 3:
-            print("Usage: python zvfs.py lsfs <filesystem>")
+        output = pop_option(sys.argv, "--format", "text")
+        if len(sys.argv) < 3 or output not in ("text", "json"):
+            print("Usage: python zvfs.py lsfs <filesystem> [directory|'pattern'] [--format text|json]")
             sys.exit(1)
-        lsfs(sys.argv[2])
+        lsfs(sys.argv[2], output, sys.argv[3] if len(sys.argv) > 3 else None)
     
+    if command == "fsckfs":
+        if fsckfs(sys.argv[2]):
+            sys.exit(1)     # exit code tells scripts that something is corrupt
+
+    if command == "serve":     # python zvfs.py serve <filesystem> [socket_path]
+        import zvfs_server
+        zvfs_server.serve(sys.argv[2], sys.argv[3] if len(sys.argv) > 3 else None)
+
+    if command == "mount":     # python zvfs.py mount <filesystem> <mountpoint>, read only, needs fusepy
+        if len(sys.argv) < 4:
+            print("Usage: python zvfs.py mount <filesystem> <mountpoint>")
+            sys.exit(1)
+        import zvfs_fuse
+        zvfs_fuse.mount(sys.argv[2], sys.argv[3])
+
+    if command == "client":    # python zvfs.py client <filesystem> <command> [args...], talks to the daemon
+        import zvfs_server
+        response = zvfs_server.client(sys.argv[2], sys.argv[3:])
+        if not response or not response["ok"]:
+            sys.exit(1)
+
     if command == "dfrgfs":
         if len(sys.argv) < 3:
             print("Usage: python zvfs.py dfrgfs <filesystem>")
@@ -0,0 +1,115 @@
+# asyncio interface to a .zvfs image for services that run an event loop
+# the zvfs functions block (open, pread, fsync), so every operation of AsyncZvfs runs in a thread of its own
+# executor (not the loop's default one, which other libraries share): a slow fsync only keeps one worker busy,
+# the event loop and the other images go on
+#
+#   async with AsyncZvfs("filesystem1.zvfs") as fs:
+#       entry = await fs.add("a.txt", b"hello")
+#       data = await fs.read("a.txt")
+#
+# reads (read, read_range, list, stats) of the same image run at the same time, writes (add, remove) are done one
+# after the other and wait for running reads (ReadWriteLock of zvfs_server), so threads of this process never wait
+# for each other's flock; other processes are kept out by the flock as usual (waiting up to lock_timeout seconds)
+# every operation opens the image, does its work and closes it again, so it always sees changes of other processes
+# use one AsyncZvfs per image, all its methods have to be awaited from the same event loop
+# errors are raised like in ZvfsImage: ValueError (file not found, already exists, image locked...) or OSError
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import zvfs
+from zvfs_server import ReadWriteLock
+
+
+class AsyncZvfs:
+    def __init__(self, fs_name, workers=None, lock_timeout=zvfs.LOCK_TIMEOUT, executor=None):
+        # executor: share a ThreadPoolExecutor between several images (it is not shut down by close() then)
+        self.fs_name = fs_name
+        self.lock_timeout = lock_timeout
+        self.lock = ReadWriteLock()
+        self._own_executor = executor is None
+        self.executor = executor or ThreadPoolExecutor(max_workers=workers, thread_name_prefix="zvfs")
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):      # waits for running operations, then stops the worker threads
+        async with self.lock.write():
+            if self._own_executor:
+                self.executor.shutdown(wait=False)
+
+    async def _read(self, func, *args):
+        async with self.lock.read():
+            return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def _write(self, func, *args):
+        async with self.lock.write():
+            return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    def _open(self, **options):
+        return zvfs.ZvfsImage(self.fs_name, lock_timeout=self.lock_timeout, **options)
+
+    ######## blocking parts (run in the executor) ########
+
+    def _add(self, file_name, data_bytes, created_ts, compress, dedup):
+        with self._open(writable=True) as image:
+            return image.add_bytes(file_name, data_bytes, created_ts, compress=compress, dedup=dedup)[1]
+
+    def _add_file(self, file_path, compress, dedup):
+        with self._open(writable=True) as image, open(file_path, "rb") as src:
+            return image.add_file(zvfs.host_file_name(file_path), src, compress=compress, dedup=dedup)[1]
+
+    def _remove(self, file_name, punch):
+        with self._open(writable=True) as image:
+            if image.remove(file_name, punch=punch) is None:
+                raise ValueError(f"File '{file_name}' not found in filesystem.")
+
+    def _read_all(self, file_name):
+        with self._open(load_table=False) as image:
+            entry = image.lookup(file_name)
+            if entry is None:
+                raise ValueError(f"File '{file_name}' not found in filesystem.")
+            return b"".join(image.iter_data(entry))
+
+    def _read_range(self, file_name, offset, length):
+        with self._open(load_table=False) as image:
+            entry = image.lookup(file_name)
+            if entry is None:
+                raise ValueError(f"File '{file_name}' not found in filesystem.")
+            return image.read_range(entry, offset, length)
+
+    def _list(self, path):
+        with self._open() as image:
+            if path is None:
+                return [entry for slot, entry in image.active_entries()]
+            dirs, selected = image.paths().select(path)
+            return [image.entries[slot] for name, slot in selected]
+
+    ######## awaitable operations ########
+
+    async def add(self, file_name, data_bytes, created_ts=None, compress=None, dedup=False):
+        # stores data_bytes as file_name (committed and fsync'ed when it returns), returns the new FileEntry
+        return await self._write(self._add, file_name, data_bytes, created_ts, compress, dedup)
+
+    async def add_file(self, file_path, compress=None, dedup=False):   # like addfs, streams a host file into the image
+        return await self._write(self._add_file, file_path, compress, dedup)
+
+    async def remove(self, file_name, punch=False):     # marks the file as deleted (punch: see ZvfsImage.remove)
+        await self._write(self._remove, file_name, punch)
+
+    async def read(self, file_name):                    # the whole file (decompressed)
+        return await self._read(self._read_all, file_name)
+
+    async def read_range(self, file_name, offset, length):     # part of the file, see zvfs.read_range
+        return await self._read(self._read_range, file_name, offset, length)
+
+    async def list(self, path=None):
+        # FileEntry of every active file in slot order, with path only the files lsfs shows for it (a directory or
+        # a pattern like "photos/*.jpg", sorted by name)
+        return await self._read(self._list, path)
+
+    async def stats(self, files=True):                  # see zvfs.stats
+        return await self._read(zvfs.stats, self.fs_name, files)
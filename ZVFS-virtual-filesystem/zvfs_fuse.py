@@ -0,0 +1,175 @@
+# read-only FUSE adapter: shows the files of a .zvfs image as a directory tree (names with "/" are files in
+# sub directories), so other programs can read them in place instead of extracting copies with getfs
+#
+#   python zvfs.py mount <filesystem> <mountpoint>      (needs fusepy: pip install fusepy, and FUSE on the system)
+#
+# the image is opened once with ZvfsImage (read only, shared lock), so the header and the entry table are parsed once
+# and the stat result of every file is made once when the image is mounted, read() is a pread on the extent of the
+# entry (compressed files are decompressed once per open file, up to MAX_DECOMPRESSED bytes, bigger ones per read)
+# the shared lock is held while the image is mounted: the table can't change under the mount, commands that change
+# the image (addfs, rmfs, dfrgfs) wait for it and give up after a while, unmount first
+#
+# without fusepy the ZvfsFuse class still works (same method names and errors as fusepy's Operations), only
+# mounting is not possible, that's how the tests use it
+
+import errno
+import os
+import stat
+import sys
+import threading
+
+import zvfs
+
+try:
+    from fuse import FUSE, FuseOSError, Operations
+except (ImportError, OSError):  # no fusepy, or no libfuse (fusepy raises OSError then): stand-ins with the same interface
+    FUSE = None
+
+    class FuseOSError(OSError):
+        def __init__(self, error):
+            super().__init__(error, os.strerror(error))
+
+    class Operations:
+        def __call__(self, op, *args):
+            if not hasattr(self, op):
+                raise FuseOSError(errno.EFAULT)
+            return getattr(self, op)(*args)
+
+
+MAX_DECOMPRESSED = 64 * 1024 * 1024     # compressed files up to this size are kept decompressed while they are open
+
+
+class ZvfsFuse(Operations):
+    def __init__(self, fs_name, lock_timeout=zvfs.LOCK_TIMEOUT):
+        # raises ValueError/OSError if the image can't be opened
+        self.image = zvfs.ZvfsImage(fs_name, use_mmap=True, lock_timeout=lock_timeout)
+        self.lock = threading.Lock()    # fusepy calls from several threads unless nothreads=True
+        self._files = {}                # name -> entry, active files only
+        self._dirs = {}                 # "/dir/sub" -> PathTrie node of the directory
+        self._attrs = {}                # "/name" -> stat dict (cached for the whole mount)
+        image_stat = os.fstat(self.image.f.fileno())
+        for slot, entry in self.image.active_entries():
+            try:
+                zvfs.check_path(entry.name)     # can't be a path in a directory tree ("/a", "a//b", "../a")
+            except ValueError:
+                continue
+            self._files[entry.name] = entry
+            self._attrs["/" + entry.name] = {
+                "st_mode": stat.S_IFREG | 0o444,
+                "st_nlink": 1,
+                "st_size": entry.data_length(),
+                "st_blocks": (entry.length + 511) // 512,
+                "st_mtime": entry.created, "st_ctime": entry.created, "st_atime": entry.created,
+                "st_uid": image_stat.st_uid, "st_gid": image_stat.st_gid,
+            }
+        dirs = [("/", self.image.paths())]
+        while dirs:
+            path, node = dirs.pop()
+            self._dirs[path] = node
+            self._files.pop(path[1:], None)     # a file named like a directory (written by other tools) is hidden
+            self._attrs[path] = {
+                "st_mode": stat.S_IFDIR | 0o555,
+                "st_nlink": 2 + len(node.dirs),
+                "st_size": 0,
+                "st_mtime": image_stat.st_mtime, "st_ctime": image_stat.st_ctime, "st_atime": image_stat.st_atime,
+                "st_uid": image_stat.st_uid, "st_gid": image_stat.st_gid,
+            }
+            dirs.extend((path.rstrip("/") + "/" + name, sub) for name, sub in node.dirs.items() if name not in ("", ".", ".."))
+        self._open = {}                 # file handle -> (entry, decompressed bytes or None)
+        self._next_fh = 1
+
+    def close(self):
+        self.image.close()
+
+    def destroy(self, path):            # called by fusepy when the filesystem is unmounted
+        self.close()
+
+    def _entry(self, path):
+        entry = self._files.get(path[1:])
+        if entry is None:
+            raise FuseOSError(errno.ENOENT)
+        return entry
+
+    ######## fusepy operations ########
+
+    def getattr(self, path, fh=None):
+        attrs = self._attrs.get(path)
+        if attrs is None:
+            raise FuseOSError(errno.ENOENT)
+        return attrs
+
+    def readdir(self, path, fh):
+        node = self._dirs.get(path)
+        if node is None:
+            raise FuseOSError(errno.ENOTDIR if path in self._attrs else errno.ENOENT)
+        prefix = path[1:] + "/" if path != "/" else ""
+        return [".", ".."] + [name for name in node.dirs if "/" + prefix + name in self._dirs] + [name for name in node.files if prefix + name in self._files]
+
+    def open(self, path, flags):
+        entry = self._entry(path)
+        if flags & (os.O_WRONLY | os.O_RDWR | os.O_APPEND | os.O_TRUNC):
+            raise FuseOSError(errno.EROFS)
+        with self.lock:
+            data = None
+            if entry.is_compressed() and entry.data_length() <= MAX_DECOMPRESSED:
+                data = b"".join(self.image.iter_data(entry))
+            fh = self._next_fh
+            self._next_fh += 1
+            self._open[fh] = (entry, data)
+        return fh
+
+    def read(self, path, size, offset, fh):
+        opened = self._open.get(fh)
+        if opened is None:      # not opened through us (fh = 0), read straight from the entry
+            opened = (self._entry(path), None)
+        entry, data = opened
+        if data is not None:
+            return data[offset:offset + size]
+        if offset >= entry.data_length():
+            return b""
+        return self.image.read_range(entry, offset, size)
+
+    def release(self, path, fh):
+        with self.lock:
+            self._open.pop(fh, None)
+        return 0
+
+    def statfs(self, path):
+        header = self.image.header
+        namemax = zvfs.MAX_PATH_BYTES if header.version == zvfs.VERSION_2 else zvfs.NAME_BYTES
+        return {"f_bsize": 64, "f_frsize": 64, "f_blocks": header.next_free_offset // 64, "f_bfree": 0,
+                "f_bavail": 0, "f_files": header.file_capacity, "f_ffree": 0, "f_namemax": namemax}
+
+    # everything that would change the image
+    def _read_only(self, *args):
+        raise FuseOSError(errno.EROFS)
+
+    chmod = chown = create = mkdir = rename = rmdir = symlink = truncate = unlink = utimens = write = _read_only
+
+
+def mount(fs_name, mountpoint, foreground=True):   # mounts the image until it is unmounted (fusermount -u / Ctrl+C)
+    if FUSE is None:
+        print("Error: mounting needs fusepy (pip install fusepy) and libfuse.")
+        return
+    if not os.path.exists(fs_name):
+        print(f"Error: filesystem {fs_name} not found.")
+        return
+    if not os.path.isdir(mountpoint):
+        print(f"Error: mount point {mountpoint} is not a directory.")
+        return
+    try:
+        operations = ZvfsFuse(fs_name)
+    except (ValueError, OSError) as e:
+        print(f"Error: {e}")
+        return
+    try:
+        FUSE(operations, mountpoint, foreground=foreground, ro=True, fsname=os.path.basename(fs_name))
+    finally:
+        operations.close()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print("Usage: python zvfs_fuse.py <filesystem> <mountpoint>")
+        sys.exit(1)
+    mount(sys.argv[1], sys.argv[2])
@@ -0,0 +1,341 @@
+# zvfs daemon: keeps one .zvfs image open (header + table in memory) and answers requests on a unix domain socket
+# every normal command starts python, opens the image and reads the table again, with the daemon a command is
+# only one round trip over the socket
+#
+# protocol: one JSON object per line, in both directions
+#   {"op": "ls"}                                                 -> {"ok": true, "files": [{"name", "size", "created"}, ...]}
+#   {"op": "ls", "path": "photos/*.jpg"}                         -> {"ok": true, "path", "dirs": ["sub/", ...], "files": [...]}
+#   {"op": "add", "path": "/host/file", "compress": null, "dedup": false} -> {"ok": true, "name", "size", "offset"}
+#   {"op": "get", "name": "a.txt", "dest": "/host/a.txt"}        -> {"ok": true, "size"}
+#   {"op": "cat", "name": "a.txt"}                               -> {"ok": true, "text"}
+#   {"op": "rm", "name": "a.txt", "punch": false}                -> {"ok": true}
+# on error: {"ok": false, "error": "..."}
+# host paths are read/written by the daemon itself, so they have to be absolute (the client takes care of that)
+# every field is checked for its type before it is used: a request with a wrong one only gets an error
+#
+# reads (ls, get, cat) run at the same time in worker threads (they only use os.pread), writes (add, rm) wait until
+# the running reads are done and are done one at a time
+# group commit: writes that come in while another write is running are queued and then done together in ONE
+# transaction (one journal commit for all of them), if one of them fails it gets its error and the others are
+# done again together without it
+#
+# the daemon keeps the table in memory, so nobody else may change the image while it runs: it holds the exclusive
+# fcntl.flock of a writable ZvfsImage the whole time and refuses to start if another process already holds a lock
+# on it, zvfs.py commands on the same image wait for the lock and then give up with an error (use the client instead)
+
+import asyncio
+import codecs
+import json
+import os
+import socket
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
+import zvfs
+
+
+######################### read/write lock ##############################
+
+class ReadWriteLock:
+    # any nb of readers or one writer, a waiting writer stops new readers from coming in (so it can't starve)
+    def __init__(self):
+        self._cond = asyncio.Condition()
+        self._readers = 0
+        self._writer = False
+        self._waiting_writers = 0
+
+    @asynccontextmanager
+    async def read(self):
+        async with self._cond:
+            await self._cond.wait_for(lambda: not self._writer and not self._waiting_writers)
+            self._readers += 1
+        try:
+            yield
+        finally:
+            async with self._cond:
+                self._readers -= 1
+                self._cond.notify_all()
+
+    @asynccontextmanager
+    async def write(self):
+        async with self._cond:
+            self._waiting_writers += 1
+            try:
+                await self._cond.wait_for(lambda: not self._writer and self._readers == 0)
+            finally:
+                self._waiting_writers -= 1
+            self._writer = True
+        try:
+            yield
+        finally:
+            async with self._cond:
+                self._writer = False
+                self._cond.notify_all()
+
+
+######################### server ##############################
+
+class ZvfsServer:
+    READ_OPS = ("ls", "get", "cat")
+    WRITE_OPS = ("add", "rm")
+
+    def __init__(self, fs_name, workers=None):
+        # exclusive lock for the whole lifetime (ZvfsImage takes it), don't wait for other processes
+        # raises ValueError for a broken or locked image
+        self.image = zvfs.ZvfsImage(fs_name, writable=True, lock_timeout=0)
+        self.lock = ReadWriteLock()
+        self.pool = ThreadPoolExecutor(max_workers=workers)    # own threads, not shared with the rest of the process
+        self._write_queue = []      # (op, request, future) waiting for the next group commit
+        self._writer = None         # task doing the group commits
+
+    def close(self):
+        self.pool.shutdown()
+        self.image.close()
+
+    ######## request fields ########
+    # raise ValueError for a field of the wrong type (KeyError if a required one is missing)
+
+    def _str(self, request, key):
+        value = request[key]
+        if not isinstance(value, str):
+            raise ValueError(f"field '{key}' must be a string")
+        return value
+
+    def _host_path(self, request, key):
+        value = self._str(request, key)
+        if not os.path.isabs(value):
+            raise ValueError(f"field '{key}' must be an absolute path")
+        return value
+
+    def _flag(self, request, key):
+        value = request.get(key, False)
+        if not isinstance(value, bool):
+            raise ValueError(f"field '{key}' must be true or false")
+        return value
+
+    ######## operations (run in a worker thread) ########
+
+    def do_ls(self, request):
+        if request.get("path") is None:
+            return {"files": [self._file(entry) for slot, entry in self.image.active_entries()]}
+        path = self._str(request, "path")
+        dirs, selected = self.image.paths().select(path)    # the prefix tree stays in memory with the table
+        return {"path": path, "dirs": dirs, "files": [self._file(self.image.entries[slot]) for name, slot in selected]}
+
+    def _file(self, entry):
+        return {"name": entry.name, "size": entry.data_length(), "created": entry.created}
+
+    def do_add(self, request):
+        path = self._host_path(request, "path")
+        file_name = zvfs.host_file_name(path)
+        compress = request.get("compress")
+        if compress is not None and not (isinstance(compress, str) and compress in zvfs.CODECS):
+            raise ValueError(f"unknown compression {compress!r}")
+        dedup = self._flag(request, "dedup")
+        with open(path, "rb") as src:
+            slot, entry = self.image.add_file(file_name, src, compress=compress, dedup=dedup)
+        return {"name": entry.name, "size": entry.data_length(), "offset": entry.start}
+
+    def do_get(self, request):
+        name = self._str(request, "name")
+        dest = self._host_path(request, "dest")
+        entry = self.image.find(name, include_deleted=True)
+        if entry is None:
+            raise ValueError(f"File '{name}' not found in filesystem.")
+        self.image.extract(entry, dest)
+        return {"size": entry.data_length(), "deleted": entry.flag == 1}
+
+    def do_cat(self, request):
+        name = self._str(request, "name")
+        entry = self.image.lookup(name)
+        if entry is None:
+            raise ValueError(f"File '{name}' not found in filesystem.")
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+        text = "".join(decoder.decode(chunk) for chunk in self.image.iter_data(entry))
+        return {"text": text + decoder.decode(b"", final=True)}
+
+    def do_rm(self, request):
+        name = self._str(request, "name")
+        if self.image.remove(name, punch=self._flag(request, "punch")) is None:
+            raise ValueError(f"File '{name}' not found in filesystem.")
+        return {}
+
+    ######## connection handling ########
+
+    def error_response(self, e):
+        if isinstance(e, KeyError):
+            return {"ok": False, "error": f"missing field {e}"}
+        return {"ok": False, "error": str(e)}
+
+    def run_one(self, op, request):     # response dict of one request (in a worker thread)
+        try:
+            return {"ok": True, **getattr(self, "do_" + op)(request)}
+        except (KeyError, ValueError, OSError) as e:
+            return self.error_response(e)
+
+    def run_group(self, group):         # responses of several write requests, committed together in one transaction
+        # a request that fails is left out and the others run again (batch() rolled back all of them), if entering
+        # or committing the batch fails nothing of the group is on disk -> every request left fails with that error
+        responses = [None] * len(group)
+        todo = list(range(len(group)))
+        while todo:
+            failed = None
+            try:
+                with self.image.batch():
+                    for current in todo:
+                        op, request, future = group[current]
+                        try:
+                            responses[current] = {"ok": True, **getattr(self, "do_" + op)(request)}
+                        except (KeyError, ValueError, OSError):
+                            failed = current
+                            raise
+                return responses
+            except (KeyError, ValueError, OSError) as e:
+                if failed is None:
+                    for current in todo:
+                        responses[current] = self.error_response(e)
+                    return responses
+                responses[failed] = self.error_response(e)
+                todo.remove(failed)
+        return responses
+
+    async def execute(self, request):   # runs one request under the lock, returns the response dict
+        op = request.get("op") if isinstance(request, dict) else None
+        if op not in self.READ_OPS + self.WRITE_OPS:
+            return {"ok": False, "error": f"unknown operation {op!r}"}
+        loop = asyncio.get_running_loop()
+        if op in self.READ_OPS:
+            async with self.lock.read():
+                return await loop.run_in_executor(self.pool, self.run_one, op, request)
+        future = loop.create_future()
+        self._write_queue.append((op, request, future))
+        if self._writer is None:
+            self._writer = asyncio.create_task(self._write_loop())
+        return await future
+
+    async def _write_loop(self):
+        loop = asyncio.get_running_loop()
+        try:
+            while self._write_queue:
+                group, self._write_queue = self._write_queue, []
+                try:
+                    async with self.lock.write():
+                        responses = await loop.run_in_executor(self.pool, self.run_group, group)
+                except Exception as e:
+                    responses = [{"ok": False, "error": str(e)}] * len(group)
+                for (op, request, future), response in zip(group, responses):
+                    if not future.done():
+                        future.set_result(response)
+        finally:
+            self._writer = None
+
+    async def handle(self, reader, writer):     # one client connection, any nb of requests
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    response = await self.execute(json.loads(line))
+                except ValueError:     # not JSON (or not even utf-8)
+                    response = {"ok": False, "error": "request is not valid JSON"}
+                writer.write(json.dumps(response).encode("utf-8") + b"\n")
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, socket_path):
+        if os.path.exists(socket_path):     # left over from a daemon that was killed
+            os.remove(socket_path)
+        return await asyncio.start_unix_server(self.handle, path=socket_path)
+
+
+def default_socket(fs_name):
+    return fs_name + ".sock"
+
+
+def serve(fs_name, socket_path=None):   # runs the daemon until it is stopped with Ctrl+C
+    socket_path = socket_path or default_socket(fs_name)
+    if not os.path.exists(fs_name):
+        print(f"Error: filesystem {fs_name} not found.")
+        return
+    try:
+        server = ZvfsServer(fs_name)
+    except ValueError as e:
+        print(f"Error: {e}")
+        return
+
+    async def main():
+        async with await server.start(socket_path) as unix_server:
+            print(f"Serving {fs_name} on {socket_path}")
+            await unix_server.serve_forever()
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+
+
+######################### client ##############################
+
+def request(socket_path, message):     # sends one request, returns the response dict
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        sock.sendall(json.dumps(message).encode("utf-8") + b"\n")
+        with sock.makefile("rb") as f:
+            return json.loads(f.readline())
+
+
+def client(fs_name, args, socket_path=None):
+    # thin client: same commands as zvfs.py, but they are sent to the daemon serving fs_name
+    # returns the response dict, or None if the command line was wrong
+    socket_path = socket_path or default_socket(fs_name)
+    args = list(args)
+    compress = zvfs.pop_option(args, "--compress")
+    dedup = zvfs.pop_flag(args, "--dedup")
+    punch = zvfs.pop_flag(args, "--punch")
+    command = args[0] if args else None
+    if command == "lsfs":
+        message = {"op": "ls", "path": args[1] if len(args) > 1 else None}
+    elif command == "addfs" and len(args) > 1:
+        message = {"op": "add", "path": os.path.abspath(args[1]), "compress": compress, "dedup": dedup}
+    elif command == "getfs" and len(args) > 1:
+        message = {"op": "get", "name": args[1], "dest": os.path.abspath(args[1])}
+    elif command == "catfs" and len(args) > 1:
+        message = {"op": "cat", "name": args[1]}
+    elif command == "rmfs" and len(args) > 1:
+        message = {"op": "rm", "name": args[1], "punch": punch}
+    else:
+        print("Usage: python zvfs.py client <filesystem> lsfs|addfs|getfs|catfs|rmfs [args...]")
+        return None
+
+    try:
+        response = request(socket_path, message)
+    except OSError as e:
+        print(f"Error: no zvfs daemon for {fs_name} on {socket_path} ({e})")
+        return None
+
+    if not response["ok"]:
+        print(f"Error: {response['error']}")
+    elif command == "lsfs":
+        for dir_name in response.get("dirs", []):
+            print(f"{dir_name:<20} {'<DIR>':<12}")
+        for file in response["files"]:
+            print(f"{file['name']:<20} {file['size']:<12}")
+        print(f"Total files listed: {len(response['files'])}")
+    elif command == "addfs":
+        print(f"Added file: {response['name']} ({response['size']} bytes), the data is located at offset {response['offset']}")
+    elif command == "getfs":
+        print(f"Extracted file: {args[1]} ({response['size']} bytes) from {fs_name}")
+    elif command == "catfs":
+        print(f"Contents of '{args[1]}':\n")
+        print(response["text"])
+    elif command == "rmfs":
+        print(f"Removed file '{args[1]}' from {fs_name}")
+    return response